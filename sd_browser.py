@@ -14,7 +14,7 @@ def print_results(browser):
 
 loglevels = [logging.CRITICAL, logging.ERROR, logging.WARN, logging.INFO, logging.DEBUG]
 
-from soa import ServiceDirectoryBrowser
+from soa import ServiceDirectoryBrowser, SnapshotReader
 
 @asyncio.coroutine
 def main(argv=None):
@@ -24,11 +24,18 @@ def main(argv=None):
                         help="set logging verbosity, 1=CRITICAL, 5=DEBUG")
     parser.add_argument('url', nargs='?', default='coap://[::1]/servicediscovery/service',
                         help="URL to service directory")
+    parser.add_argument("--snapshot", default=None, metavar='PATH',
+                        help="Read the registry snapshot of a directory on this host instead")
     args = parser.parse_args()
 
     # logging setup
     logging.basicConfig(level=loglevels[args.verbosity-1])
 
+    if args.snapshot:
+        reader = SnapshotReader(args.snapshot)
+        pprint({srv.name: srv for srv in reader.service_list()}, indent=4, width=160)
+        return
+
     sdb = ServiceDirectoryBrowser(uri=args.url, notify=print_results)
     yield from sdb.start_observe()
 
@@ -1,17 +1,78 @@
 #!/usr/bin/env python3
 
+import os
 import logging
 import argparse
+import tempfile
+import multiprocessing
 
 import asyncio
 import ipaddress
 
+import aiohttp
+
 from soa.directory import ServiceDirectory
+from soa.directory.directory import CapacityPolicy
+from soa.directory import asyncdir
 from soa.directory import coap
 from soa.directory import http
+from soa.directory.memory import MemoryServiceDirectory
+from soa.directory import ratelimit
+from soa.directory.replica import ReplicaDirectory
+from soa.directory.snapshot import SnapshotPublisher
 
 loglevels = [logging.CRITICAL, logging.ERROR, logging.WARN, logging.INFO, logging.DEBUG]
 
+def start_servers(args, directory, loop, *, reuse_port=False, multicast=True):
+    """Start the CoAP and HTTP front ends"""
+    rate_limiter = None
+    if args.rate_limit:
+        # Shared by both front ends, so a client cannot double its rate
+        rate_limiter = ratelimit.RateLimiter(args.rate_limit, args.rate_burst,
+                                             key=args.rate_limit_key)
+
+    if args.coap_port:
+        # aiocoap only supports IPv6 sockets, use ::ffff:123.45.67.89 for
+        # listening on IPv4 addresses
+        coap_addr = ipaddress.ip_address(args.coap_bind)
+        if isinstance(coap_addr, ipaddress.IPv4Address):
+            coap_bind = '::ffff:' + str(coap_addr)
+        else:
+            coap_bind = str(coap_addr)
+        # TODO: Update this when aiocoap 0.3 is released on PyPi (loop support)
+        #coap_server = coap.Server(directory=directory, loop=loop)
+        coap_server = coap.Server(directory=directory, bind=(coap_bind, args.coap_port),
+                                  notify_interval=args.notify_interval,
+                                  notify_max_delay=args.notify_max_delay,
+                                  resource_directory=args.resource_directory,
+                                  rate_limiter=rate_limiter, reuse_port=reuse_port)
+        asyncio.async(coap_server.context)
+        if args.multicast and multicast:
+            asyncio.async(coap_server.join_multicast(
+                port=args.coap_port, interface=args.multicast_interface,
+                leisure=args.multicast_leisure))
+    if args.http_port:
+        http_directory = http.Server(directory=directory, loop=loop,
+                                     heartbeat_interval=args.heartbeat_interval,
+                                     rate_limiter=rate_limiter)
+        http_handler = http_directory.make_handler()
+        http_server = loop.create_server(http_handler, host=args.http_bind,
+            port=args.http_port, reuse_port=reuse_port)
+        asyncio.async(http_server)
+
+def run_worker(args, writer_socket, index):
+    """Serve the front ends from a replica of the registry of the writer"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    directory = ReplicaDirectory(
+        'http://writer/servicediscovery',
+        connector=aiohttp.UnixConnector(path=writer_socket, loop=loop),
+        sync_interval=args.sync_interval, loop=loop)
+    loop.run_until_complete(directory.start())
+    # Only one worker joins the multicast groups, others would answer again
+    start_servers(args, directory, loop, reuse_port=True, multicast=index == 0)
+    loop.run_forever()
+
 def main(argv=None):
     parser = argparse.ArgumentParser(argv)
     parser.add_argument('-f', '--dbfile', type=str, metavar='FILE', default='directory_db',
@@ -22,10 +83,72 @@ def main(argv=None):
                         help="CoAP port, use 0 to disable")
     parser.add_argument("--coap-bind", default='::',
                         help="CoAP server bind address")
+    parser.add_argument("--notify-interval", type=float, default=1.0,
+                        help="Minimum time between CoAP observe notifications in seconds, "
+                        "use 0 to notify on every change")
+    parser.add_argument("--notify-max-delay", type=float, default=5.0,
+                        help="Maximum time to hold back a CoAP observe notification in seconds")
+    parser.add_argument("--no-rd", dest='resource_directory', action='store_false',
+                        help="Disable the CoRE Resource Directory interface")
+    parser.add_argument("--in-memory", action='store_true',
+                        help="Keep the registry in memory instead of the database file")
+    parser.add_argument("--lifetime", type=int, default=30 * 60, metavar='SECONDS',
+                        help="Default lease lifetime of published services")
+    parser.add_argument("--min-lifetime", type=int, default=60, metavar='SECONDS',
+                        help="Minimum lease lifetime granted to publishers")
+    parser.add_argument("--max-lifetime", type=int, default=25 * 60 * 60, metavar='SECONDS',
+                        help="Maximum lease lifetime granted to publishers")
+    parser.add_argument("--type-lifetime", action='append', default=[],
+                        metavar='TYPE=SECONDS',
+                        help="Default lease lifetime of the services of a type, may be "
+                        "given several times")
+    parser.add_argument("--max-services", type=int, default=None, metavar='N',
+                        help="Maximum number of services in the registry")
+    parser.add_argument("--max-services-per-host", type=int, default=None, metavar='N',
+                        help="Maximum number of services per host")
+    parser.add_argument("--max-services-per-domain", type=int, default=None, metavar='N',
+                        help="Maximum number of services per domain")
+    parser.add_argument("--eviction-policy", default=CapacityPolicy.REJECT,
+                        choices=(CapacityPolicy.REJECT, CapacityPolicy.NEAREST_DEADLINE,
+                                 CapacityPolicy.LEAST_RECENTLY_RENEWED),
+                        help="What to do with new services when a limit is reached")
+    parser.add_argument("--rate-limit", type=float, default=None, metavar='RATE',
+                        help="Sustained number of services per second a client may publish "
+                        "or unpublish, unlimited if not given")
+    parser.add_argument("--rate-burst", type=int, default=10, metavar='N',
+                        help="Number of services a client may publish or unpublish at once")
+    parser.add_argument("--rate-limit-key", default=ratelimit.BY_ADDRESS,
+                        choices=(ratelimit.BY_ADDRESS, ratelimit.BY_HOST),
+                        help="Limit the rate per client address or per service host")
+    parser.add_argument("--db-workers", type=int, default=4, metavar='N',
+                        help="Number of threads running concurrent database lookups")
+    parser.add_argument("--multicast", action='store_true',
+                        help="Answer CoAP discovery requests sent to the All-CoAP-Nodes "
+                        "multicast groups")
+    parser.add_argument("--multicast-interface", default=None,
+                        help="Network interface to join the multicast groups on")
+    parser.add_argument("--multicast-leisure", type=float, default=5.0,
+                        help="Maximum random delay of multicast responses in seconds")
     parser.add_argument("--http-port", type=int, default=8045,
                         help="HTTP port, use 0 to disable")
     parser.add_argument("--http-bind", default='::',
                         help="HTTP server bind address")
+    parser.add_argument("--heartbeat-interval", type=float, default=15.0,
+                        help="Seconds between heartbeats on idle HTTP event streams")
+    parser.add_argument("--workers", type=int, default=0, metavar='N',
+                        help="Serve CoAP and HTTP from N worker processes sharing the ports, "
+                        "while this process owns the registry")
+    parser.add_argument("--writer-socket", default=None, metavar='PATH',
+                        help="Unix socket the workers reach the registry through, default "
+                        "is a temporary file")
+    parser.add_argument("--sync-interval", type=float, default=1.0, metavar='SECONDS',
+                        help="Maximum delay until workers see modifications made through "
+                        "other workers")
+    parser.add_argument("--snapshot", default=None, metavar='PATH',
+                        help="Keep a snapshot of the registry in this file for local readers, "
+                        "e.g. /dev/shm/sd_snapshot")
+    parser.add_argument("--snapshot-interval", type=float, default=0.5, metavar='SECONDS',
+                        help="Minimum time between two snapshots")
     args = parser.parse_args()
 
     # logging setup
@@ -34,28 +157,60 @@ def main(argv=None):
     #logging.getLogger("coap-server").setLevel(logging.DEBUG)
     #logging.getLogger("soa").setLevel(logging.DEBUG)
 
-    directory = ServiceDirectory(args.dbfile)
+    type_lifetimes = {}
+    for item in args.type_lifetime:
+        stype, _, lifetime = item.rpartition('=')
+        try:
+            type_lifetimes[stype] = int(lifetime)
+        except ValueError:
+            parser.error('Invalid --type-lifetime: {}'.format(item))
+    config = {
+        'lifetime': args.lifetime,
+        'min_lifetime': args.min_lifetime,
+        'max_lifetime': args.max_lifetime,
+        'type_lifetimes': type_lifetimes,
+        'max_services': args.max_services,
+        'max_services_per_host': args.max_services_per_host,
+        'max_services_per_domain': args.max_services_per_domain,
+        'eviction_policy': args.eviction_policy,
+        }
+
+    workers = []
+    if args.workers:
+        writer_socket = args.writer_socket or \
+            os.path.join(tempfile.mkdtemp(prefix='sd_server-'), 'writer.sock')
+        # Fork before this process starts any threads or event loop
+        for index in range(args.workers):
+            worker = multiprocessing.Process(
+                target=run_worker, args=(args, writer_socket, index), daemon=True)
+            worker.start()
+            workers.append(worker)
 
     loop = asyncio.get_event_loop()
 
-    if args.coap_port:
-        # aiocoap only supports IPv6 sockets, use ::ffff:123.45.67.89 for
-        # listening on IPv4 addresses
-        coap_addr = ipaddress.ip_address(args.coap_bind)
-        if isinstance(coap_addr, ipaddress.IPv4Address):
-            coap_bind = '::ffff:' + str(coap_addr)
-        else:
-            coap_bind = str(coap_addr)
-        # TODO: Update this when aiocoap 0.3 is released on PyPi (loop support)
-        #coap_server = coap.Server(directory=directory, loop=loop)
-        coap_server = coap.Server(directory=directory, bind=(coap_bind, args.coap_port))
-        asyncio.async(coap_server.context)
-    if args.http_port:
-        http_directory = http.Server(directory=directory, loop=loop)
-        http_handler = http_directory.make_handler()
-        http_server = loop.create_server(http_handler, host=args.http_bind,
-            port=args.http_port)
-        asyncio.async(http_server)
+    if args.in_memory:
+        directory = MemoryServiceDirectory(config=config)
+    else:
+        # Both front ends share the facade, which serialises their modifications
+        directory = asyncdir.AsyncServiceDirectory(
+            ServiceDirectory(args.dbfile, config=config), max_workers=args.db_workers,
+            loop=loop)
+
+    if args.snapshot:
+        # Written by the process owning the registry only
+        snapshot = SnapshotPublisher(directory, args.snapshot,
+                                     interval=args.snapshot_interval, loop=loop)
+        loop.run_until_complete(snapshot.start())
+
+    if workers:
+        # The workers forward modifications to this process, and follow its
+        # change feed
+        writer = http.Server(directory=directory, loop=loop)
+        if os.path.exists(writer_socket):
+            os.unlink(writer_socket)
+        loop.run_until_complete(loop.create_unix_server(writer.make_handler(), writer_socket))
+    else:
+        start_servers(args, directory, loop)
 
     loop.run_forever()
 
@@ -34,6 +34,7 @@ class LogMixin(object):
 from . import services, coap #pylint: disable=wrong-import-position
 from .services import Service #pylint: disable=wrong-import-position
 from .coap import ServiceDirectoryBrowser, CoAPObserver #pylint: disable=wrong-import-position
+from .snapshot import SnapshotReader #pylint: disable=wrong-import-position
 
 # Set default logging handler to avoid "No handler found" warnings.
 logging.getLogger(__name__).addHandler(NullHandler())
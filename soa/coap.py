@@ -1,40 +1,99 @@
 """SOA CoAP client functions"""
 
 import asyncio
+import copy
 import json
 
 import aiocoap
+from aiocoap.numbers.optionnumbers import OptionNumber
 
 from . import services
 
 from . import LogMixin
 
 class CoAPObserver(LogMixin, object):
-    """CoAP resource observer"""
+    """CoAP resource observer
+
+    Notifications which are too large for a single message are sent blockwise
+    by the server (:rfc:`7959#section-2.6`). Only the first block arrives as
+    the notification, the remaining blocks are fetched with ordinary GET
+    requests before the complete response is passed to the observation
+    handler. This applies to the initial response as well, because aiocoap
+    registers the observation under the token of the last block when it
+    assembles the response itself, and then rejects all notifications.
+
+    A notification is fresh for its Max-Age (:rfc:`7641#section-3.3.1`). If
+    no newer notification arrives by then, or within `refresh_interval`, the
+    observation is assumed to be lost, e.g. dropped by the server, and ends
+    with :attr:`lost` set, so that the caller can register it again.
+    """
+
+    default_max_age = 60
+    """Max-Age of notifications without the option, see :rfc:`7252#section-5.10.5`"""
+    max_age_grace = 5.0
+    """Time to wait for a notification after the previous one became stale, in
+    seconds"""
 
     def __init__(self, *args, uri, observation_handler,
-                 accept=aiocoap.numbers.media_types_rev['application/json'], **kwargs):
-        """Constructor"""
+                 accept=aiocoap.numbers.media_types_rev['application/json'],
+                 request_factory=None, refresh_interval=300.0, **kwargs):
+        """Constructor
+
+        :param request_factory: Callable creating the GET request to send
+            when the observation is started, default is :meth:`make_request`
+        :type request_factory: callable
+        :param refresh_interval: Longest time without notifications before the
+            observation is assumed to be lost, in seconds
+        :type refresh_interval: float
+        """
         super().__init__(*args, **kwargs)
         self.uri = uri
         self.requester = None
         self.context = None
         self.accept = accept
         self.observation_handler = observation_handler
+        self.request_factory = request_factory
+        self.refresh_interval = refresh_interval
+        self.lost = False
+        """True if the last observation ended because notifications stopped"""
+        self._request = None
+        self._observation_is_over = None
+        self._transfer = None
+        self._watchdog = None
 
-    @asyncio.coroutine
-    def start_observe(self):
-        """Begin observing the resource given in self.uri"""
-        self.context = yield from aiocoap.Context.create_client_context()
+    def make_request(self):
+        """Create a GET request for the observed resource
+
+        :returns: A CoAP request
+        :rtype: aiocoap.Message
+        """
+        if self.request_factory is not None:
+            return self.request_factory()
         request = aiocoap.Message(code=aiocoap.numbers.codes.Code.GET)
         request.set_request_uri(self.uri)
-        request.opt.accept = aiocoap.numbers.media_types_rev['application/json']
+        request.opt.accept = self.accept
+        return request
+
+    @asyncio.coroutine
+    def start_observe(self):
+        """Begin observing the resource given in self.uri
+
+        The client context is created on the first call, and used again when
+        the observation is registered again.
+        """
+        if self.context is None:
+            self.context = yield from aiocoap.Context.create_client_context()
+        self.lost = False
+        self._watch(None)
+        request = self.make_request()
+        self._request = copy.deepcopy(request)
         # Tell the server we want to observe the resource
         request.opt.observe = 0
         observation_is_over = asyncio.Future()
-        self.requester = self.context.request(request)
+        self._observation_is_over = observation_is_over
+        self.requester = self.context.request(request, handle_blockwise=False)
         self.requester.observation.register_errback(observation_is_over.set_result)
-        self.requester.observation.register_callback(self.observation_handler)
+        self.requester.observation.register_callback(self.notification_handler)
         self.log.info("Begin observation on '{}'".format(self.uri))
         self.log.debug("options: {}".format(repr(request.opt)))
         try:
@@ -44,27 +103,189 @@ class CoAPObserver(LogMixin, object):
             if not self.requester.observation.cancelled:
                 self.log.warning('Cancelling observation %r', self.requester.observation)
                 self.requester.observation.cancel()
+            return
         # Pass the initial GET response to the observation handler as well
-        self.observation_handler(response)
+        self.notification_handler(response)
         # The observation_is_over Future is only completed if the observation
         # stops for whatever reason
         exit_reason = yield from observation_is_over
+        self._cancel_transfer()
+        self._watch(None)
         # The below two lines are probably not necessary
         if not self.requester.observation.cancelled:
             self.requester.observation.cancel()
         self.log.info("Observation is over ({}): {!r}, {!r}".format(
             self.uri, exit_reason, self.requester.observation))
 
+    def cancel(self):
+        """End the observation, which makes start_observe return"""
+        if self._observation_is_over is not None and not self._observation_is_over.done():
+            self._observation_is_over.set_result('Cancelled by client')
+
+    def _cancel_transfer(self):
+        """Abandon the collection of the blocks of an earlier notification"""
+        if self._transfer is not None and not self._transfer.done():
+            self._transfer.cancel()
+        self._transfer = None
+
+    def _watch(self, response):
+        """Expect the next notification before a response becomes stale
+
+        :param response: The latest notification, or None to stop waiting
+        :type response: aiocoap.Message
+        """
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if response is None:
+            return
+        max_age = self.default_max_age
+        for option in response.opt.get_option(OptionNumber.MAX_AGE):
+            max_age = option.value
+        delay = min(max_age, self.refresh_interval) + self.max_age_grace
+        self._watchdog = asyncio.get_event_loop().call_later(delay, self._expired)
+
+    def _expired(self):
+        """End an observation which has not been notified in time"""
+        self._watchdog = None
+        if self._observation_is_over is not None and not self._observation_is_over.done():
+            self.log.info("No notification from '%s' in time, the observation is lost", self.uri)
+            self.lost = True
+            self._observation_is_over.set_result('No notification in time')
+
+    def notification_handler(self, response):
+        """Handler for incoming notifications
+
+        Complete notifications are passed on to the observation handler
+        directly, while the remaining blocks of a blockwise notification are
+        fetched first. A newer notification supersedes the transfer of an
+        older one.
+        """
+        self._cancel_transfer()
+        self._watch(response)
+        block2 = response.opt.block2
+        if block2 is None or not block2.more:
+            self.observation_handler(response)
+            return
+        if block2.block_number != 0:
+            self.log.warning('Notification starts with block %d, ignoring', block2.block_number)
+            return
+        self._transfer = asyncio.get_event_loop().create_task(self.fetch_blocks(response))
+
+    @asyncio.coroutine
+    def fetch_blocks(self, first):
+        """Fetch the remaining blocks of a blockwise notification and pass the
+        assembled response to the observation handler
+
+        The transfer is abandoned if the ETag of a block does not match the
+        ETag of the first block, which means that the resource has changed and
+        a newer notification is on its way.
+
+        :param first: The first block of the notification
+        :type first: aiocoap.Message
+        """
+        payload = first.payload
+        block2 = first.opt.block2
+        while block2.more:
+            # The blocks must be requested with the options of the original
+            # request, so that the server can tell which body they belong to
+            request = copy.deepcopy(self._request)
+            request.opt.block2 = (block2.block_number + 1, False, block2.size_exponent)
+            if first.mtype is not aiocoap.ACK:
+                # An aiocoap server answers the block requests of a notification
+                # with separate responses, and never acknowledges the requests,
+                # which holds back confirmable requests until their
+                # retransmissions time out
+                request.mtype = aiocoap.NON
+            try:
+                response = yield from self.context.request(
+                    request, handle_blockwise=False).response
+            except aiocoap.error.Error as exc:
+                self.log.warning('Fetching block %d failed: %r',
+                                 request.opt.block2.block_number, exc)
+                return
+            if not response.code.is_successful() or response.opt.block2 is None:
+                self.log.warning('Unexpected response to block %d: %s',
+                                 request.opt.block2.block_number, response.code)
+                return
+            if response.opt.etag != first.opt.etag:
+                self.log.info('Resource changed during blockwise transfer, waiting for the '
+                              'next notification')
+                return
+            block2 = response.opt.block2
+            payload += response.payload
+        self.log.debug('Assembled notification of %d bytes', len(payload))
+        first.payload = payload
+        first.opt.block2 = None
+        self.observation_handler(first)
+
 class ServiceDirectoryBrowser(LogMixin, object):
     """Client for the Arrowhead service directory"""
 
-    def __init__(self, *args, uri, notify=None, **kwargs):
-        """Constructor"""
+    def __init__(self, *args, uri, notify=None, delta=False, **kwargs):
+        """Constructor
+
+        :param uri: URI of the service list resource of the directory
+        :type uri: string
+        :param notify: Callback to call with this object as argument whenever
+            the service list has been updated
+        :type notify: callable(ServiceDirectoryBrowser)
+        :param delta: Ask the directory for the changes since the last update
+            instead of the complete service list
+        :type delta: bool
+        """
         super().__init__(*args, **kwargs)
         self.services = {}
         self.notify = notify
         self.uri = uri
         self.observer = None
+        self.delta = delta
+        self.epoch = None
+        self.generation = None
+        self.retry_interval = 15.0
+        self._resync = False
+
+    def make_request(self):
+        """Create a GET request for the service list
+
+        :returns: A CoAP request
+        :rtype: aiocoap.Message
+        """
+        request = aiocoap.Message(code=aiocoap.numbers.codes.Code.GET)
+        request.set_request_uri(self.uri)
+        request.opt.accept = aiocoap.numbers.media_types_rev['application/json']
+        if self.delta:
+            query = ['delta']
+            if self.generation is not None:
+                query.extend(['since={}'.format(self.generation), 'epoch={}'.format(self.epoch)])
+            request.opt.uri_query = tuple(request.opt.uri_query) + tuple(query)
+        return request
+
+    def _apply_service_list(self, slist):
+        """Update self.services from a decoded service list response
+
+        :param slist: Decoded JSON service list, or delta
+        :type slist: dict
+        :returns: False if the response is a delta which does not apply to
+            the current state of self.services
+        :rtype: bool
+        """
+        updated = [services.Service.from_json_dict(json_dict) for json_dict in slist['service']]
+        if 'since' in slist:
+            if slist.get('epoch') != self.epoch or slist['since'] != self.generation:
+                self.log.info('Missed an update from %s, requesting the full list', self.uri)
+                self.epoch = None
+                self.generation = None
+                return False
+            for name in slist.get('removed', []):
+                self.services.pop(name, None)
+        else:
+            self.services.clear()
+        for srv in updated:
+            self.services[srv.name] = srv
+        self.epoch = slist.get('epoch')
+        self.generation = slist.get('generation')
+        return True
 
     def browse_handler(self, response):
         """Handler for incoming responses to an active directory observation"""
@@ -79,48 +300,39 @@ class ServiceDirectoryBrowser(LogMixin, object):
         except ValueError as exc:
             raise RuntimeError('ValueError while parsing JSON service list: {}'.format(str(exc)))
         self.log.debug('slist: %r', slist)
-        for json_dict in slist['service']:
-            srv = services.Service.from_json_dict(json_dict)
-            name = srv.name
-            self.services[name] = srv
+        if not self._apply_service_list(slist):
+            if self.observer is not None:
+                self._resync = True
+                self.observer.cancel()
+            return
         if self.notify is not None:
             self.notify(self)
 
     @asyncio.coroutine
     def start_observe(self):
-        """Timed polling"""
-        if False:
-            # This would be correct if Block2 was working properly for observe in aiocoap
-            if self.observer is None:
-                self.observer = CoAPObserver(
-                    uri=self.uri, observation_handler=self.browse_handler,
-                    accept=aiocoap.numbers.media_types_rev['application/json'])
-            yield from self.observer.start_observe()
-        self.log.warning('Using polling because of missing Block2 Observation handler')
-        context = yield from aiocoap.Context.create_client_context()
-        self.log.info("Begin poll on '%s'", self.uri)
+        """Observe the service list
+
+        The observation is established again whenever it ends, e.g. when the
+        directory restarts. It is registered again right away when
+        notifications stop arriving, or when a delta notification does not
+        apply to the current state and the full list must be requested.
+        """
+        if self.observer is None:
+            self.observer = CoAPObserver(
+                uri=self.uri, observation_handler=self.browse_handler,
+                accept=aiocoap.numbers.media_types_rev['application/json'],
+                request_factory=self.make_request)
         while True:
-            request = aiocoap.Message(code=aiocoap.numbers.codes.Code.GET)
-            request.set_request_uri(self.uri)
-            request.opt.accept = aiocoap.numbers.media_types_rev['application/json']
-            requester = context.request(request)
-            self.log.debug("poll: %r, options: %r", request, request.opt)
+            self._resync = False
             try:
-                response = yield from asyncio.wait_for(requester.response, timeout=60.0)
-            except asyncio.TimeoutError:
-                # timed out waiting for server to respond
-                self.log.warning('Request timed out (60 s), retrying...')
-                continue
-            except ConnectionError as exc:
-                # connection refused etc.
-                self.log.warning('Connection error: %r, retrying in 15 s...', exc)
-                self.log.debug('Context: %r', context)
-                self.log.debug('Requester: %r', requester)
-                context = yield from aiocoap.Context.create_client_context()
-                yield from asyncio.sleep(15.0)
-                continue
-            # Pass the poll response to the observation handler
-            self.browse_handler(response)
-            self.log.debug('ServiceRegistry: Sleeping')
-            yield from asyncio.sleep(30.0) # magic number, wait 30 seconds before polling again
-            self.log.debug('ServiceRegistry: Awake')
+                yield from self.observer.start_observe()
+            except (ConnectionError, RuntimeError) as exc:
+                self.log.warning('Observation of %s failed: %r', self.uri, exc)
+            else:
+                if self._resync or self.observer.lost:
+                    # The state is known to be stale, so there is no point
+                    # in backing off
+                    continue
+            self.log.info('Observation of %s ended, retrying in %d s...',
+                          self.uri, self.retry_interval)
+            yield from asyncio.sleep(self.retry_interval)
@@ -0,0 +1,790 @@
+"""Asynchronous service directory interface
+
+:class:`AsyncDirectory` is the interface which the front ends use to access
+the registry from coroutines. Backends which can do their work without
+blocking, like :class:`soa.directory.memory.MemoryServiceDirectory`,
+implement it natively.
+
+:class:`soa.directory.directory.ServiceDirectory` stores the registry in a
+blitzdb database, so every lookup reads files and every modification commits
+to disk. Calling it from a coroutine stalls all other requests served by the
+event loop until the disk operation has finished.
+
+:class:`AsyncServiceDirectory` wraps a directory and runs its blocking
+operations on an executor instead. Lookups run concurrently with each other,
+while modifications are serialised and exclusive of any lookup, using a
+:class:`ReadWriteLock`.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import threading
+
+from .. import LogMixin
+from .directory import call_notify, unix_now, DoesNotExist, QuotaExceeded
+from .notify import DEFAULT_MAXSIZE, MERGE, EventBuffer, NotifyDispatcher
+
+__all__ = [
+    'AsyncDirectory',
+    'AsyncServiceDirectory',
+    'ChangeStream',
+    'ReadWriteLock',
+    'publish_batch',
+    'unpublish_batch',
+    ]
+
+CREATED = 'created'
+"""Batch status: the service was not published before"""
+UPDATED = 'updated'
+"""Batch status: the service was published before and has been replaced"""
+DELETED = 'deleted'
+"""Batch status: the service has been removed"""
+NOT_FOUND = 'not-found'
+"""Batch status: the service to remove was not published"""
+INVALID = 'invalid'
+"""Batch status: the service has no name and was skipped"""
+
+@asyncio.coroutine
+def publish_batch(directory, services, lifetime=None):
+    """Publish a batch of services, skipping services without a name
+
+    :param directory: The directory to publish in
+    :type directory: AsyncDirectory
+    :param services: The services to publish
+    :type services: list(soa.services.Service)
+    :param lifetime: Requested lease lifetime of all services in seconds
+    :type lifetime: int
+    :returns: Name, status and effective lease lifetime of each service, the
+        status is one of :data:`CREATED`, :data:`UPDATED` and :data:`INVALID`
+    :rtype: list(tuple(string, string, int))
+    """
+    valid = [service for service in services if service.name]
+    results = iter((yield from directory.publish_many(
+        services=valid, lifetimes=[lifetime] * len(valid))) if valid else ())
+    statuses = []
+    for service in services:
+        if not service.name:
+            statuses.append((service.name, INVALID, None))
+            continue
+        existed, effective = next(results)
+        statuses.append((service.name, UPDATED if existed else CREATED, effective))
+    return statuses
+
+@asyncio.coroutine
+def unpublish_batch(directory, names):
+    """Remove a batch of services, skipping empty names
+
+    :param directory: The directory to remove the services from
+    :type directory: AsyncDirectory
+    :param names: The names of the services to remove
+    :type names: list(string)
+    :returns: Name, status and None of each service, the status is one of
+        :data:`DELETED`, :data:`NOT_FOUND` and :data:`INVALID`
+    :rtype: list(tuple(string, string, None))
+    """
+    valid = [name for name in names if name]
+    found = iter((yield from directory.unpublish_many(names=valid)) if valid else ())
+    return [(name, (DELETED if next(found) else NOT_FOUND) if name else INVALID, None)
+            for name in names]
+
+class _Releaser(object): # pylint: disable=too-few-public-methods
+    """Context manager releasing a lock on exit"""
+
+    def __init__(self, release):
+        self._release = release
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        self._release()
+
+class ReadWriteLock(object):
+    """Readers-writer lock for coroutines
+
+    Any number of readers may hold the lock at the same time, while a writer
+    holds it exclusively. Waiting writers take precedence over new readers, so
+    a steady stream of lookups can not starve modifications. The lock is used
+    like :class:`asyncio.Lock`::
+
+        with (yield from lock.reader()):
+            ...
+    """
+
+    def __init__(self, *, loop=None):
+        """Constructor
+
+        :param loop: Event loop, default is the loop of the acquiring
+            coroutine
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self._loop = loop
+        self._readers = 0
+        self._writer = False
+        self._read_waiters = collections.deque()
+        self._write_waiters = collections.deque()
+
+    @property
+    def readers(self):
+        """Number of readers holding the lock"""
+        return self._readers
+
+    def locked(self):
+        """Check if a writer holds the lock
+
+        :rtype: bool
+        """
+        return self._writer
+
+    @asyncio.coroutine
+    def acquire_read(self):
+        """Acquire the lock for reading"""
+        if not self._writer and not self._write_waiters:
+            self._readers += 1
+            return
+        yield from self._wait(self._read_waiters, self.release_read)
+
+    @asyncio.coroutine
+    def acquire_write(self):
+        """Acquire the lock for writing"""
+        if not self._writer and not self._readers and not self._write_waiters:
+            self._writer = True
+            return
+        yield from self._wait(self._write_waiters, self.release_write)
+
+    @asyncio.coroutine
+    def _wait(self, waiters, release):
+        """Wait until the lock is handed over
+
+        :param waiters: Queue to wait in
+        :type waiters: collections.deque
+        :param release: Function giving the lock back, if it is handed over
+            after the waiting coroutine was cancelled
+        :type release: callable
+        """
+        waiter = asyncio.Future(loop=self._loop or asyncio.get_event_loop())
+        waiters.append(waiter)
+        try:
+            yield from waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                release()
+            else:
+                waiters.remove(waiter)
+                self._wake()
+            raise
+
+    def release_read(self):
+        """Release the lock after reading"""
+        if self._readers <= 0:
+            raise RuntimeError('Lock is not held for reading')
+        self._readers -= 1
+        self._wake()
+
+    def release_write(self):
+        """Release the lock after writing"""
+        if not self._writer:
+            raise RuntimeError('Lock is not held for writing')
+        self._writer = False
+        self._wake()
+
+    def _wake(self):
+        """Hand the lock over to the next waiting writer, or to all waiting
+        readers"""
+        if self._writer:
+            return
+        while self._write_waiters and self._write_waiters[0].done():
+            self._write_waiters.popleft()
+        if self._write_waiters:
+            if not self._readers:
+                self._writer = True
+                self._write_waiters.popleft().set_result(None)
+            return
+        while self._read_waiters:
+            waiter = self._read_waiters.popleft()
+            if not waiter.done():
+                self._readers += 1
+                waiter.set_result(None)
+
+    @asyncio.coroutine
+    def reader(self):
+        """Acquire the lock for reading
+
+        :returns: Context manager releasing the lock
+        """
+        yield from self.acquire_read()
+        return _Releaser(self.release_read)
+
+    @asyncio.coroutine
+    def writer(self):
+        """Acquire the lock for writing
+
+        :returns: Context manager releasing the lock
+        """
+        yield from self.acquire_write()
+        return _Releaser(self.release_write)
+
+class ChangeStream(object):
+    """Asynchronous iterator over the change events of a directory
+
+    Events are queued from the moment the stream is created until it is
+    closed, in a bounded :class:`soa.directory.notify.EventBuffer`. Use
+    :meth:`get` from a coroutine, or ``async for`` on Python 3.5 and later::
+
+        with directory.changes() as stream:
+            while True:
+                event = yield from stream.get()
+    """
+
+    def __init__(self, directory, *, maxsize=DEFAULT_MAXSIZE, policy=MERGE, loop=None):
+        """Constructor
+
+        :param directory: Directory to receive the change events of
+        :type directory: AsyncDirectory
+        :param maxsize: Maximum number of pending events
+        :type maxsize: int
+        :param policy: Buffer policy, see :class:`soa.directory.notify.EventBuffer`
+        :type policy: string
+        :param loop: Event loop
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self._directory = directory
+        self.buffer = EventBuffer(maxsize, policy, loop=loop)
+        self._closed = False
+        directory.add_notify_callback(self.buffer.put_nowait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        event = yield from self.get()
+        if event is None:
+            raise StopAsyncIteration #pylint: disable=undefined-variable
+        return event
+
+    def pending(self):
+        """Get the number of queued events
+
+        :rtype: int
+        """
+        return self.buffer.qsize()
+
+    @asyncio.coroutine
+    def get(self):
+        """Wait for the next change event
+
+        :returns: The next event, or None once the stream is closed
+        :rtype: soa.directory.directory.ChangeEvent
+        """
+        return (yield from self.buffer.get())
+
+    def close(self):
+        """Stop receiving change events
+
+        Events queued before closing are still returned by :meth:`get`.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._directory.del_notify_callback(self.buffer.put_nowait)
+        self.buffer.close()
+
+class AsyncDirectory(object):
+    """Service directory interface for coroutines
+
+    Lookups and modifications are coroutines. Notify callbacks are always
+    called on the event loop.
+    """
+
+    DoesNotExist = DoesNotExist
+    QuotaExceeded = QuotaExceeded
+
+    def changes(self, **kwargs):
+        """Iterate over the change events of the directory
+
+        :param kwargs: Buffer options, see :class:`ChangeStream`
+        :rtype: ChangeStream
+        """
+        return ChangeStream(self, **kwargs)
+
+    def subscribe(self, callback, **kwargs):
+        """Register a callback which is called from a task of its own
+
+        Unlike callbacks registered with :meth:`add_notify_callback`, a slow
+        or failing subscriber does not delay modifications of the registry,
+        see :class:`soa.directory.notify.NotifyDispatcher`.
+
+        :param callback: Callback or coroutine function to pass the change
+            events to
+        :type callback: callable(ChangeEvent)
+        :param kwargs: Buffer options, see
+            :class:`soa.directory.notify.NotifyDispatcher`
+        :returns: The dispatcher, which also collects statistics
+        :rtype: soa.directory.notify.NotifyDispatcher
+        """
+        dispatcher = NotifyDispatcher(callback, **kwargs)
+        self.add_notify_callback(dispatcher)
+        return dispatcher
+
+    def unsubscribe(self, dispatcher):
+        """Unregister a callback registered with :meth:`subscribe`, dropping
+        the events it has not processed yet
+
+        :param dispatcher: The dispatcher returned by :meth:`subscribe`
+        :type dispatcher: soa.directory.notify.NotifyDispatcher
+        """
+        self.del_notify_callback(dispatcher)
+        dispatcher.cancel()
+
+    def add_notify_callback(self, callback):
+        """Register a callback to be executed whenever the service registry
+        is updated, see
+        :meth:`soa.directory.directory.ServiceDirectory.add_notify_callback`
+
+        :param callback: The callback to register
+        :type callback: callable(ChangeEvent)
+        """
+        raise NotImplementedError
+
+    def del_notify_callback(self, callback):
+        """Unregister a callback
+
+        :param callback: The callback to unregister
+        :type callback: callable(ChangeEvent)
+        """
+        raise NotImplementedError
+
+    def epoch(self):
+        """Get the identifier of this instance of the registry, see
+        :meth:`soa.directory.directory.ServiceDirectory.epoch`
+
+        :rtype: string
+        """
+        raise NotImplementedError
+
+    def next_deadline(self):
+        """Get the time when the first service in the registry will time out,
+        see :meth:`soa.directory.directory.ServiceDirectory.next_deadline`
+
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def generation(self):
+        """Get the current generation of the registry, see
+        :meth:`soa.directory.directory.ServiceDirectory.generation`
+
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def changes_since(self, since, epoch=None):
+        """Get the changes to the registry after a given generation, see
+        :meth:`soa.directory.directory.ServiceDirectory.changes_since`
+
+        :param since: The last generation known to the client
+        :type since: int
+        :param epoch: The epoch which `since` was read in
+        :type epoch: string
+        :rtype: soa.directory.directory.ChangeSet
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def prune_old_services(self):
+        """Delete all service entries that have timed out"""
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def publish(self, *, service, lifetime=None):
+        """Publish a service in the registry, see
+        :meth:`soa.directory.directory.ServiceDirectory.publish`
+
+        :param service: The service to update
+        :type service: soa.services.Service
+        :param lifetime: Requested lease lifetime in seconds
+        :type lifetime: int
+        :returns: The effective lease lifetime in seconds
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def unpublish(self, *, name):
+        """De-register a service in the registry, see
+        :meth:`soa.directory.directory.ServiceDirectory.unpublish`
+
+        :param name: The name of the service to delete
+        :type name: string
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def publish_many(self, *, services, lifetimes=None):
+        """Publish several services in the registry, see
+        :meth:`soa.directory.directory.ServiceDirectory.publish_many`
+
+        The default implementation publishes the services one by one.
+
+        :param services: The services to update
+        :type services: list(soa.services.Service)
+        :param lifetimes: Requested lease lifetime of each service
+        :type lifetimes: list(int)
+        :returns: For each service, whether it was already published, and
+            the effective lease lifetime
+        :rtype: list(tuple(bool, int))
+        """
+        results = []
+        for service, lifetime in zip(services, lifetimes or [None] * len(services)):
+            try:
+                yield from self.service(name=service.name)
+            except self.DoesNotExist:
+                existed = False
+            else:
+                existed = True
+            lifetime = yield from self.publish(service=service, lifetime=lifetime)
+            results.append((existed, lifetime))
+        return results
+
+    @asyncio.coroutine
+    def unpublish_many(self, *, names):
+        """De-register several services in the registry, see
+        :meth:`soa.directory.directory.ServiceDirectory.unpublish_many`
+
+        The default implementation removes the services one by one.
+
+        :param names: The names of the services to delete
+        :type names: list(string)
+        :returns: For each name, whether the service was published
+        :rtype: list(bool)
+        """
+        found = []
+        for name in names:
+            try:
+                yield from self.unpublish(name=name)
+            except self.DoesNotExist:
+                found.append(False)
+            else:
+                found.append(True)
+        return found
+
+    @asyncio.coroutine
+    def service(self, *, name):
+        """Get a named service from the registry
+
+        :param name: The name of the service to look up
+        :type name: string
+        :rtype: soa.services.Service
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def service_list(self, **search):
+        """Get a list of services matching the given criteria
+
+        :param search: Search criteria as key: value pairs
+        :type search: dict
+        :rtype: list(soa.services.Service)
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def last_modified(self, **search):
+        """Get the time of the most recent update of any service matching the
+        given criteria
+
+        :param search: Search criteria as key: value pairs
+        :type search: dict
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def types(self):
+        """Get a set of all the service types currently registered
+
+        :rtype: set
+        """
+        raise NotImplementedError
+
+class AsyncServiceDirectory(LogMixin, AsyncDirectory):
+    """Service directory facade for coroutines
+
+    The blocking methods of the wrapped directory are coroutines here, which
+    run the operation on an executor. Methods which only read state kept in
+    memory are passed through as they are.
+
+    Notify callbacks registered through the facade are always called on the
+    event loop. Change events caused by a modification made through the
+    facade are delivered after the modification has completed, while the
+    write lock is still held, so callbacks may read the wrapped
+    :attr:`directory` directly.
+
+    All front ends serving the same directory should share one facade, so
+    that their modifications are serialised with each other.
+    """
+
+    def __init__(self, directory, *, executor=None, max_workers=4, loop=None):
+        """Constructor
+
+        :param directory: The directory to wrap
+        :type directory: soa.directory.directory.ServiceDirectory
+        :param executor: Executor to run the directory operations on, default
+            is a thread pool owned by the facade
+        :type executor: concurrent.futures.Executor
+        :param max_workers: Number of threads of the default executor, which
+            is the maximum number of concurrent lookups
+        :type max_workers: int
+        :param loop: Event loop, default is the loop of the calling coroutine
+        :type loop: asyncio.AbstractEventLoop
+        """
+        super().__init__()
+        self.directory = directory
+        self.DoesNotExist = directory.DoesNotExist #pylint: disable=invalid-name
+        self._own_executor = executor is None
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._loop = loop
+        self._lock = ReadWriteLock(loop=loop)
+        self._local = threading.local()
+        self._callbacks = {}
+
+    @classmethod
+    def wrap(cls, directory, **kwargs):
+        """Get a facade for a directory
+
+        :param directory: A directory, or an implementation of
+            :class:`AsyncDirectory` which is returned as-is
+        :type directory: soa.directory.directory.ServiceDirectory or
+            AsyncDirectory
+        :param kwargs: Constructor arguments used when creating a new facade
+        :rtype: AsyncDirectory
+        """
+        if isinstance(directory, AsyncDirectory):
+            return directory
+        return cls(directory, **kwargs)
+
+    @property
+    def stats(self):
+        """Statistics of the wrapped directory"""
+        return self.directory.stats
+
+    def close(self):
+        """Shut down the default executor"""
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    def _run_job(self, events, func, *args, **kwargs):
+        """Run a directory operation on an executor thread, collecting the
+        change events it causes in `events`"""
+        self._local.events = events
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._local.events = None
+
+    @asyncio.coroutine
+    def _read(self, func, *args, **kwargs):
+        """Run a lookup on the executor, concurrently with other lookups"""
+        loop = self._loop or asyncio.get_event_loop()
+        with (yield from self._lock.reader()):
+            return (yield from loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)))
+
+    @asyncio.coroutine
+    def _write(self, func, *args, **kwargs):
+        """Run a modification on the executor, exclusively, and deliver the
+        resulting change events on the event loop"""
+        loop = self._loop or asyncio.get_event_loop()
+        with (yield from self._lock.writer()):
+            events = []
+            try:
+                return (yield from loop.run_in_executor(
+                    self._executor,
+                    functools.partial(self._run_job, events, func, *args, **kwargs)))
+            finally:
+                for callback, event in events:
+                    call_notify((callback, ), event, self.log, self.stats)
+
+    def add_notify_callback(self, callback):
+        """Register a callback to be executed on the event loop whenever the
+        service registry is updated
+
+        See :meth:`soa.directory.directory.ServiceDirectory.add_notify_callback`.
+
+        :param callback: The callback to register
+        :type callback: callable(ChangeEvent)
+        """
+        if callback in self._callbacks:
+            return
+
+        def deliver(event):
+            """Pass the event on, or hold it back until the modification
+            running on the executor has completed"""
+            events = getattr(self._local, 'events', None)
+            if events is None:
+                callback(event)
+            else:
+                events.append((callback, event))
+        self._callbacks[callback] = deliver
+        self.directory.add_notify_callback(deliver)
+
+    def del_notify_callback(self, callback):
+        """Unregister a callback
+
+        :param callback: The callback to unregister
+        :type callback: callable(ChangeEvent)
+        """
+        deliver = self._callbacks.pop(callback, None)
+        if deliver is not None:
+            self.directory.del_notify_callback(deliver)
+
+    def epoch(self):
+        """Get the identifier of this instance of the registry, see
+        :meth:`soa.directory.directory.ServiceDirectory.epoch`
+
+        :rtype: string
+        """
+        return self.directory.epoch()
+
+    def next_deadline(self):
+        """Get the time when the first service in the registry will time out,
+        see :meth:`soa.directory.directory.ServiceDirectory.next_deadline`
+
+        :rtype: int
+        """
+        return self.directory.next_deadline()
+
+    @asyncio.coroutine
+    def generation(self):
+        """Get the current generation of the registry, see
+        :meth:`soa.directory.directory.ServiceDirectory.generation`
+
+        Services which have timed out are pruned on the executor first.
+
+        :rtype: int
+        """
+        deadline = self.directory.next_deadline()
+        if deadline is not None and deadline < unix_now():
+            yield from self.prune_old_services()
+        return self.directory.generation(prune=False)
+
+    @asyncio.coroutine
+    def changes_since(self, since, epoch=None):
+        """Get the changes to the registry after a given generation, see
+        :meth:`soa.directory.directory.ServiceDirectory.changes_since`
+
+        :rtype: soa.directory.directory.ChangeSet
+        """
+        yield from self.generation()
+        return (yield from self._read(
+            self.directory.changes_since, since, epoch=epoch, prune=False))
+
+    @asyncio.coroutine
+    def prune_old_services(self):
+        """Delete all service entries that have timed out"""
+        yield from self._write(self.directory.prune_old_services)
+
+    @asyncio.coroutine
+    def publish(self, *, service, lifetime=None):
+        """Publish a service in the registry, see
+        :meth:`soa.directory.directory.ServiceDirectory.publish`
+
+        :param service: The service to update
+        :type service: soa.services.Service
+        :param lifetime: Requested lease lifetime in seconds
+        :type lifetime: int
+        :returns: The effective lease lifetime in seconds
+        :rtype: int
+        """
+        # Only pass on a lifetime if one was requested, for backends
+        # without lease lifetimes
+        kwargs = {} if lifetime is None else {'lifetime': lifetime}
+        return (yield from self._write(self.directory.publish, service=service, **kwargs))
+
+    @asyncio.coroutine
+    def unpublish(self, *, name):
+        """De-register a service in the registry, see
+        :meth:`soa.directory.directory.ServiceDirectory.unpublish`
+
+        :param name: The name of the service to delete
+        :type name: string
+        """
+        yield from self._write(self.directory.unpublish, name=name)
+
+    @asyncio.coroutine
+    def publish_many(self, *, services, lifetimes=None):
+        """Publish several services in the registry in a single modification,
+        see :meth:`soa.directory.directory.ServiceDirectory.publish_many`
+
+        :param services: The services to update
+        :type services: list(soa.services.Service)
+        :param lifetimes: Requested lease lifetime of each service
+        :type lifetimes: list(int)
+        :returns: For each service, whether it was already published, and
+            the effective lease lifetime
+        :rtype: list(tuple(bool, int))
+        """
+        return (yield from self._write(
+            self.directory.publish_many, services=services, lifetimes=lifetimes))
+
+    @asyncio.coroutine
+    def unpublish_many(self, *, names):
+        """De-register several services in the registry in a single
+        modification, see
+        :meth:`soa.directory.directory.ServiceDirectory.unpublish_many`
+
+        :param names: The names of the services to delete
+        :type names: list(string)
+        :returns: For each name, whether the service was published
+        :rtype: list(bool)
+        """
+        return (yield from self._write(self.directory.unpublish_many, names=names))
+
+    @asyncio.coroutine
+    def service(self, *, name):
+        """Get a named service from the registry
+
+        :param name: The name of the service to look up
+        :type name: string
+        :rtype: soa.services.Service
+        """
+        return (yield from self._read(self.directory.service, name=name))
+
+    @asyncio.coroutine
+    def service_list(self, **search):
+        """Get a list of services matching the given criteria
+
+        :param search: Search criteria as key: value pairs
+        :type search: dict
+        :rtype: list(soa.services.Service)
+        """
+        return (yield from self._read(self.directory.service_list, **search))
+
+    @asyncio.coroutine
+    def last_modified(self, **search):
+        """Get the time of the most recent update of any service matching the
+        given criteria
+
+        :param search: Search criteria as key: value pairs
+        :type search: dict
+        :rtype: int
+        """
+        return (yield from self._read(self.directory.last_modified, **search))
+
+    @asyncio.coroutine
+    def types(self):
+        """Get a set of all the service types currently registered
+
+        :rtype: set
+        """
+        return (yield from self._read(self.directory.types))
@@ -0,0 +1,271 @@
+"""Caching of rendered resource representations
+
+The service directory front ends render the same few documents (the service
+list, the type list etc.) over and over again. The registry generation counter
+(see :meth:`soa.directory.directory.ServiceDirectory.generation`) tells when a
+rendered document has become stale, which allows the front ends to keep the
+encoded bytes around between requests and to answer conditional requests
+without rendering anything.
+
+When many clients ask for the same stale document at once, e.g. after a network
+outage, :class:`SingleFlight` makes sure that it is rendered only once, and
+that all of them get the result of that one rendering.
+"""
+import asyncio
+import binascii
+import collections
+import gzip
+import hashlib
+import io
+import zlib
+
+__all__ = [
+    'LRUCache',
+    'Representation',
+    'RepresentationCache',
+    'SingleFlight',
+    ]
+
+def gzip_compress(data):
+    """Compress data with gzip, reproducibly
+
+    Unlike :func:`gzip.compress`, the header carries no modification time, so
+    the same body always gives the same bytes, in every process, as its strong
+    entity tag promises.
+
+    :param data: Data to compress
+    :type data: bytes
+    :rtype: bytes
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return buf.getvalue()
+
+CONTENT_CODINGS = {
+    'gzip': gzip_compress,
+    'deflate': zlib.compress,
+}
+"""Supported HTTP content-codings (:rfc:`7231#section-3.1.2.1`) and the
+functions used to apply them"""
+
+def body_digest(body):
+    """Compute a short digest of an encoded body
+
+    The digest is the first 8 bytes of the SHA-1 sum of the body, which is the
+    same scheme as :func:`aiocoap.resource.hashing_etag` uses, and fits in a
+    CoAP ETag option.
+
+    :param body: Encoded body
+    :type body: bytes
+    :returns: Digest of the body
+    :rtype: bytes
+    """
+    return hashlib.sha1(body).digest()[:8]
+
+
+class Representation(object): # pylint: disable=too-few-public-methods
+    """An encoded representation of a resource
+
+    The ETag is derived from the body, so two representations with the same
+    body will always have the same ETag, regardless of which generation of the
+    registry they were rendered from.
+    """
+
+    def __init__(self, body, content_type, last_modified=None):
+        """Constructor
+
+        :param body: Encoded body
+        :type body: bytes
+        :param content_type: Content type of the body
+        :type content_type: string or int
+        :param last_modified: Unix timestamp of the last modification of the
+            resource, if known
+        :type last_modified: int
+        """
+        self.body = body
+        self.content_type = content_type
+        self.last_modified = last_modified
+        self.digest = body_digest(body)
+        self._coded = {}
+
+    @property
+    def etag(self):
+        """Strong HTTP entity tag for this representation, including quotes"""
+        return '"{}"'.format(binascii.hexlify(self.digest).decode('ascii'))
+
+    def coded(self, coding):
+        """Get the body with a content-coding applied
+
+        The coded body is computed once and then kept together with the
+        uncoded body, so every client of the same generation gets the same
+        bytes without compressing them again.
+
+        :param coding: Name of the content-coding, a key in
+            :data:`CONTENT_CODINGS`
+        :type coding: string
+        :returns: The coded body and its strong entity tag, which differs from
+            the entity tag of the uncoded body
+        :rtype: tuple(bytes, string)
+        """
+        try:
+            return self._coded[coding]
+        except KeyError:
+            pass
+        body = CONTENT_CODINGS[coding](self.body)
+        etag = '"{}-{}"'.format(binascii.hexlify(self.digest).decode('ascii'), coding)
+        self._coded[coding] = (body, etag)
+        return self._coded[coding]
+
+
+class LRUCache(object):
+    """A dict-like mapping which holds at most `maxsize` items
+
+    The least recently used item is dropped when a new item is inserted into a
+    full cache.
+    """
+
+    def __init__(self, maxsize=128):
+        """Constructor
+
+        :param maxsize: Maximum number of items to keep
+        :type maxsize: int
+        """
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Look up a key, and mark it as recently used if found
+
+        :param key: The key to look up
+        :param default: Value to return if the key is not found
+        :returns: The stored value, or `default`
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        """Insert or replace an item, evicting the least recently used item if
+        the cache is full
+
+        :param key: The key to store
+        :param value: The value to store
+        """
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove an item
+
+        :param key: The key to remove
+        :param default: Value to return if the key is not found
+        :returns: The removed value, or `default`
+        """
+        return self._data.pop(key, default)
+
+    def clear(self):
+        """Remove all items"""
+        self._data.clear()
+
+
+class RepresentationCache(LRUCache):
+    """Cache of :class:`Representation` objects tagged with the registry
+    generation they were rendered from"""
+
+    def get(self, key, generation): # pylint: disable=arguments-differ
+        """Look up a cached representation
+
+        :param key: Cache key, typically the resource path and content type
+        :type key: tuple
+        :param generation: Current registry generation
+        :type generation: int
+        :returns: The cached representation, or None if there is no
+            representation of the given generation in the cache
+        :rtype: Representation
+        """
+        entry = super().get(key)
+        if entry is None or entry[0] != generation:
+            return None
+        return entry[1]
+
+    def put(self, key, generation, representation): # pylint: disable=arguments-differ
+        """Store a rendered representation
+
+        :param key: Cache key, typically the resource path and content type
+        :type key: tuple
+        :param generation: Registry generation the representation was rendered
+            from
+        :type generation: int
+        :param representation: The representation to store
+        :type representation: Representation
+        """
+        super().put(key, (generation, representation))
+
+
+class SingleFlight(object):
+    """Collapse concurrent computations of the same key into one
+
+    The first caller for a key starts the computation in a task of its own,
+    later callers for the same key wait for that task instead of starting
+    another one. The key is forgotten as soon as the computation is done, so
+    results are not cached; combine with :class:`RepresentationCache` for that.
+    """
+
+    def __init__(self, *, loop=None):
+        """Constructor
+
+        :param loop: Event loop to run the computations on, default is the
+            loop of the first caller
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self.stats = collections.Counter()
+        self._loop = loop
+        self._flights = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    @asyncio.coroutine
+    def run(self, key, func):
+        """Get the result of a computation, joining the computation already in
+        flight for the same key
+
+        Cancelling a caller does not cancel the computation, as other callers
+        may be waiting for it. Exceptions are raised in all callers.
+
+        :param key: Key identifying the computation, typically a cache key and
+            the registry generation
+        :type key: tuple
+        :param func: Coroutine function performing the computation
+        :type func: callable
+        :returns: The return value of `func`
+        """
+        future = self._flights.get(key)
+        if future is None:
+            self.stats['runs'] += 1
+            future = asyncio.ensure_future(func(), loop=self._loop)
+            self._flights[key] = future
+            future.add_done_callback(lambda done: self._landed(key, done))
+        else:
+            self.stats['shared'] += 1
+        return (yield from asyncio.shield(future, loop=self._loop))
+
+    def _landed(self, key, future):
+        """Forget a finished computation"""
+        if self._flights.get(key) is future:
+            del self._flights[key]
+        if not future.cancelled():
+            # Exceptions are for the callers, and not logged as never retrieved
+            future.exception()
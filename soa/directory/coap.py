@@ -1,107 +1,72 @@
 """CoAP implementation of the Arrowhead Service Directory based around aiocoap"""
 
-import re
+import json
+import socket
 import asyncio
+import collections
 
 import aiocoap.resource as resource
 from aiocoap.numbers import media_types_rev
+from aiocoap.numbers.constants import COAP_PORT, DEFAULT_BLOCK_SIZE_EXP
 from aiocoap.numbers.codes import Code
 import aiocoap
 
-from .. import LogMixin
-
 from .. import services
-
-__all__ = ['ServiceDirectoryCoAP']
-
-URI_PATH_SEPARATOR = '/'
-
-class RequestDispatcher(object):
-    """Helper functions for dispatching requests based on their Accept or
-    Content-format header options"""
-
-    default_content_type = None
-
-    @staticmethod
-    def dispatch_input(request, handlers, *args, **kwargs):
-        """Dispatch handling of the request payload to a handler based on the
-        given Content-format option"""
-        try:
-            input_handler = handlers[request.opt.content_format]
-        except KeyError:
-            raise UnsupportedMediaTypeError()
-        else:
-            return input_handler(*args, **kwargs)
-
-    def dispatch_output(self, request, handlers, *args, **kwargs):
-        """Dispatch handling of the request payload to a handler based on the
-        given Accept option"""
-        accept = request.opt.accept
-        if accept is None:
-            accept = self.default_content_type
-        try:
-            output_handler = handlers[accept]
-        except KeyError:
-            raise NotAcceptableError()
-        else:
-            return output_handler(*args, **kwargs)
-
-class NotAcceptableError(aiocoap.error.RenderableError):
-    """Not acceptable, there is no handler registered for the given Accept type"""
-    code = Code.NOT_ACCEPTABLE
-    message = "NotAcceptable"
-
-class UnsupportedMediaTypeError(aiocoap.error.RenderableError):
-    """Unsupported media type, there is no handler registered for the given Content-format"""
-    code = Code.UNSUPPORTED_MEDIA_TYPE
-    message = "UnsupportedMediaType"
-
-class NotFoundError(aiocoap.error.RenderableError):
-    """Not found"""
-    code = Code.NOT_FOUND
-    message = "NotFound"
-
-class BadRequestError(aiocoap.error.RenderableError):
-    """Generic bad request message"""
-    code = Code.BAD_REQUEST
-    message = "BadRequest"
-
-class PathRegex(str):
-    """Regular expression match in resource path components"""
-
-class Site(LogMixin, resource.Site):
-    """CoAP Site resource with path regex matching"""
-
-    @asyncio.coroutine
-    def render(self, request):
-        path = tuple(request.opt.uri_path)
-        # Only compare against resources with the same number of path components
-        matches = [(key, res) for key, res in self._resources.items() if len(key) == len(path)]
-        # Filter routes matching the path, one level at a time
-        for level in range(len(path)):
-            # Try to find exact string matches
-            string_matches = [
-                (key, res) for key, res in matches \
-                if not isinstance(key[level], PathRegex) and \
-                key[level] == path[level]
-                ]
-            if string_matches:
-                # string matches have a higher priority than regex matches
-                matches = string_matches
-                continue
-            # Try to find any regex matches
-            matches = [
-                (key, res) for key, res in matches \
-                if isinstance(key[level], PathRegex) and \
-                re.fullmatch(key[level], path[level])
-                ]
-        if len(matches) == 0:
-            raise aiocoap.error.NoResource()
-        elif len(matches) > 1:
-            raise aiocoap.error.RenderableError(
-                "Ambiguous matches: {} = {}".format(repr(path), repr(matches)))
-        child = matches[0][1]
-        return child.render(request)
+from .directory import unix_now, NotifyCoalescer
+from .asyncdir import AsyncServiceDirectory, publish_batch, unpublish_batch
+from .cache import LRUCache, Representation, RepresentationCache, SingleFlight
+from .coapsite import (
+    BadOptionError, BadRequestError, ForbiddenError, NotAcceptableError, NotFoundError,
+    UnsupportedMediaTypeError, PathRegex, RequestDispatcher, Resource, Site,
+    WellKnownCoreResource, parse_lifetime, parse_query, query_to_search, search_key, set_max_age)
+from .ratelimit import RateLimiter
+from .rd import ResourceDirectory
+from .multicast import ALL_COAP_NODES, DEFAULT_LEISURE, create_multicast_responders
+
+__all__ = ['ServiceDirectoryCoAP', 'create_server_context']
+
+@asyncio.coroutine
+def create_server_context(site, bind=('::', COAP_PORT), *, reuse_port=False,
+                          loggername='coap-server'):
+    """Create a server context like
+    :meth:`aiocoap.Context.create_server_context` does, optionally sharing
+    the port with other processes
+
+    The socket is bound with ``SO_REUSEADDR``, so that the multicast
+    responders (:func:`soa.directory.multicast.multicast_socket`) can bind
+    the group addresses on the same port.
+
+    With `reuse_port`, the socket is also bound with ``SO_REUSEPORT``, and the
+    kernel distributes the datagrams among all processes bound to the port.
+    Datagrams from the same client address always go to the same process, so
+    blockwise transfers and observations stay within one process.
+
+    :param site: The site serving the requests
+    :type site: aiocoap.resource.Site
+    :param bind: IPv6 address and port to bind to
+    :type bind: tuple(string, int)
+    :param reuse_port: Bind with ``SO_REUSEPORT``
+    :type reuse_port: bool
+    :param loggername: Name of the logger of the context
+    :type loggername: string
+    :rtype: aiocoap.Context
+    """
+    loop = asyncio.get_event_loop()
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(bind)
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    _, protocol = yield from loop.create_datagram_endpoint(
+        lambda: aiocoap.Context(loop, site, loggername=loggername), sock=sock)
+    yield from protocol.ready
+    return protocol
 
 class ServiceDirectoryCoAP(RequestDispatcher, Site):
     """Service Directory resource handler class"""
@@ -110,43 +75,98 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
 
     default_content_type = media_types_rev['application/json']
 
-    class Resource(resource.Resource):
-        """Generic resource class"""
-        def __init__(self, *args, get=None, put=None, post=None, delete=None, **kwargs):
-            """Constructor
-
-            :param get: callback for GET requests
-            :type get: asyncio.coroutine or None
-            :param put: callback for PUT requests
-            :type put: asyncio.coroutine or None
-            :param post: callback for POST requests
-            :type post: asyncio.coroutine or None
-            :param delete: callback for DELETE requests
-            :type delete: asyncio.coroutine or None
-            """
-            super().__init__(*args, **kwargs)
-            if get is not None:
-                self.render_get = get
-            if put is not None:
-                self.render_put = put
-            if post is not None:
-                self.render_post = post
-            if delete is not None:
-                self.render_delete = delete
+    Resource = Resource
 
     class ObservableResource(Resource, resource.ObservableResource):
-        """Generic observable resource class"""
+        """Generic observable resource class
 
-    def __init__(self, directory, uri_prefix, *args, **kwargs):
+        Observations are tracked per requested path, so that a resource
+        serving many paths (through :class:`PathRegex` matching) can notify
+        only the observers of the paths which were affected by a change.
+        """
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._path_observations = collections.defaultdict(set)
+
+        @asyncio.coroutine
+        def add_observation(self, request, serverobservation):
+            path = tuple(request.opt.uri_path)
+            observations = self._path_observations[path]
+            observations.add(serverobservation)
+
+            def cancel():
+                """Forget the observation when the observer goes away"""
+                observations.discard(serverobservation)
+                if not observations and self._path_observations.get(path) is observations:
+                    del self._path_observations[path]
+            serverobservation.accept(cancel)
+
+        def observed_paths(self):
+            """Get the paths which currently have observers
+
+            :returns: Observed paths
+            :rtype: list(tuple)
+            """
+            return list(self._path_observations.keys())
+
+        def is_observed_by(self, serverobservation):
+            """Check if an observation is still active
+
+            :param serverobservation: The observation to check
+            :type serverobservation: aiocoap.protocol.ServerObservation
+            :rtype: bool
+            """
+            path = tuple(serverobservation.original_request.opt.uri_path)
+            return serverobservation in self._path_observations.get(path, ())
+
+        def updated_state(self, response=None, path=None, changed=None): #pylint: disable=arguments-differ
+            """Send notifications to observers
+
+            :param response: Response to send instead of rendering the
+                original requests again
+            :type response: aiocoap.Message
+            :param path: Only notify the observers of this path, default is to
+                notify all observers
+            :type path: tuple
+            :param changed: Predicate telling whether an observation needs to
+                be notified, default is to notify all observations
+            :type changed: callable(aiocoap.protocol.ServerObservation)
+            """
+            if path is None:
+                observations = [obs for observations in self._path_observations.values()
+                                for obs in observations]
+            else:
+                observations = list(self._path_observations.get(tuple(path), ()))
+            for obs in observations:
+                if changed is None or changed(obs):
+                    obs.trigger(response)
+
+    def __init__(self, directory, uri_prefix, *args,
+                 notify_interval=None, notify_max_delay=None, rate_limiter=None, **kwargs):
         """Constructor
 
-        :param directory: Service directory backend
-        :type directory: soa.directory.directory.ServiceDirectory
+        :param directory: Service directory backend, it is wrapped in a
+            :class:`soa.directory.asyncdir.AsyncServiceDirectory` unless it
+            implements :class:`soa.directory.asyncdir.AsyncDirectory`
+        :type directory: soa.directory.directory.ServiceDirectory or
+            soa.directory.asyncdir.AsyncDirectory
         :param uri_prefix: URI prefix for this site
         :type uri_prefix: tuple(strings...)
+        :param notify_interval: Minimum time between observe notifications in
+            seconds, changes in between are merged. Notifications are sent
+            immediately if not given.
+        :type notify_interval: float
+        :param notify_max_delay: Maximum time to hold back a notification in
+            seconds, see :class:`soa.directory.directory.NotifyCoalescer`
+        :type notify_max_delay: float
+        :param rate_limiter: Limits the rate of publish and unpublish requests
+            per client, requests over the limit are answered with 5.03
+            Service Unavailable
+        :type rate_limiter: soa.directory.ratelimit.RateLimiter
         """
         super().__init__(*args, **kwargs)
         self.uri_prefix = uri_prefix
+        self.rate_limiter = rate_limiter
 
         self.slist_handlers = {
             media_types_rev['application/json']: services.servicelist_to_json,
@@ -161,8 +181,22 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
         }
         self._create_resources()
         self.log.debug('Resources: %r', self._resources)
-        self._directory = directory
-        self._directory.add_notify_callback(self.notify)
+        self._cache = RepresentationCache()
+        self._flights = SingleFlight()
+        self._snapshots = LRUCache(maxsize=16)
+        self._delta_observers = LRUCache(maxsize=1024)
+        self._transfers = LRUCache(maxsize=256)
+        self._filter_digests = LRUCache(maxsize=1024)
+        self._notify_tasks = set()
+        self._directory = AsyncServiceDirectory.wrap(directory)
+        if notify_interval:
+            self.coalescer = NotifyCoalescer(
+                self.notify_events, min_interval=notify_interval,
+                max_delay=notify_max_delay)
+            self._directory.add_notify_callback(self.coalescer)
+        else:
+            self.coalescer = None
+            self._directory.add_notify_callback(self.notify)
         self.notify()
 
     def _create_resources(self):
@@ -179,20 +213,155 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
             self.uri_prefix + ('type', ), self._typelist_resource)
         self.add_resource(
             self.uri_prefix + ('type', PathRegex('.*')), self._type_resource)
+        self.add_resource(
+            self.uri_prefix + ('changes', ), self.Resource(get=self._render_changes))
         self.add_resource(
             self.uri_prefix + ('publish', ),
             self.Resource(post=self._render_publish))
         self.add_resource(
             self.uri_prefix + ('unpublish', ),
             self.Resource(post=self._render_unpublish))
+        self.add_resource(
+            self.uri_prefix + ('bulk', 'publish'),
+            self.Resource(post=self._render_bulk_publish))
+        self.add_resource(
+            self.uri_prefix + ('bulk', 'unpublish'),
+            self.Resource(post=self._render_bulk_unpublish))
+
+    def notify(self, event=None):
+        """Send notifications to the subscribers affected by a change
 
-    def notify(self):
-        """Send notifications to all registered subscribers"""
-        self.log.debug('Notifying subscribers')
-        self._servicelist_resource.updated_state()
-        self._service_resource.updated_state()
+        The list resources are always updated, while only the observers of
+        the changed service and of its type are notified.
+
+        :param event: Description of the change, notify all subscribers if
+            None
+        :type event: soa.directory.directory.ChangeEvent
+        """
+        if event is None:
+            self.log.debug('Notifying all subscribers')
+            self._servicelist_resource.updated_state()
+            self._typelist_resource.updated_state()
+            self._service_resource.updated_state()
+            self._type_resource.updated_state()
+            return
+        self.notify_events([event])
+
+    def notify_events(self, events):
+        """Send one notification to each subscriber affected by any of the
+        given changes
+
+        :param events: Descriptions of the changes
+        :type events: list(soa.directory.directory.ChangeEvent)
+        """
+        self.log.debug('Notifying subscribers: %r', events)
+        self._servicelist_resource.updated_state(
+            changed=lambda obs: self._should_notify(self._servicelist_resource, obs))
         self._typelist_resource.updated_state()
-        self._type_resource.updated_state()
+        names = {event.name for event in events}
+        types = set().union(*(event.types for event in events))
+        for name in names:
+            self._service_resource.updated_state(path=self.uri_prefix + ('service', name))
+        for tname in types:
+            self._type_resource.updated_state(
+                path=self.uri_prefix + ('type', tname),
+                changed=lambda obs: self._should_notify(self._type_resource, obs))
+
+    def _request_search(self, request):
+        """Get the directory search criteria of a service list request
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :returns: Search criteria and the cache key identifying them
+        :rtype: tuple(dict, tuple)
+        """
+        query = parse_query(request)
+        search = query_to_search(query)
+        key = search_key(query)
+        if tuple(request.opt.uri_path[:-1]) == self.uri_prefix + ('type', ):
+            search['type'] = request.opt.uri_path[-1]
+            key = (('type', search['type']), ) + key
+        return search, key
+
+    @asyncio.coroutine
+    def _filter_digest(self, search, key):
+        """Compute the digest of the list of services matching a filter
+
+        :param search: Search criteria
+        :type search: dict
+        :param key: Cache key identifying the search criteria
+        :type key: tuple
+        :returns: Digest of the JSON service list
+        :rtype: bytes
+        """
+        @asyncio.coroutine
+        def render():
+            """Encode the matching services"""
+            slist = yield from self._directory.service_list(**search)
+            return services.servicelist_to_json(slist).encode('utf-8')
+        representation = yield from self._representation(
+            ('filter', ) + key, media_types_rev['application/json'], render)
+        return representation.digest
+
+    def _should_notify(self, resource, observation):
+        """Tell whether an observation of a resource affected by a change
+        needs to be notified right away
+
+        Unfiltered observations are always notified. Filtered observations
+        are notified later, from a task checking whether the filter result
+        has changed since the last notification, as the check needs to look
+        up the registry.
+
+        :param resource: The observed resource
+        :type resource: ObservableResource
+        :param observation: The observation to check
+        :type observation: aiocoap.protocol.ServerObservation
+        :rtype: bool
+        """
+        request = observation.original_request
+        search, key = self._request_search(request)
+        if not key or (('type', search.get('type')), ) == key:
+            return True
+        task = asyncio.ensure_future(
+            self._notify_if_changed(resource, observation, search, key))
+        self._notify_tasks.add(task)
+        task.add_done_callback(self._notify_tasks.discard)
+        return False
+
+    @asyncio.coroutine
+    def _notify_if_changed(self, resource, observation, search, key):
+        """Notify a filtered observation if the filter result has changed
+
+        :param resource: The observed resource
+        :type resource: ObservableResource
+        :param observation: The observation to notify
+        :type observation: aiocoap.protocol.ServerObservation
+        :param search: Search criteria of the observation
+        :type search: dict
+        :param key: Cache key identifying the search criteria
+        :type key: tuple
+        """
+        request = observation.original_request
+        digest = yield from self._filter_digest(search, key)
+        if not resource.is_observed_by(observation):
+            return
+        if self._filter_digests.get((request.remote, request.token)) != digest:
+            observation.trigger()
+
+    @asyncio.coroutine
+    def _remember_filter_result(self, request, search, key):
+        """Remember the filter result sent to an observer
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :param search: Search criteria of the request
+        :type search: dict
+        :param key: Cache key identifying the search criteria
+        :type key: tuple
+        """
+        if request.opt.observe is not None and key:
+            digest = yield from self._filter_digest(search, key)
+            self._filter_digests.put((request.remote, request.token), digest)
 
     def _slist_to_corelf(self, slist):
         """Convert a service list to CoRE Link-format links to other resources"""
@@ -204,6 +373,138 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
         uri_base = '/' + '/'.join(self.uri_prefix) + self.type_url
         return services.typelist_to_corelf(tlist, uri_base)
 
+    def _max_age(self):
+        """Compute the Max-Age of representations of the registry contents
+
+        A representation is fresh until the first service in the registry times
+        out, as the service will then disappear from the lists.
+
+        :returns: Max-Age in seconds, or None if no services are registered
+        :rtype: int
+        """
+        deadline = self._directory.next_deadline()
+        if deadline is None:
+            return None
+        return max(deadline - unix_now(), 0)
+
+    @asyncio.coroutine
+    def _render_cached(self, request, key, render):
+        """Respond with a cached representation of the registry contents
+
+        The encoded payload is cached until the registry generation changes.
+        The response carries an ETag option derived from the payload, and
+        requests carrying a matching ETag are answered with 2.03 Valid and no
+        payload.
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :param key: Cache key identifying the resource
+        :type key: tuple
+        :param render: Coroutine function producing the encoded payload for
+            the request
+        :type render: callable
+        :return: A CoAP response
+        :rtype: aiocoap.Message
+        """
+        content_format = request.opt.accept
+        if content_format is None:
+            content_format = self.default_content_type
+        representation = self._block_transfer(request)
+        if representation is None:
+            representation = yield from self._representation(key, content_format, render)
+        return self._respond(request, representation)
+
+    @asyncio.coroutine
+    def _representation(self, key, content_format, render):
+        """Get the representation of the registry contents from the cache,
+        rendering it if the cached copy is stale
+
+        Concurrent requests for the same stale representation wait for a
+        single rendering, see :class:`soa.directory.cache.SingleFlight`.
+
+        :param key: Cache key identifying the resource
+        :type key: tuple
+        :param content_format: Content format of the representation
+        :type content_format: int
+        :param render: Coroutine function producing the encoded payload
+        :type render: callable
+        :rtype: soa.directory.cache.Representation
+        """
+        key = key + (content_format, )
+        generation = yield from self._directory.generation()
+
+        @asyncio.coroutine
+        def render_cached():
+            """Render and cache the representation"""
+            representation = Representation((yield from render()), content_format)
+            self._cache.put(key, generation, representation)
+            return representation
+
+        representation = self._cache.get(key, generation)
+        if representation is None:
+            representation = yield from self._flights.run(key + (generation, ), render_cached)
+        return representation
+
+    @staticmethod
+    def _transfer_key(request):
+        """Identify the blockwise transfers of a resource to a client"""
+        return (request.remote, tuple(request.opt.uri_path), tuple(request.opt.uri_query))
+
+    def _block_transfer(self, request):
+        """Look up the body of an ongoing blockwise transfer
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :returns: The representation that the first block of the transfer was
+            taken from, or None if the request does not continue a transfer
+        :rtype: soa.directory.cache.Representation
+        """
+        block2 = request.opt.block2
+        if block2 is None or block2.block_number == 0:
+            return None
+        return self._transfers.get(self._transfer_key(request))
+
+    def _respond(self, request, representation):
+        """Create the response carrying a representation
+
+        Large bodies are sent blockwise (:rfc:`7959`). The representation which
+        the first block is taken from is remembered for the client, so all
+        blocks of a transfer are cut from the same encoded body even if the
+        registry is modified in between, or if the transfer continues a
+        blockwise observe notification.
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :param representation: The representation to send
+        :type representation: soa.directory.cache.Representation
+        :return: A CoAP response
+        :rtype: aiocoap.Message
+        """
+        block2 = request.opt.block2
+        size_exp = DEFAULT_BLOCK_SIZE_EXP
+        if block2 is not None:
+            size_exp = min(block2.size_exponent, size_exp)
+        size = 2 ** (size_exp + 4)
+        if len(representation.body) > size and (block2 is None or block2.block_number == 0):
+            self._transfers.put(self._transfer_key(request), representation)
+        if representation.digest in request.opt.etags:
+            msg = aiocoap.Message(code=Code.VALID)
+        elif block2 is None:
+            msg = aiocoap.Message(code=Code.CONTENT, payload=representation.body)
+        else:
+            start = block2.block_number * size
+            if start > 0 and start >= len(representation.body):
+                raise BadOptionError()
+            msg = aiocoap.Message(
+                code=Code.CONTENT, payload=representation.body[start:start + size])
+            msg.opt.block2 = (
+                block2.block_number, start + size < len(representation.body), size_exp)
+        if msg.code == Code.CONTENT:
+            msg.opt.content_format = representation.content_type
+        msg.opt.etag = representation.digest
+        set_max_age(msg, self._max_age())
+        return msg
+
     @asyncio.coroutine
     def _render_service(self, request):
         """GET handler, respond with a single service
@@ -212,20 +513,24 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
         :type request: aiocoap.Message
         """
         name = request.opt.uri_path[-1]
-        try:
-            service = self._directory.service(name=name)
-        except self._directory.DoesNotExist:
-            # Could not find a service by that name, send response code
-            raise NotFoundError()
-        try:
-            payload = service.to_bytes(request.opt.accept)
-        except services.UnknownContentError as exc:
-            raise UnsupportedMediaTypeError(str(exc))
-        msg = aiocoap.Message(code=Code.CONTENT, payload=payload)
-        msg.opt.content_format = request.opt.accept
-        if msg.opt.content_format is None:
-            msg.opt.content_format = self.default_content_type
-        return msg
+
+        @asyncio.coroutine
+        def render():
+            """Encode the service in the requested format"""
+            try:
+                service = yield from self._directory.service(name=name)
+            except self._directory.DoesNotExist:
+                # Could not find a service by that name, send response code
+                raise NotFoundError()
+            content_format = request.opt.accept
+            if content_format is None:
+                content_format = self.default_content_type
+            try:
+                return service.to_bytes(content_format)
+            except services.UnknownContentError as exc:
+                raise UnsupportedMediaTypeError(str(exc))
+
+        return (yield from self._render_cached(request, ('service', name), render))
 
     @asyncio.coroutine
     def _render_servicelist(self, request):
@@ -234,13 +539,105 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
         :param request: The inbound CoAP request
         :type request: aiocoap.Message
         """
-        slist = self._directory.service_list()
-        payload = self.dispatch_output(request, self.slist_handlers, slist)
-        msg = aiocoap.Message(code=Code.CONTENT, payload=payload.encode('utf-8'))
-        msg.opt.content_format = request.opt.accept
-        if msg.opt.content_format is None:
-            msg.opt.content_format = self.default_content_type
-        return msg
+        query = parse_query(request)
+        search, key = self._request_search(request)
+        if 'delta' in query:
+            return (yield from self._render_servicelist_delta(request, query, search, key))
+        yield from self._remember_filter_result(request, search, key)
+
+        @asyncio.coroutine
+        def render():
+            """Encode the service list in the requested format"""
+            slist = yield from self._directory.service_list(**search)
+            payload = self.dispatch_output(request, self.slist_handlers, slist)
+            return payload.encode('utf-8')
+
+        return (yield from self._render_cached(request, ('service', ) + key, render))
+
+    @asyncio.coroutine
+    def _service_snapshot(self, generation, search=None, key=()):
+        """Get the JSON dicts of all services in the current generation
+
+        The snapshot is kept, so that the next delta can be computed against
+        it. Only the snapshots of the most recently rendered generations are
+        kept.
+
+        :param generation: The current registry generation
+        :type generation: int
+        :param search: Search criteria, default is all services
+        :type search: dict
+        :param key: Cache key identifying the search criteria
+        :type key: tuple
+        :returns: name => JSON dict mapping
+        :rtype: dict
+        """
+        snapshot = self._snapshots.get((generation, key))
+        if snapshot is None:
+            slist = yield from self._directory.service_list(**(search or {}))
+            snapshot = collections.OrderedDict((srv.name, srv.to_json_dict()) for srv in slist)
+            self._snapshots.put((generation, key), snapshot)
+        return snapshot
+
+    @asyncio.coroutine
+    def _render_servicelist_delta(self, request, query, search, key):
+        """GET handler, respond with the changes to the service list since a
+        previous generation
+
+        The client names the last generation it has seen with the ``since``
+        and ``epoch`` query parameters. For observations, following
+        notifications carry the changes since the previous notification. The
+        response is a JSON object with the current ``epoch`` and
+        ``generation``, and either ``since``, the list of added or updated
+        services in ``service`` and the names of removed services in
+        ``removed``, or, if the changes are not known, ``"full": true`` and
+        the complete service list in ``service``.
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :param query: Parsed Uri-Query options
+        :type query: dict
+        :param search: Search criteria from the filters in the query
+        :type search: dict
+        :param key: Cache key identifying the search criteria
+        :type key: tuple
+        """
+        if request.opt.accept not in (None, media_types_rev['application/json']):
+            raise NotAcceptableError()
+        representation = self._block_transfer(request)
+        if representation is not None:
+            return self._respond(request, representation)
+        epoch = self._directory.epoch()
+        generation = yield from self._directory.generation()
+        current = yield from self._service_snapshot(generation, search, key)
+        observation_key = (request.remote, request.token)
+        since = None
+        if request.opt.observe is not None:
+            since = self._delta_observers.get(observation_key)
+        if since is None and query.get('since') and query.get('epoch') == epoch:
+            try:
+                since = int(query['since'])
+            except ValueError:
+                raise BadRequestError()
+        previous = None if since is None else self._snapshots.get((since, key))
+        if previous is None:
+            delta = {
+                'epoch': epoch,
+                'generation': generation,
+                'full': True,
+                'service': list(current.values()),
+            }
+        else:
+            delta = {
+                'epoch': epoch,
+                'generation': generation,
+                'since': since,
+                'service': [srv for name, srv in current.items() if previous.get(name) != srv],
+                'removed': [name for name in previous if name not in current],
+            }
+        if request.opt.observe is not None:
+            self._delta_observers.put(observation_key, generation)
+        return self._respond(request, Representation(
+            json.dumps(delta).encode('utf-8'), media_types_rev['application/json']))
 
     @asyncio.coroutine
     def _render_typelist(self, request):
@@ -249,13 +646,14 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
         :param request: The inbound CoAP request
         :type request: aiocoap.Message
         """
-        tlist = self._directory.types()
-        payload = self.dispatch_output(request, self.tlist_handlers, tlist)
-        msg = aiocoap.Message(code=Code.CONTENT, payload=payload.encode('utf-8'))
-        msg.opt.content_format = request.opt.accept
-        if msg.opt.content_format is None:
-            msg.opt.content_format = media_types_rev['application/json']
-        return msg
+        @asyncio.coroutine
+        def render():
+            """Encode the type list in the requested format"""
+            tlist = yield from self._directory.types()
+            payload = self.dispatch_output(request, self.tlist_handlers, tlist)
+            return payload.encode('utf-8')
+
+        return (yield from self._render_cached(request, ('type', ), render))
 
     @asyncio.coroutine
     def _render_type(self, request):
@@ -264,13 +662,66 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
         :param request: The inbound CoAP request
         :type request: aiocoap.Message
         """
-        tname = request.opt.uri_path[-1]
-        slist = self._directory.service_list(type=tname)
-        payload = self.dispatch_output(request, self.slist_handlers, slist)
-        msg = aiocoap.Message(code=Code.CONTENT, payload=payload.encode('utf-8'))
-        msg.opt.content_format = request.opt.accept
-        if msg.opt.content_format is None:
-            msg.opt.content_format = self.default_content_type
+        search, key = self._request_search(request)
+        yield from self._remember_filter_result(request, search, key)
+
+        @asyncio.coroutine
+        def render():
+            """Encode the list of services of the given type in the requested format"""
+            slist = yield from self._directory.service_list(**search)
+            payload = self.dispatch_output(request, self.slist_handlers, slist)
+            return payload.encode('utf-8')
+
+        return (yield from self._render_cached(request, key, render))
+
+    @asyncio.coroutine
+    def _render_changes(self, request):
+        """GET handler, respond with the changes since the generation given in
+        the ``since`` query parameter, see
+        :meth:`soa.directory.directory.ServiceDirectory.changes_since`
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        """
+        if request.opt.accept not in (None, media_types_rev['application/json']):
+            raise NotAcceptableError()
+        query = parse_query(request)
+        try:
+            since = int(query['since']) if query.get('since') else None
+        except ValueError:
+            raise BadRequestError()
+        epoch = query.get('epoch')
+
+        @asyncio.coroutine
+        def render():
+            """Encode the change set"""
+            changes = yield from self._directory.changes_since(since, epoch=epoch)
+            return json.dumps(changes.to_json_dict()).encode('utf-8')
+
+        return (yield from self._render_cached(request, ('changes', since, epoch), render))
+
+    def _check_rate(self, request, slist):
+        """Charge a modification request to the rate limiter
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :param slist: Services to be modified
+        :type slist: list(soa.services.Service)
+        :returns: A 5.03 response telling the client when to retry in the
+            Max-Age option if it is over its limit, otherwise None
+        :rtype: aiocoap.Message
+        """
+        if self.rate_limiter is None:
+            return None
+        remote = request.remote
+        address = remote[0] if isinstance(remote, tuple) else remote
+        wait = self.rate_limiter.acquire(self.rate_limiter.keys(address, slist))
+        if not wait:
+            return None
+        self.log.info('Rate limit exceeded by %s', address)
+        msg = aiocoap.Message(code=Code.SERVICE_UNAVAILABLE, payload=b'Too many requests')
+        msg.opt.content_format = media_types_rev['text/plain']
+        set_max_age(msg, RateLimiter.retry_after(wait))
         return msg
 
     @asyncio.coroutine
@@ -278,7 +729,9 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
         """POST handler
 
         This method parses the received payload data as a service and updates the
-        directory with the new data.
+        directory with the new data. A lease lifetime in seconds may be
+        requested with the ``lt`` query parameter, the effective lifetime is
+        returned in the Max-Age option.
 
         :param request: The inbound CoAP request
         :type request: aiocoap.Message
@@ -286,6 +739,7 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
         :rtype: aiocoap.Message
         """
         self.log.debug('POST %r' % (request.opt.uri_path, ))
+        lifetime = parse_lifetime(parse_query(request))
         try:
             service = services.Service.from_message(request)
         except services.UnknownContentError as exc:
@@ -295,18 +749,25 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
         if not service.name:
             # bad input
             raise BadRequestError()
+        limited = self._check_rate(request, [service])
+        if limited is not None:
+            return limited
 
         try:
-            self._directory.service(name=service.name)
+            yield from self._directory.service(name=service.name)
         except self._directory.DoesNotExist:
             code = Code.CREATED
         else:
             code = Code.CHANGED
 
-        self._directory.publish(service=service)
+        try:
+            lifetime = yield from self._directory.publish(service=service, lifetime=lifetime)
+        except self._directory.QuotaExceeded as exc:
+            raise ForbiddenError(str(exc))
         payload = 'POST OK'
         msg = aiocoap.Message(code=code, payload=payload.encode('utf-8'))
         msg.opt.content_format = media_types_rev['text/plain']
+        set_max_age(msg, lifetime)
         return msg
 
     @asyncio.coroutine
@@ -328,27 +789,167 @@ class ServiceDirectoryCoAP(RequestDispatcher, Site):
         if not service.name:
             # bad input
             raise BadRequestError()
-        self._directory.unpublish(name=service.name)
+        limited = self._check_rate(request, [service])
+        if limited is not None:
+            return limited
+        yield from self._directory.unpublish(name=service.name)
         payload = 'POST OK'
         code = Code.DELETED
         msg = aiocoap.Message(code=code, payload=payload.encode('utf-8'))
         msg.opt.content_format = media_types_rev['text/plain']
         return msg
 
+    @staticmethod
+    def _parse_servicelist(request):
+        """Parse the service list payload of a bulk request
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :rtype: list(soa.services.Service)
+        """
+        try:
+            return services.servicelist_from_message(request)
+        except services.UnknownContentError as exc:
+            raise UnsupportedMediaTypeError(str(exc))
+        except services.ServiceError:
+            raise BadRequestError()
+
+    @staticmethod
+    def _batch_response(request, statuses):
+        """Create the response to a bulk request, in the content format of
+        the request
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :param statuses: Name and status of each service
+        :type statuses: list(tuple(string, string))
+        :rtype: aiocoap.Message
+        """
+        if request.opt.content_format == media_types_rev['application/xml']:
+            payload = services.statuslist_to_xml(statuses)
+        else:
+            payload = services.statuslist_to_json(statuses)
+        msg = aiocoap.Message(code=Code.CHANGED, payload=payload.encode('utf-8'))
+        msg.opt.content_format = request.opt.content_format
+        return msg
+
+    @asyncio.coroutine
+    def _render_bulk_publish(self, request):
+        """POST handler
+
+        This method parses the received payload data as a service list and
+        publishes all services as one batch, with the lease lifetime
+        requested in the ``lt`` query parameter. The response lists the
+        status and lifetime of each service, see
+        :func:`soa.directory.asyncdir.publish_batch`.
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :return: A CoAP response
+        :rtype: aiocoap.Message
+        """
+        lifetime = parse_lifetime(parse_query(request))
+        slist = self._parse_servicelist(request)
+        limited = self._check_rate(request, slist)
+        if limited is not None:
+            return limited
+        try:
+            statuses = yield from publish_batch(self._directory, slist, lifetime)
+        except self._directory.QuotaExceeded as exc:
+            raise ForbiddenError(str(exc))
+        return self._batch_response(request, statuses)
+
+    @asyncio.coroutine
+    def _render_bulk_unpublish(self, request):
+        """POST handler
+
+        This method parses the received payload data as a service list and
+        removes all named services as one batch. The response lists the
+        status of each service, see
+        :func:`soa.directory.asyncdir.unpublish_batch`.
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :return: A CoAP response
+        :rtype: aiocoap.Message
+        """
+        slist = self._parse_servicelist(request)
+        limited = self._check_rate(request, slist)
+        if limited is not None:
+            return limited
+        statuses = yield from unpublish_batch(self._directory, [srv.name for srv in slist])
+        return self._batch_response(request, statuses)
+
 class Server(object):
     """CoAP server implementation"""
 
-    def __init__(self, *, directory, **kwargs):
+    def __init__(self, *, directory, notify_interval=None, notify_max_delay=None,
+                 resource_directory=True, rate_limiter=None, reuse_port=False, **kwargs):
         """Constructor
 
-        :param directory: Service directory to use as backend
-        :type directory: soa.directory.ServiceDirectory
+        :param directory: Service directory to use as backend, see
+            :class:`ServiceDirectoryCoAP`
+        :type directory: soa.directory.ServiceDirectory or
+            soa.directory.asyncdir.AsyncDirectory
+        :param notify_interval: Minimum time between observe notifications in
+            seconds, see :class:`ServiceDirectoryCoAP`
+        :type notify_interval: float
+        :param notify_max_delay: Maximum time to hold back a notification in
+            seconds, see :class:`ServiceDirectoryCoAP`
+        :type notify_max_delay: float
+        :param resource_directory: Also provide the CoRE Resource Directory
+            interfaces, see :class:`soa.directory.rd.ResourceDirectory`
+        :type resource_directory: bool
+        :param rate_limiter: Limits the rate of publish and unpublish requests
+            per client, see :class:`ServiceDirectoryCoAP`
+        :type rate_limiter: soa.directory.ratelimit.RateLimiter
+        :param reuse_port: Share the port with other processes, see
+            :func:`create_server_context`
+        :type reuse_port: bool
         """
         super().__init__()
-        self._directory = directory
-        self.site = ServiceDirectoryCoAP(directory=directory, uri_prefix=('servicediscovery', ))
-        self.context = aiocoap.Context.create_server_context(self.site, **kwargs)
+        self._directory = AsyncServiceDirectory.wrap(directory)
+        self.site = ServiceDirectoryCoAP(
+            directory=self._directory, uri_prefix=('servicediscovery', ),
+            notify_interval=notify_interval, notify_max_delay=notify_max_delay,
+            rate_limiter=rate_limiter)
+        self.resource_directory = None
+        if resource_directory:
+            self.resource_directory = ResourceDirectory(self._directory)
+            self.resource_directory.add_resources(self.site)
+        self.context = create_server_context(self.site, reuse_port=reuse_port, **kwargs)
 
         self.site.add_resource(
             ('.well-known', 'core'),
-            resource.WKCResource(self.site.get_resources_as_linkheader))
+            WellKnownCoreResource(self.site))
+        self.multicast_transports = []
+
+    @asyncio.coroutine
+    def join_multicast(self, *, groups=ALL_COAP_NODES, port=COAP_PORT, interface=None,
+                       leisure=DEFAULT_LEISURE):
+        """Answer discovery requests sent to multicast groups
+
+        Multicast GET requests for /.well-known/core and for the services of
+        a type, including Uri-Query filters, are answered, see
+        :mod:`soa.directory.multicast`.
+
+        :param groups: Multicast groups to join, default is the All-CoAP-Nodes
+            groups
+        :type groups: iterable(string)
+        :param port: UDP port to listen on
+        :type port: int
+        :param interface: Name of the network interface to join the groups on
+        :type interface: string
+        :param leisure: Maximum random delay of the responses in seconds
+        :type leisure: float
+        :returns: The datagram transports, one per joined group
+        :rtype: list(asyncio.DatagramTransport)
+        """
+        paths = [
+            ('.well-known', 'core'),
+            self.site.uri_prefix + ('type', PathRegex('.*')),
+        ]
+        transports = yield from create_multicast_responders(
+            self.site, paths, groups=groups, port=port, interface=interface, leisure=leisure)
+        self.multicast_transports.extend(transports)
+        return transports
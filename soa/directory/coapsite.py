@@ -0,0 +1,460 @@
+"""Building blocks for CoAP sites: request routing, Uri-Query handling and
+response codes"""
+
+import re
+import asyncio
+import collections
+
+import link_header
+
+import aiocoap.resource as resource
+from aiocoap.numbers import media_types_rev
+from aiocoap.numbers.codes import Code
+from aiocoap.numbers.optionnumbers import OptionNumber
+import aiocoap
+
+from .. import LogMixin
+from .cache import LRUCache, Representation
+
+__all__ = [
+    'BadOptionError',
+    'BadRequestError',
+    'ForbiddenError',
+    'NotAcceptableError',
+    'NotFoundError',
+    'PathRegex',
+    'RequestDispatcher',
+    'Resource',
+    'RouteNode',
+    'Site',
+    'UnsupportedMediaTypeError',
+    'WellKnownCoreResource',
+    ]
+
+URI_PATH_SEPARATOR = '/'
+
+def set_max_age(message, max_age):
+    """Set the Max-Age option of a CoAP message
+
+    :param message: The message to modify
+    :type message: aiocoap.Message
+    :param max_age: Max-Age in seconds, or None to remove the option
+    :type max_age: int
+    """
+    message.opt.delete_option(OptionNumber.MAX_AGE)
+    if max_age is not None:
+        message.opt.add_option(OptionNumber.MAX_AGE.create_option(value=max_age))
+
+def parse_query(request):
+    """Split the Uri-Query options of a request into a dict
+
+    :param request: The inbound CoAP request
+    :type request: aiocoap.Message
+    :returns: Query parameters, parameters without a value map to None
+    :rtype: dict
+    """
+    query = {}
+    for item in request.opt.uri_query:
+        name, sep, value = item.partition('=')
+        query[name] = value if sep else None
+    return query
+
+def parse_lifetime(query):
+    """Validate the lease lifetime requested with the ``lt`` query parameter
+
+    :param query: Parsed Uri-Query options
+    :type query: dict
+    :returns: Lifetime in seconds, or None if not given
+    :rtype: int
+    """
+    if 'lt' not in query:
+        return None
+    try:
+        lifetime = int(query['lt'])
+    except (TypeError, ValueError):
+        raise BadRequestError()
+    if lifetime < 1:
+        raise BadRequestError()
+    return lifetime
+
+SERVICE_FILTER_ATTRIBUTES = ('name', 'type', 'host', 'port', 'domain')
+"""Service attributes which can be used as Uri-Query filters, any other
+filter is matched against the service properties"""
+
+QUERY_CONTROL_PARAMETERS = ('delta', 'since', 'epoch')
+"""Uri-Query parameters which are not filters"""
+
+def query_to_search(query):
+    """Translate the Uri-Query filters of a request to directory search
+    criteria
+
+    Each filter is given as ``attribute=value``, where attribute is one of
+    :data:`SERVICE_FILTER_ATTRIBUTES` or the name of a service property. A
+    value ending in ``*`` matches any value beginning with the given prefix,
+    as in :rfc:`6690#section-4.1`.
+
+    :param query: Parsed Uri-Query options, see :func:`parse_query`
+    :type query: dict
+    :returns: Search criteria for
+        :meth:`soa.directory.directory.ServiceDirectory.service_list`
+    :rtype: dict
+    """
+    search = {}
+    for name, value in query.items():
+        if name in QUERY_CONTROL_PARAMETERS:
+            continue
+        if value is None:
+            raise BadRequestError()
+        if name == 'port':
+            try:
+                search[name] = int(value)
+            except ValueError:
+                raise BadRequestError()
+            continue
+        if name not in SERVICE_FILTER_ATTRIBUTES:
+            name = 'properties.' + name
+        if value.endswith('*'):
+            search[name] = {'$regex': '^' + re.escape(value[:-1])}
+        else:
+            search[name] = value
+    return search
+
+def search_key(query):
+    """Create a cache key from the filters in a Uri-Query
+
+    :param query: Parsed Uri-Query options, see :func:`parse_query`
+    :type query: dict
+    :returns: Hashable, canonical representation of the filters
+    :rtype: tuple
+    """
+    return tuple(sorted((name, value) for name, value in query.items()
+                        if name not in QUERY_CONTROL_PARAMETERS))
+
+def attributes_match(attributes, filters):
+    """Check link attributes against query filters
+
+    This implements the query filtering of :rfc:`6690#section-4.1`, extended
+    to any number of filters. A filter matches if any value of the attribute, or any of the space
+    separated words of a value, is equal to the filter value. A filter value
+    ending in ``*`` matches by prefix.
+
+    :param attributes: Attribute name, value pairs
+    :type attributes: list
+    :param filters: Attribute name => filter value
+    :type filters: dict
+    :rtype: bool
+    """
+    for name, pattern in filters.items():
+        values = [value for attr, value in attributes if attr == name and value is not None]
+        candidates = set(values)
+        for value in values:
+            candidates.update(value.split())
+        if pattern.endswith('*'):
+            if not any(value.startswith(pattern[:-1]) for value in candidates):
+                return False
+        elif pattern not in candidates:
+            return False
+    return True
+
+class RequestDispatcher(object):
+    """Helper functions for dispatching requests based on their Accept or
+    Content-format header options"""
+
+    default_content_type = None
+
+    @staticmethod
+    def dispatch_input(request, handlers, *args, **kwargs):
+        """Dispatch handling of the request payload to a handler based on the
+        given Content-format option"""
+        try:
+            input_handler = handlers[request.opt.content_format]
+        except KeyError:
+            raise UnsupportedMediaTypeError()
+        else:
+            return input_handler(*args, **kwargs)
+
+    def dispatch_output(self, request, handlers, *args, **kwargs):
+        """Dispatch handling of the request payload to a handler based on the
+        given Accept option"""
+        accept = request.opt.accept
+        if accept is None:
+            accept = self.default_content_type
+        try:
+            output_handler = handlers[accept]
+        except KeyError:
+            raise NotAcceptableError()
+        else:
+            return output_handler(*args, **kwargs)
+
+class NotAcceptableError(aiocoap.error.RenderableError):
+    """Not acceptable, there is no handler registered for the given Accept type"""
+    code = Code.NOT_ACCEPTABLE
+    message = "NotAcceptable"
+
+class UnsupportedMediaTypeError(aiocoap.error.RenderableError):
+    """Unsupported media type, there is no handler registered for the given Content-format"""
+    code = Code.UNSUPPORTED_MEDIA_TYPE
+    message = "UnsupportedMediaType"
+
+class NotFoundError(aiocoap.error.RenderableError):
+    """Not found"""
+    code = Code.NOT_FOUND
+    message = "NotFound"
+
+class BadRequestError(aiocoap.error.RenderableError):
+    """Generic bad request message"""
+    code = Code.BAD_REQUEST
+    message = "BadRequest"
+
+class ForbiddenError(aiocoap.error.RenderableError):
+    """Forbidden, e.g. because a quota of the directory is exhausted"""
+    code = Code.FORBIDDEN
+    message = "Forbidden"
+
+    def __init__(self, message=None):
+        super().__init__(message)
+        if message is not None:
+            self.message = message
+
+class BadOptionError(aiocoap.error.RenderableError):
+    """Bad option, the request carries an option which can not be honoured"""
+    code = Code.BAD_OPTION
+    message = "BadOption"
+
+class PathRegex(str):
+    """Regular expression match in resource path components"""
+
+class RouteNode(object):
+    """Node in the routing tree of a :class:`Site`
+
+    Each node corresponds to a path prefix. Children matching a path component
+    exactly are kept in a dict, children matching a path component by a
+    regular expression (:class:`PathRegex`) are kept separately with their
+    compiled expressions, and are only considered when no exact match exists.
+    """
+    __slots__ = ('children', 'regex_children', 'resource')
+
+    def __init__(self):
+        self.children = {}
+        self.regex_children = collections.OrderedDict()
+        self.resource = None
+
+    def child(self, component):
+        """Get or create the child node for a path component
+
+        :param component: Path component, either a plain string or a
+            :class:`PathRegex`
+        :type component: string
+        :returns: The child node
+        :rtype: RouteNode
+        """
+        if isinstance(component, PathRegex):
+            try:
+                return self.regex_children[str(component)][1]
+            except KeyError:
+                node = RouteNode()
+                self.regex_children[str(component)] = (re.compile(component), node)
+                return node
+        return self.children.setdefault(component, RouteNode())
+
+    def insert(self, path, res):
+        """Add a resource at the given path below this node
+
+        :param path: Path components
+        :type path: tuple
+        :param res: The resource to add
+        """
+        node = self
+        for component in path:
+            node = node.child(component)
+        node.resource = res
+
+    def lookup(self, path):
+        """Find all resources matching the given path below this node
+
+        String matches have a higher priority than regex matches, at every
+        path level.
+
+        :param path: Path components
+        :type path: tuple
+        :returns: The matching resources
+        :rtype: list
+        """
+        nodes = [self]
+        for component in path:
+            matches = [node.children[component] for node in nodes if component in node.children]
+            if not matches:
+                matches = [
+                    child for node in nodes \
+                    for regex, child in node.regex_children.values() \
+                    if regex.fullmatch(component)
+                    ]
+                if not matches:
+                    return []
+            nodes = matches
+        return [node.resource for node in nodes if node.resource is not None]
+
+class Site(LogMixin, resource.Site):
+    """CoAP Site resource with path regex matching
+
+    Resources are kept in a routing tree which is built when they are added,
+    so finding the resource for a request only takes time proportional to the
+    depth of the requested path.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._routes = RouteNode()
+        self._links = None
+        self._link_documents = LRUCache(maxsize=32)
+
+    def add_resource(self, path, res):
+        super().add_resource(path, res)
+        self._routes.insert(tuple(path), res)
+        self._resources_changed()
+
+    def remove_resource(self, path):
+        super().remove_resource(path)
+        self._routes = RouteNode()
+        for key, res in self._resources.items():
+            self._routes.insert(key, res)
+        self._resources_changed()
+
+    def _resources_changed(self):
+        """Drop the cached resource links"""
+        self._links = None
+        self._link_documents.clear()
+
+    def get_resources_as_linkheader(self):
+        """Get links to all resources of the site
+
+        The links are built once and kept until a resource is added or
+        removed.
+
+        :rtype: link_header.LinkHeader
+        """
+        if self._links is None:
+            self._links = super().get_resources_as_linkheader()
+        return self._links
+
+    def get_resources_as_linkformat(self, filters=None):
+        """Get the encoded link-format document describing the resources of
+        the site
+
+        :param filters: Link attribute filters, see :func:`attributes_match`.
+            The link target can be filtered as ``href``.
+        :type filters: dict
+        :returns: The link-format document
+        :rtype: soa.directory.cache.Representation
+        """
+        filters = filters or {}
+        key = tuple(sorted(filters.items()))
+        document = self._link_documents.get(key)
+        if document is None:
+            links = [link for link in self.get_resources_as_linkheader().links
+                     if attributes_match(link.attr_pairs + [['href', link.href]], filters)]
+            document = Representation(
+                link_header.format_links(links).encode('utf-8'),
+                media_types_rev['application/link-format'])
+            self._link_documents.put(key, document)
+        return document
+
+    def _find_child(self, request):
+        """Find the resource responsible for a request
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :returns: The matching resource
+        :raises aiocoap.error.NoResource: if no resource matches the path
+        """
+        path = tuple(request.opt.uri_path)
+        matches = self._routes.lookup(path)
+        if len(matches) == 0:
+            raise aiocoap.error.NoResource()
+        elif len(matches) > 1:
+            raise aiocoap.error.RenderableError(
+                "Ambiguous matches: {} = {}".format(repr(path), repr(matches)))
+        return matches[0]
+
+    @asyncio.coroutine
+    def needs_blockwise_assembly(self, request):
+        try:
+            child = self._find_child(request)
+        except aiocoap.error.Error:
+            return True
+        return child.needs_blockwise_assembly(request)
+
+    @asyncio.coroutine
+    def render(self, request):
+        child = self._find_child(request)
+        return child.render(request)
+
+    @asyncio.coroutine
+    def add_observation(self, request, serverobservation):
+        try:
+            child = self._find_child(request)
+        except aiocoap.error.Error:
+            return
+        try:
+            yield from child.add_observation(request, serverobservation)
+        except AttributeError:
+            pass
+
+class Resource(resource.Resource):
+    """Generic resource class"""
+    def __init__(self, *args, get=None, put=None, post=None, delete=None, **kwargs):
+        """Constructor
+
+        :param get: callback for GET requests
+        :type get: asyncio.coroutine or None
+        :param put: callback for PUT requests
+        :type put: asyncio.coroutine or None
+        :param post: callback for POST requests
+        :type post: asyncio.coroutine or None
+        :param delete: callback for DELETE requests
+        :type delete: asyncio.coroutine or None
+        """
+        super().__init__(*args, **kwargs)
+        if get is not None:
+            self.render_get = get
+        if put is not None:
+            self.render_put = put
+        if post is not None:
+            self.render_post = post
+        if delete is not None:
+            self.render_delete = delete
+
+class WellKnownCoreResource(resource.Resource):
+    """CoRE resource discovery resource (:rfc:`6690#section-4`), suitable as
+    .well-known/core
+
+    The link-format documents are cached by the site, see
+    :meth:`Site.get_resources_as_linkformat`, so discovery requests do not
+    rebuild the document. Query filters, e.g. ``?rt=core.rd`` or
+    ``?href=/rd*``, are evaluated against the cached links.
+    """
+
+    ct = media_types_rev['application/link-format']
+
+    def __init__(self, site):
+        """Constructor
+
+        :param site: The site to describe
+        :type site: Site
+        """
+        super().__init__()
+        self.site = site
+
+    @asyncio.coroutine
+    def render_get(self, request):
+        query = parse_query(request)
+        if any(value is None for value in query.values()):
+            raise BadRequestError()
+        document = self.site.get_resources_as_linkformat(query)
+        if document.digest in request.opt.etags:
+            msg = aiocoap.Message(code=Code.VALID)
+        else:
+            msg = aiocoap.Message(code=Code.CONTENT, payload=document.body)
+            msg.opt.content_format = document.content_type
+        msg.opt.etag = document.digest
+        return msg
@@ -3,10 +3,15 @@
 :seealso:
     https://forge.soa4d.org/plugins/mediawiki/wiki/arrowhead-f/index.php/Mandatory_Core_Systems_and_Services
 """
+import os
 import time
+import binascii
 import calendar
 import tempfile
+import asyncio
+import collections
 
+import attr
 import blitzdb
 
 from .. import LogMixin
@@ -21,21 +26,666 @@ def unix_now():
     """
     return calendar.timegm(time.gmtime())
 
+RECORD_METADATA = ('deadline', 'updated', 'lifetime')
+"""Keys of service records which are not part of the service description"""
+
+def effective_lifetime(get_config, stype=None, requested=None):
+    """Determine the lease lifetime of a service
+
+    Without a requested lifetime, the default lifetime of the service type
+    from the ``type_lifetimes`` configuration, or else the ``lifetime``
+    default applies. The result is bounded by ``min_lifetime`` and
+    ``max_lifetime``.
+
+    :param get_config: Function looking up configuration values
+    :type get_config: callable(string)
+    :param stype: The type of the service
+    :type stype: string
+    :param requested: The lifetime requested by the publisher in seconds
+    :type requested: int
+    :returns: The lifetime in seconds
+    :rtype: int
+    """
+    if requested is None:
+        requested = get_config('type_lifetimes').get(stype, get_config('lifetime'))
+    return max(get_config('min_lifetime'), min(get_config('max_lifetime'), int(requested)))
+
+SLOW_NOTIFY_CALLBACK = 0.1
+"""Time in seconds after which a notify callback is reported as slow"""
+
+def call_notify(callbacks, event, log, stats=None):
+    """Call notify callbacks, isolating them from each other and from the
+    caller
+
+    Exceptions raised by a callback are logged and do not prevent the other
+    callbacks from being called. The callbacks run inside the modification
+    which caused the event, so the time spent in them is measured, and
+    callbacks taking longer than :data:`SLOW_NOTIFY_CALLBACK` are reported.
+    Such subscribers should rather use
+    :meth:`soa.directory.asyncdir.AsyncDirectory.subscribe`.
+
+    :param callbacks: The callbacks to call
+    :type callbacks: iterable(callable(ChangeEvent))
+    :param event: Description of the modification
+    :type event: ChangeEvent
+    :param log: Logger to report failing callbacks to
+    :type log: logging.Logger
+    :param stats: Counters to add the time spent in the callbacks in seconds
+        (``notify_time``), the number of failed (``notify_errors``) and of
+        slow (``notify_slow``) calls to
+    :type stats: collections.Counter
+    """
+    for func in list(callbacks):
+        start = time.monotonic()
+        failed = False
+        try:
+            func(event)
+        except Exception: #pylint: disable=broad-except
+            failed = True
+            log.exception('Notify callback %r failed on %r', func, event)
+        elapsed = time.monotonic() - start
+        slow = elapsed > SLOW_NOTIFY_CALLBACK
+        if slow:
+            log.warning('Notify callback %r took %.3f s on %r', func, elapsed, event)
+        if stats is not None:
+            stats['notify_time'] += elapsed
+            stats['notify_errors'] += failed
+            stats['notify_slow'] += slow
+
 class DirectoryException(Exception):
     """Service directory exception base class"""
 
 class DoesNotExist(DirectoryException):
     """Service not found in directory"""
 
-class Directory(LogMixin, object): # pylint: disable=too-few-public-methods
+class QuotaExceeded(DirectoryException):
+    """Service rejected because a capacity limit of the directory is reached"""
+
+@attr.s # pylint: disable=too-few-public-methods
+class ChangeEvent(object):
+    """Description of a single modification of the service registry
+
+    Change events are passed to the callbacks registered with
+    :meth:`ServiceDirectory.add_notify_callback`.
+    """
+    PUBLISH = 'publish'
+    """A service was published or renewed"""
+    UNPUBLISH = 'unpublish'
+    """A service was removed by its publisher"""
+    EXPIRE = 'expire'
+    """A service was removed because it timed out"""
+    EVICT = 'evict'
+    """A service was removed to make room for another one, see
+    :class:`CapacityPolicy`"""
+
+    kind = attr.ib()
+    name = attr.ib()
+    type = attr.ib(default=None)
+    old_type = attr.ib(default=None)
+    generation = attr.ib(default=None)
+    renewal = attr.ib(default=False)
+    """True if a service was published again without any changes"""
+
+    @property
+    def types(self):
+        """The service types affected by this change
+
+        This includes the previous type of a service which was published
+        again with a different type.
+        """
+        return {stype for stype in (self.type, self.old_type) if stype is not None}
+
+@attr.s # pylint: disable=too-few-public-methods
+class ChangeLogEntry(object):
+    """A single entry of the :class:`ChangeLog`
+
+    Removed services are recorded as tombstones, which carry the name and
+    type of the service but no service description. Entries of published
+    services carry the effective lease lifetime.
+    """
+    UPSERT = 'upsert'
+    """A service was added or modified"""
+    RENEW = 'renew'
+    """A service was published again without any changes"""
+    DELETE = 'delete'
+    """A service was removed by its publisher"""
+    EXPIRE = 'expire'
+    """A service was removed because it timed out"""
+    EVICT = 'evict'
+    """A service was removed to make room for another one"""
+
+    OPERATIONS = {
+        ChangeEvent.UNPUBLISH: DELETE,
+        ChangeEvent.EXPIRE: EXPIRE,
+        ChangeEvent.EVICT: EVICT,
+    }
+
+    sequence = attr.ib()
+    operation = attr.ib()
+    name = attr.ib()
+    type = attr.ib(default=None)
+    service = attr.ib(default=None)
+    lifetime = attr.ib(default=None)
+
+    @classmethod
+    def from_event(cls, event, service=None, lifetime=None):
+        """Create the entry for a change event
+
+        :param event: Description of the change, with the generation set
+        :type event: ChangeEvent
+        :param service: The published service, ignored for removals
+        :type service: soa.services.Service
+        :param lifetime: Lease lifetime of the published service in seconds,
+            ignored for removals
+        :type lifetime: int
+        :rtype: ChangeLogEntry
+        """
+        if event.kind == ChangeEvent.PUBLISH:
+            operation = cls.RENEW if event.renewal else cls.UPSERT
+        else:
+            operation = cls.OPERATIONS[event.kind]
+            service = lifetime = None
+        return cls(event.generation, operation, event.name, type=event.type, service=service,
+                   lifetime=lifetime)
+
+    def to_json_dict(self):
+        """Convert the entry to a JSON representation dict
+
+        :rtype: dict
+        """
+        entry = {
+            'sequence': self.sequence,
+            'op': self.operation,
+            'name': self.name,
+            'type': self.type,
+        }
+        if self.service is not None:
+            entry['service'] = self.service.to_json_dict()
+        if self.lifetime is not None:
+            entry['lifetime'] = self.lifetime
+        return entry
+
+@attr.s # pylint: disable=too-few-public-methods
+class ChangeSet(object):
+    """The changes to the registry since a given sequence number, see
+    :meth:`ServiceDirectory.changes_since`
+
+    If the changes are not known any more, because the log has been trimmed
+    since or the registry has been restarted, :attr:`resync` is set and the
+    client needs to fetch the complete service list.
+    """
+    epoch = attr.ib()
+    generation = attr.ib()
+    since = attr.ib(default=None)
+    changes = attr.ib(default=attr.Factory(list))
+    resync = attr.ib(default=False)
+
+    def to_json_dict(self):
+        """Convert the change set to a JSON representation dict
+
+        :rtype: dict
+        """
+        if self.resync:
+            return {'epoch': self.epoch, 'generation': self.generation, 'resync': True}
+        return {
+            'epoch': self.epoch,
+            'generation': self.generation,
+            'since': self.since,
+            'resync': False,
+            'changes': [entry.to_json_dict() for entry in self.changes],
+        }
+
+class ChangeLog(object):
+    """Bounded log of the modifications of the registry
+
+    Entries are numbered with the registry generation they led to, so the
+    generation counter serves as the sequence number of the log. Changes up
+    to the generation the log was started at are not known, which requires
+    a resync of clients asking for them.
+    """
+
+    def __init__(self, maxlen=1024):
+        """Constructor
+
+        :param maxlen: Number of entries to keep
+        :type maxlen: int
+        """
+        self._entries = collections.deque(maxlen=maxlen)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, event, service=None, lifetime=None):
+        """Add an entry for a change
+
+        :param event: Description of the change, with the new generation set
+        :type event: ChangeEvent
+        :param service: The published service, None for removals
+        :type service: soa.services.Service
+        :param lifetime: Lease lifetime of the published service in seconds
+        :type lifetime: int
+        """
+        self._entries.append(ChangeLogEntry.from_event(event, service, lifetime))
+
+    def changes_since(self, since, epoch, generation):
+        """Get the changes after a given sequence number
+
+        Only the most recent entry of each service is returned.
+
+        :param since: The last sequence number known to the client
+        :type since: int
+        :param epoch: The current epoch of the registry
+        :type epoch: string
+        :param generation: The current generation of the registry
+        :type generation: int
+        :rtype: ChangeSet
+        """
+        oldest = self._entries[0].sequence if self._entries else generation + 1
+        if since is None or since > generation or since < oldest - 1:
+            return ChangeSet(epoch, generation, resync=True)
+        latest = collections.OrderedDict()
+        for entry in self._entries:
+            if entry.sequence > since:
+                latest.pop(entry.name, None)
+                latest[entry.name] = entry
+        return ChangeSet(epoch, generation, since=since, changes=list(latest.values()))
+
+class CapacityPolicy(object):
+    """Capacity limits of the registry, and what to do when they are reached
+
+    Limits apply to the total number of services, and to the number of
+    services per host and per domain. When publishing a new service would
+    exceed a limit, the policy either rejects it with :class:`QuotaExceeded`,
+    or evicts the service within the limit's scope which has the nearest
+    deadline or was renewed least recently.
+    """
+
+    REJECT = 'reject'
+    """Reject new services when a limit is reached"""
+    NEAREST_DEADLINE = 'nearest-deadline'
+    """Evict the service which would time out first"""
+    LEAST_RECENTLY_RENEWED = 'least-recently-renewed'
+    """Evict the service which was published or renewed least recently"""
+
+    EVICTION_KEYS = {
+        NEAREST_DEADLINE: lambda record: record.get('deadline') or 0,
+        LEAST_RECENTLY_RENEWED: lambda record: record.get('updated') or 0,
+    }
+
+    def __init__(self, max_services=None, max_per_host=None, max_per_domain=None,
+                 eviction=REJECT):
+        """Constructor
+
+        :param max_services: Maximum number of services, None for no limit
+        :type max_services: int
+        :param max_per_host: Maximum number of services per host
+        :type max_per_host: int
+        :param max_per_domain: Maximum number of services per domain
+        :type max_per_domain: int
+        :param eviction: One of :data:`REJECT`, :data:`NEAREST_DEADLINE` and
+            :data:`LEAST_RECENTLY_RENEWED`
+        :type eviction: string
+        """
+        if eviction != self.REJECT and eviction not in self.EVICTION_KEYS:
+            raise DirectoryException('Unknown eviction policy: {}'.format(eviction))
+        self.limits = [(scope, limit) for scope, limit in (
+            (None, max_services), ('host', max_per_host), ('domain', max_per_domain))
+                       if limit is not None]
+        self.eviction = eviction
+
+    @classmethod
+    def from_config(cls, get_config):
+        """Create the policy from the directory configuration
+
+        :param get_config: Function looking up configuration values
+        :type get_config: callable(string)
+        :rtype: CapacityPolicy
+        """
+        return cls(get_config('max_services'), get_config('max_services_per_host'),
+                   get_config('max_services_per_domain'), get_config('eviction_policy'))
+
+    def admit(self, records, services):
+        """Check a batch of services against the limits
+
+        :param records: The current records of the registry by name
+        :type records: dict(string, dict)
+        :param services: The services to publish
+        :type services: list(soa.services.Service)
+        :returns: The records to evict to make room for the batch
+        :rtype: list(dict)
+        :raises QuotaExceeded: if a service has to be rejected, no services
+            of the batch are published then
+        """
+        if not self.limits:
+            return []
+        records = dict(records)
+        counts = collections.Counter()
+        for record in records.values():
+            counts.update(self._keys(record))
+        protected = {service.name for service in services}
+        evicted = []
+        for service in services:
+            old = records.pop(service.name, None)
+            if old is not None:
+                counts.subtract(self._keys(old))
+            record = service.to_dict()
+            for scope, limit in self.limits:
+                key = (scope, record.get(scope)) if scope else (None, None)
+                while counts[key] >= limit:
+                    victim = None
+                    if self.eviction != self.REJECT:
+                        candidates = [candidate for candidate in records.values()
+                                      if candidate['name'] not in protected and
+                                      (scope is None or candidate.get(scope) == key[1])]
+                        victim = min(candidates, key=self.EVICTION_KEYS[self.eviction],
+                                     default=None)
+                    if victim is None:
+                        raise QuotaExceeded('Quota exceeded: at most {} services{}'.format(
+                            limit, ' per {} {}'.format(scope, key[1]) if scope else ''))
+                    del records[victim['name']]
+                    counts.subtract(self._keys(victim))
+                    evicted.append(victim)
+            records[service.name] = record
+            counts.update(self._keys(record))
+        return evicted
+
+    def _keys(self, record):
+        """Get the counters a record contributes to"""
+        return [(scope, record.get(scope)) if scope else (None, None)
+                for scope, _ in self.limits]
+
+class NotifyCoalescer(LogMixin, object):
+    """Notify callback wrapper which merges bursts of change events
+
+    An instance can be registered with
+    :meth:`ServiceDirectory.add_notify_callback` in place of the wrapped
+    callback. Change events are collected until no new event has arrived for
+    `min_interval` seconds, but never held back for more than `max_delay`
+    seconds after the first one. The wrapped callback is then called once
+    with the list of all collected events, so subscribers see at most one
+    update per window, reflecting the final state of the registry.
+    """
+
+    def __init__(self, callback, *, min_interval, max_delay=None, loop=None):
+        """Constructor
+
+        :param callback: Callback to pass the collected events to
+        :type callback: callable(list(ChangeEvent))
+        :param min_interval: Minimum time between two calls to the callback,
+            in seconds
+        :type min_interval: float
+        :param max_delay: Maximum time to hold back an event, in seconds,
+            default and minimum is `min_interval`
+        :type max_delay: float
+        :param loop: Event loop to schedule the callbacks on
+        :type loop: asyncio.AbstractEventLoop
+        """
+        super().__init__()
+        self.callback = callback
+        self.min_interval = min_interval
+        self.max_delay = max(max_delay or 0, min_interval)
+        self._loop = loop or asyncio.get_event_loop()
+        self._pending = []
+        self._first_pending = None
+        self._handle = None
+        self.stats = collections.Counter()
+
+    def __call__(self, event):
+        """Collect a change event
+
+        :param event: Description of the change
+        :type event: ChangeEvent
+        """
+        now = self._loop.time()
+        self._pending.append(event)
+        self.stats['events'] += 1
+        if self._first_pending is None:
+            self._first_pending = now
+        due = min(now + self.min_interval, self._first_pending + self.max_delay)
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self._loop.call_at(due, self.flush)
+
+    def flush(self):
+        """Pass all collected events to the callback right away"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        events, self._pending = self._pending, []
+        self._first_pending = None
+        if not events:
+            return
+        self.stats['notifications'] += 1
+        self.log.debug('Passing on %u events', len(events))
+        self.callback(events)
+
+    def cancel(self):
+        """Drop all collected events without calling the callback"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._pending = []
+        self._first_pending = None
+
+    @property
+    def coalescing_ratio(self):
+        """Average number of events passed on per callback, or None if the
+        callback has not been called yet"""
+        if not self.stats['notifications']:
+            return None
+        return self.stats['events'] / self.stats['notifications']
+
+class RegistryMixin(object):
+    """Registry bookkeeping shared by the directory backends
+
+    Holds the configuration, the epoch, the generation counter and change
+    log, the capacity policy and the notify callbacks. Backends call
+    :meth:`_init_registry` from their constructor, and only implement the
+    storage of the service records.
+    """
+
+    config_defaults = {
+        'lifetime': 30 * 60,
+        'min_lifetime': 60,
+        'max_lifetime': 25 * 60 * 60,
+        'type_lifetimes': {},
+        'max_services': None,
+        'max_services_per_host': None,
+        'max_services_per_domain': None,
+        'eviction_policy': CapacityPolicy.REJECT,
+        'changelog_size': 1024,
+        }
+    """Default configuration items"""
+
+    def _init_registry(self, config=None):
+        """Set up the bookkeeping of an empty registry
+
+        :param config: Configuration values overriding :attr:`config_defaults`
+        :type config: dict
+        :raises DirectoryException: for unknown configuration keys
+        """
+        unknown = set(config or {}) - set(self.config_defaults)
+        if unknown:
+            raise DirectoryException('Unknown configuration keys: {}'.format(sorted(unknown)))
+        self._config = dict(config or {})
+        self.log.debug('config: %r', [(k, v) for k, v in self._config.items()])
+        self._notify_set = set()
+        self._epoch = binascii.hexlify(os.urandom(4)).decode('ascii')
+        self._generation = 0
+        self._changelog = ChangeLog(self._get_config_value('changelog_size'))
+        self._capacity = CapacityPolicy.from_config(self._get_config_value)
+        self.stats = collections.Counter()
+        """Number of ``evicted`` and ``rejected`` services, and the time spent
+        in notify callbacks, see :func:`call_notify`"""
+        self._next_deadline = None
+
+    def _init_loaded(self):
+        """Count the services found in the storage at startup as the first
+        generation of the registry
+
+        The change log does not know these services, so clients which only
+        know generation 0, e.g. from before a restart of a persistent
+        registry, are told to resync instead of being told that nothing has
+        changed.
+        """
+        self._generation = 1
+
+    def _track_deadlines(self, removed=(), added=()):
+        """Update the nearest deadline after a modification
+
+        The records are only scanned if a removed or replaced record held the
+        nearest deadline, so modifications stay cheap in large registries.
+        Call this after the storage has been updated.
+
+        :param removed: Deadlines of the removed or replaced records
+        :type removed: iterable(int)
+        :param added: Deadlines of the added records
+        :type added: iterable(int)
+        """
+        if self._next_deadline is not None and self._next_deadline in set(removed):
+            self._next_deadline = self._find_next_deadline()
+        else:
+            deadlines = [deadline for deadline in added if deadline is not None]
+            if self._next_deadline is not None:
+                deadlines.append(self._next_deadline)
+            self._next_deadline = min(deadlines, default=None)
+
+    def _expiry_due(self, now):
+        """Check whether any service may have timed out
+
+        :param now: Current time
+        :type now: int
+        :rtype: bool
+        """
+        return self._next_deadline is not None and self._next_deadline < now
+
+    def _get_config_value(self, key):
+        """Get a configuration value
+
+        :param key: the key to look up
+        :type key: string
+        :returns: The configuration value, or its default value if it is not
+            configured
+        :rtype: varies
+        """
+        value = self._config.get(key, self.config_defaults[key])
+        self.log.debug('Config get: %s => %r', key, value)
+        return value
+
+    def _changed(self, event, service=None, lifetime=None):
+        """Advance the registry generation after a modification, log it and
+        notify subscribers
+
+        :param event: Description of the modification
+        :type event: ChangeEvent
+        :param service: The published service, for publish events
+        :type service: soa.services.Service
+        :param lifetime: Lease lifetime of the published service
+        :type lifetime: int
+        """
+        self._generation += 1
+        event.generation = self._generation
+        self.log.debug('generation %u: %r', self._generation, event)
+        self._changelog.record(event, service, lifetime)
+        self._call_notify(event)
+
+    def _change_set(self, since, epoch, generation):
+        """Get the changes after a given generation, see
+        :meth:`ServiceDirectory.changes_since`
+
+        :param generation: The current generation, after pruning
+        :type generation: int
+        :rtype: ChangeSet
+        """
+        if epoch is not None and epoch != self._epoch:
+            return ChangeSet(self._epoch, generation, resync=True)
+        return self._changelog.changes_since(since, self._epoch, generation)
+
+    def _admit(self, active, services):
+        """Apply the capacity policy to a batch of services
+
+        :param active: Function returning the records of the services in the
+            registry by name, only called if there are limits
+        :type active: callable()
+        :param services: The services to publish
+        :type services: list(soa.services.Service)
+        :returns: The records the backend has to evict, see
+            :meth:`CapacityPolicy.admit`
+        :rtype: list(dict)
+        :raises QuotaExceeded: if the batch does not fit in the registry
+        """
+        if not self._capacity.limits:
+            return []
+        try:
+            evicted = self._capacity.admit(active(), services)
+        except QuotaExceeded:
+            self.stats['rejected'] += 1
+            raise
+        for record in evicted:
+            self.log.info('evict %s', record['name'])
+            self.stats['evicted'] += 1
+        return evicted
+
+    def epoch(self):
+        """Get the identifier of this instance of the registry
+
+        The generation counter starts over whenever the directory is created,
+        so a generation is only meaningful together with the epoch it was
+        read in. The epoch is a random string chosen at construction time.
+
+        :returns: The epoch identifier
+        :rtype: string
+        """
+        return self._epoch
+
+    def next_deadline(self):
+        """Get the time when the first service in the registry will time out
+
+        :returns: Unix timestamp of the nearest deadline, or None if the
+            registry is empty
+        :rtype: int
+        """
+        return self._next_deadline
+
+    def add_notify_callback(self, callback):
+        """Register a callback to be executed whenever the service registry is updated
+
+        This can be used to let users subscribe to events in the registry.
+        A :class:`ChangeEvent` describing the modification will be passed as
+        an argument to the callback.
+
+        :param callback: The callback to register
+        :type callback: callable(ChangeEvent)
+        """
+        self._notify_set.add(callback)
+
+    def del_notify_callback(self, callback):
+        """Unregister a callback
+
+        :param callback: The callback to unregister
+        :type callback: callable(ChangeEvent)
+        """
+        self._notify_set.discard(callback)
+
+    def _call_notify(self, event):
+        """Call all registered callbacks
+
+        A failing callback does not abort the modification, and the time
+        spent in the callbacks is added to :attr:`stats`, see
+        :func:`call_notify`.
+
+        :param event: Description of the modification
+        :type event: ChangeEvent
+        """
+        call_notify(self._notify_set, event, self.log, self.stats)
+
+class Directory(RegistryMixin, LogMixin, object): # pylint: disable=too-few-public-methods
     """Directory base class"""
 
     DoesNotExist = DoesNotExist
+    QuotaExceeded = QuotaExceeded
 
-    config_defaults = {}
-    """Default configuration items, override in subclass"""
-
-    def __init__(self, database=None):
+    def __init__(self, database=None, config=None):
         """Constructor
 
         If a database backend object is not provided, an ephemeral database will
@@ -43,6 +693,8 @@ class Directory(LogMixin, object): # pylint: disable=too-few-public-methods
 
         :param database: A database file name, or database object
         :type database: string or database
+        :param config: Configuration values overriding :attr:`config_defaults`
+        :type config: dict
         """
         super().__init__()
         self.log.debug('Using blitzdb v %s', blitzdb.__version__)
@@ -60,23 +712,8 @@ class Directory(LogMixin, object): # pylint: disable=too-few-public-methods
         else:
             # database is used as-is
             self._db = database
-        self._config = {}
+        self._init_registry(config)
         self.log.info('Directory initialized')
-        self.log.debug('config: %r', [(k, v) for k, v in self._config.items()])
-        self._notify_set = set()
-
-    def _get_config_value(self, key):
-        """Get a configuration value from the database
-
-        :param key: the key to look up
-        :type key: string
-        :returns: The configuration value, or a default value if the key was not
-            found in the database
-        :rtype: varies
-        """
-        value = self._config.get(key, self.config_defaults[key])
-        self.log.debug('Config get: %s => %r', key, value)
-        return value
 
 class ServiceDirectory(Directory):
     """Service directory main class"""
@@ -88,50 +725,79 @@ class ServiceDirectory(Directory):
             """Database backend configuration metadata"""
             primary_key = 'name' #use the name of the service as the primary key
 
-    config_defaults = {
-        'lifetime': 30 * 60
-        }
+    def __init__(self, *args, **kwargs):
+        """Constructor
+
+        See :class:`Directory` for the arguments.
+        """
+        super().__init__(*args, **kwargs)
+        self._next_deadline = self._find_next_deadline()
+        if len(self._db.filter(self.Service, {})):
+            self._init_loaded()
+
+    def _find_next_deadline(self):
+        """Find the deadline of the service which will time out first
 
+        :returns: Unix timestamp of the nearest deadline, or None if the
+            registry is empty
+        :rtype: int
+        """
+        deadlines = [record.attributes.get('deadline')
+                     for record in self._db.filter(self.Service, {})]
+        return min((deadline for deadline in deadlines if deadline is not None),
+                   default=None)
+
+    def generation(self, prune=True):
+        """Get the current generation of the registry
+
+        The generation is a counter which is incremented every time the set of
+        services in the registry changes. Services which have timed out are
+        pruned before the counter is read, so two calls returning the same
+        value are guaranteed to have seen the same registry contents. This
+        makes the generation usable as a cache validator for rendered
+        representations of the registry.
+
+        :param prune: Prune services which have timed out first, callers
+            which have already done so may skip it
+        :type prune: bool
+        :returns: The registry generation
+        :rtype: int
+        """
+        if prune and self._expiry_due(unix_now()):
+            self.prune_old_services()
+        return self._generation
+
+    def changes_since(self, since, epoch=None, prune=True):
+        """Get the changes to the registry after a given generation
+
+        :param since: The last generation known to the client, as returned
+            by :meth:`generation` or in a previous :class:`ChangeSet`
+        :type since: int
+        :param epoch: The epoch which `since` was read in, a different epoch
+            than the current one requires a resync
+        :type epoch: string
+        :param prune: Prune services which have timed out first
+        :type prune: bool
+        :rtype: ChangeSet
+        """
+        return self._change_set(since, epoch, self.generation(prune=prune))
 
     def prune_old_services(self):
         """Delete all service entries that have timed out"""
         now = unix_now()
+        if not self._expiry_due(now):
+            return
         services = self._db.filter(self.Service, {'deadline': {'$lt': now}})
-        count = len(services)
+        expired = [record.attributes.copy() for record in services]
         services.delete()
         self._db.commit()
-        self.log.debug('pruned %u timed out services', count)
-
-    def add_notify_callback(self, callback):
-        """Register a callback to be executed whenever the service registry is updated
-
-        This can be used to let users subscribe to events in the registry.
-        The service registry will be passed as an argument to the callback.
-
-        :param callback: The callback to register
-        :type callback: callable(serviceregistry)
-        """
-        if callback in self._notify_set:
-            return
-        self._notify_set.add(callback)
-
-    def del_notify_callback(self, callback):
-        """Unregister a callback
-
-        :param callback: The callback to unregister
-        :type callback: callable(serviceregistry)
-        """
-        if callback not in self._notify_set:
-            return
-        self._notify_set.remove(callback)
-
-    def _call_notify(self):
-        """Call all registered callbacks"""
-        self.prune_old_services()
-        for func in self._notify_set:
-            func()
+        self.log.debug('pruned %u timed out services', len(expired))
+        self._next_deadline = self._find_next_deadline()
+        for srv in expired:
+            self._changed(ChangeEvent(
+                ChangeEvent.EXPIRE, srv.get('name'), type=srv.get('type')))
 
-    def publish(self, *, service):
+    def publish(self, *, service, lifetime=None):
         """Publish a service in the registry
 
         The service entry will be updated if it already exists, otherwise it
@@ -139,22 +805,86 @@ class ServiceDirectory(Directory):
 
         :param service: The service to update
         :type service: dict
+        :param lifetime: Requested lease lifetime in seconds, see
+            :func:`effective_lifetime`. When updating a service without a
+            requested lifetime, its previous lifetime is kept.
+        :type lifetime: int
+        :returns: The effective lease lifetime in seconds
+        :rtype: int
         """
-        scopy = service.to_dict()
+        return self.publish_many(services=[service], lifetimes=[lifetime])[0][1]
+
+    def publish_many(self, *, services, lifetimes=None):
+        """Publish several services in the registry as one batch
+
+        The database is only written once for the whole batch. A change event
+        is still generated for each service. Services may be evicted to make
+        room for the batch, see :class:`CapacityPolicy`.
+
+        :param services: The services to update
+        :type services: list(soa.services.Service)
+        :param lifetimes: Requested lease lifetime of each service, see
+            :meth:`publish`
+        :type lifetimes: list(int)
+        :returns: For each service, whether it was already published, and
+            the effective lease lifetime
+        :rtype: list(tuple(bool, int))
+        :raises QuotaExceeded: if the batch does not fit in the registry
+        """
+        evicted = [record['name'] for record in self._admit(
+            lambda: {record.attributes.get('name'): record.attributes
+                     for record in self._find_active()}, services)]
         # Add last updated time stamp and refresh deadline
         now = unix_now()
-        lifetime = self._get_config_value('lifetime')
-        scopy['updated'] = now
-        scopy['deadline'] = now + lifetime
-        self.log.debug('publish: %r', scopy)
-        old_service = self._db.filter(self.Service, {'name': service.name})
-        self.log.debug('remove %r', [s for s in old_service])
-        old_service.delete()
+        old_query = self._db.filter(
+            self.Service, {'name': {'$in': [service.name for service in services] + evicted}})
+        records = {record.attributes.get('name'): record.attributes for record in old_query}
+        removed = [record.get('deadline') for record in records.values()]
+        self.log.debug('remove %r', records)
+        old_query.delete()
         self._db.commit()
-        service_entry = self.Service(scopy)
-        self._db.save(service_entry)
+        evict_events = []
+        for name in evicted:
+            evict_events.append(ChangeEvent(
+                ChangeEvent.EVICT, name, type=records.pop(name).get('type')))
+        results = []
+        events = []
+        for service, lifetime in zip(services, lifetimes or [None] * len(services)):
+            scopy = service.to_dict()
+            unchanged = dict(scopy)
+            old_type = None
+            renewal = False
+            old_record = records.get(service.name)
+            if old_record is not None:
+                if old_record.get('type') != service.type:
+                    old_type = old_record.get('type')
+                old = {key: value for key, value in old_record.items()
+                       if key not in RECORD_METADATA}
+                renewal = old == unchanged
+                if lifetime is None:
+                    lifetime = old_record.get('lifetime')
+            lifetime = effective_lifetime(self._get_config_value, service.type, lifetime)
+            scopy['updated'] = now
+            scopy['deadline'] = now + lifetime
+            scopy['lifetime'] = lifetime
+            self.log.debug('publish: %r', scopy)
+            results.append((old_record is not None, lifetime))
+            records[service.name] = scopy
+            events.append((ChangeEvent(
+                ChangeEvent.PUBLISH, service.name, type=service.type, old_type=old_type,
+                renewal=renewal), AHService(**unchanged), lifetime))
+        for service in services:
+            scopy = records.pop(service.name, None)
+            if scopy is not None:
+                self._db.save(self.Service(scopy))
         self._db.commit()
-        self._call_notify()
+        self._track_deadlines(removed, [now + lifetime for _, lifetime in results])
+        self.prune_old_services()
+        for event in evict_events:
+            self._changed(event)
+        for event, service, lifetime in events:
+            self._changed(event, service, lifetime)
+        return results
 
     def unpublish(self, *, name):
         """De-register a service in the registry
@@ -164,13 +894,35 @@ class ServiceDirectory(Directory):
         :param name: The name of the service to delete
         :type name: string
         """
-        self.log.debug('unpublish: %s', name)
-        service = self._db.filter(self.Service, {'name': name})
-        if len(service) == 0:
+        if not self.unpublish_many(names=[name])[0]:
             raise self.DoesNotExist()
-        service.delete()
-        self._db.commit()
-        self._call_notify()
+
+    def unpublish_many(self, *, names):
+        """De-register several services in the registry as one batch
+
+        :param names: The names of the services to delete
+        :type names: list(string)
+        :returns: For each name, whether the service was published
+        :rtype: list(bool)
+        """
+        self.log.debug('unpublish: %s', names)
+        query = self._db.filter(self.Service, {'name': {'$in': list(names)}})
+        types = {}
+        removed = []
+        for record in query:
+            types[record.attributes.get('name')] = record.attributes.get('type')
+            removed.append(record.attributes.get('deadline'))
+        if types:
+            query.delete()
+            self._db.commit()
+            self._track_deadlines(removed)
+            self.prune_old_services()
+        found = []
+        for name in names:
+            found.append(name in types)
+            if name in types:
+                self._changed(ChangeEvent(ChangeEvent.UNPUBLISH, name, type=types.pop(name)))
+        return found
 
     def service(self, *, name):
         """Get a named service from the registry
@@ -188,10 +940,24 @@ class ServiceDirectory(Directory):
             raise self.DoesNotExist('Not found: {}'.format(name))
         sdict = service.attributes.copy()
         # Delete the deadline and updated meta information before returning
-        sdict.pop('deadline', None)
-        sdict.pop('updated', None)
+        for key in RECORD_METADATA:
+            sdict.pop(key, None)
         return AHService(**sdict)
 
+    def _find_active(self, **search):
+        """Find the records of all services matching the given criteria which
+        have not yet timed out
+
+        :param search: Search criteria as key: value pairs
+        :type search: dict
+        :returns: Matching database records
+        """
+        now = unix_now()
+        # Find all services with deadline >= now
+        criteria = {key: value for key, value in search.items()}
+        criteria['deadline'] = {'$gte': now}
+        return self._db.filter(self.Service, criteria)
+
     def service_list(self, **search):
         """Get a list of services matching the given criteria
 
@@ -201,18 +967,29 @@ class ServiceDirectory(Directory):
         :type search: dict
         """
         self.log.debug('list %r', search)
-        now = unix_now()
-        # Find all services with deadline >= now
-        criteria = {key: value for key, value in search.items()}
-        criteria['deadline'] = {'$gte': now}
-        service_records = self._db.filter(self.Service, criteria)
+        service_records = self._find_active(**search)
         service_dicts = [service.attributes.copy() for service in service_records]
         for srv in service_dicts:
-            srv.pop('deadline', None)
-            srv.pop('updated', None)
+            for key in RECORD_METADATA:
+                srv.pop(key, None)
         res = [AHService(**srv) for srv in service_dicts]
         return res
 
+    def last_modified(self, **search):
+        """Get the time of the most recent update of any service matching the
+        given criteria
+
+        :param search: Search criteria as key: value pairs, see
+            :meth:`service_list`
+        :type search: dict
+        :returns: Unix timestamp of the last update, or None if no services
+            match the criteria
+        :rtype: int
+        """
+        updated = [record.attributes.get('updated')
+                   for record in self._find_active(**search)]
+        return max((stamp for stamp in updated if stamp is not None), default=None)
+
     def types(self):
         """Get a set of all the service types currently registered
 
@@ -1,24 +1,311 @@
 """HTTP REST implementation of Arrowhead service registry based around aiohttp"""
-import fnmatch
+import json
 import asyncio
 from aiohttp import web
 
 from .. import LogMixin
 
 from .. import services
+from .asyncdir import AsyncServiceDirectory, publish_batch, unpublish_batch
+from .cache import LRUCache, Representation, RepresentationCache, SingleFlight
+from .directory import ChangeLogEntry
+from .ratelimit import RateLimiter
+
+CODING_PREFERENCE = ('gzip', 'deflate')
+"""Supported content-codings, in order of preference"""
+
+def parse_qlist(header):
+    """Split a header value of the form used by Accept and Accept-Encoding
+
+    :param header: The header value
+    :type header: string
+    :returns: (token, quality) pairs, in the order they appear in the header.
+        Tokens are lower case, quality values default to 1.0 and malformed
+        quality values are treated as 0.
+    :rtype: list(tuple(string, float))
+    """
+    items = []
+    for element in header.split(','):
+        parts = element.split(';')
+        token = parts[0].strip().lower()
+        if not token:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value.strip())
+                except ValueError:
+                    quality = 0.0
+        items.append((token, quality))
+    return items
+
+def choose_coding(header, codings=CODING_PREFERENCE):
+    """Choose a content-coding based on an Accept-Encoding header value
+
+    :param header: Value of the Accept-Encoding header, may be None
+    :type header: string
+    :param codings: Supported content-codings, in order of preference
+    :type codings: iterable(string)
+    :returns: The best content-coding, or None if the body should be sent
+        without a content-coding
+    :rtype: string
+    """
+    if not header:
+        return None
+    qualities = dict(parse_qlist(header))
+    best = None
+    best_quality = 0.0
+    for coding in codings:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    if best is not None and best_quality < qualities.get('identity', 0.0):
+        # the client explicitly prefers uncompressed data
+        return None
+    return best
+
+class AcceptNegotiator(object):
+    """Content negotiation based on the Accept header (:rfc:`7231#section-5.3.2`)
+
+    Each header value is parsed once into a list of media ranges, and the
+    outcome of the negotiation is memoised per distinct header value and set
+    of available content types in a bounded LRU cache, as clients tend to send
+    the same few Accept headers over and over again.
+
+    For every available content type, the quality value is taken from the
+    most specific media range matching it. The content type with the highest
+    quality wins, ties are broken by the position of the matching media range
+    in the header, and then by the order of the available content types. Media
+    type parameters other than the quality value are ignored.
+    """
+
+    NOT_ACCEPTABLE = object()
+    """Negotiation result when none of the available types are acceptable"""
+    _MISSING = object()
+
+    def __init__(self, maxsize=64):
+        """Constructor
+
+        :param maxsize: Maximum number of memoised negotiation results
+        :type maxsize: int
+        """
+        self._results = LRUCache(maxsize)
+
+    @staticmethod
+    def compile(header):
+        """Parse an Accept header value into a list of media ranges
 
+        :param header: The header value
+        :type header: string
+        :returns: (type, subtype, quality, position) tuples
+        :rtype: list(tuple)
+        """
+        ranges = []
+        for position, (token, quality) in enumerate(parse_qlist(header)):
+            if token == '*':
+                # Some old clients send a bare * for */*
+                token = '*/*'
+            mtype, _, subtype = token.partition('/')
+            if not mtype or not subtype or (mtype == '*' and subtype != '*'):
+                continue
+            ranges.append((mtype.strip(), subtype.strip(), quality, position))
+        return ranges
+
+    @staticmethod
+    def _match(ranges, content_type):
+        """Find the quality value of a content type
+
+        :returns: (quality, position) of the most specific matching media
+            range, or None if no media range matches
+        """
+        mtype, _, subtype = content_type.lower().partition('/')
+        best = None
+        for range_type, range_subtype, quality, position in ranges:
+            if range_type == '*':
+                specificity = 0
+            elif range_type != mtype:
+                continue
+            elif range_subtype == '*':
+                specificity = 1
+            elif range_subtype == subtype:
+                specificity = 2
+            else:
+                continue
+            if best is None or specificity > best[0]:
+                best = (specificity, quality, position)
+        return best and best[1:]
+
+    def negotiate(self, header, content_types):
+        """Pick the content type best matching an Accept header value
+
+        :param header: Value of the Accept header, may be empty
+        :type header: string
+        :param content_types: Available content types, in order of preference
+        :type content_types: iterable(string)
+        :returns: The chosen content type, None if the header is empty or
+            names no media range, or :attr:`NOT_ACCEPTABLE`
+        """
+        content_types = tuple(content_types)
+        key = (header or '', content_types)
+        # None is a valid result, so misses are told apart with a sentinel
+        result = self._results.get(key, self._MISSING)
+        if result is self._MISSING:
+            result = self._negotiate(self.compile(key[0]), content_types)
+            self._results.put(key, result)
+        return result
+
+    def _negotiate(self, ranges, content_types):
+        """Run the negotiation for a compiled header"""
+        if not ranges:
+            return None
+        best = None
+        best_rank = None
+        for index, content_type in enumerate(content_types):
+            match = self._match(ranges, content_type)
+            if match is None or match[0] <= 0:
+                continue
+            rank = (-match[0], match[1], index)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = content_type, rank
+        if best is None:
+            return self.NOT_ACCEPTABLE
+        return best
+
+
+def etag_matches(header, etag):
+    """Check an ETag against an If-None-Match header value
+
+    Uses the weak comparison function from :rfc:`7232#section-2.3.2`, as
+    required for If-None-Match.
+
+    :param header: Value of the If-None-Match header, may be None
+    :type header: string
+    :param etag: Entity tag of the current representation, including quotes
+    :type etag: string
+    :returns: True if the header matches the given entity tag
+    :rtype: bool
+    """
+    if not header:
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+LIFETIME_HEADER = 'Lease-Lifetime'
+"""Response header carrying the effective lease lifetime of a published
+service in seconds"""
+
+def parse_lifetime(request):
+    """Validate the lease lifetime requested with the ``lifetime`` query
+    parameter
+
+    :param request: incoming HTTP request
+    :type request: aiohttp.Request
+    :returns: Lifetime in seconds, or None if not given
+    :rtype: int
+    """
+    if 'lifetime' not in request.query:
+        return None
+    try:
+        lifetime = int(request.query['lifetime'])
+    except ValueError:
+        raise web.HTTPBadRequest(reason='Invalid lifetime parameter')
+    if lifetime < 1:
+        raise web.HTTPBadRequest(reason='Invalid lifetime parameter')
+    return lifetime
+
+def format_sse(data=None, *, event=None, event_id=None, comment=None):
+    """Encode a message of a Server-Sent Events stream
+
+    :param data: Message data, may span several lines
+    :type data: string
+    :param event: Event type, the client default is ``message``
+    :type event: string
+    :param event_id: Event ID, sent back by reconnecting clients in the
+        Last-Event-ID header
+    :type event_id: string
+    :param comment: Comment, ignored by clients
+    :type comment: string
+    :rtype: bytes
+    """
+    lines = []
+    if comment is not None:
+        lines.append(': ' + comment)
+    if event is not None:
+        lines.append('event: ' + event)
+    if event_id is not None:
+        lines.append('id: ' + event_id)
+    if data is not None:
+        lines.extend('data: ' + line for line in data.split('\n'))
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+def event_filter(query):
+    """Create a predicate for change events from ``type`` and ``name`` query
+    parameters
+
+    Both parameters may be given several times. Names ending in ``*`` match
+    all services with the given prefix.
+
+    :param query: Query parameters of the request
+    :type query: multidict.MultiDict
+    :returns: Function taking the name and the set of types affected by a
+        change, True if the change matches
+    :rtype: callable
+    """
+    types = set(query.getall('type', []))
+    names = query.getall('name', [])
+
+    def matches(name, stypes):
+        """Check a change against the filter"""
+        if types and not types & stypes:
+            return False
+        return not names or any(
+            name.startswith(pattern[:-1]) if pattern.endswith('*') else name == pattern
+            for pattern in names)
+    return matches
 
 class Server(LogMixin, web.Application):
     """HTTP server implementation"""
 
-    def __init__(self, *args, directory, **kwargs):
+    def __init__(self, *args, directory, compression_threshold=1024, heartbeat_interval=15.0,
+                 rate_limiter=None, **kwargs):
         """Constructor
 
-        :param directory: Service directory to use as backend
-        :type directory: soa.directory.ServiceDirectory
+        :param directory: Service directory to use as backend, it is wrapped
+            in a :class:`soa.directory.asyncdir.AsyncServiceDirectory` unless
+            it implements :class:`soa.directory.asyncdir.AsyncDirectory`
+        :type directory: soa.directory.ServiceDirectory or
+            soa.directory.asyncdir.AsyncDirectory
+        :param compression_threshold: Minimum body size in bytes for sending
+            compressed responses to clients which accept it, None disables
+            compression
+        :type compression_threshold: int
+        :param heartbeat_interval: Seconds without change events after which
+            a heartbeat is sent on event streams
+        :type heartbeat_interval: float
+        :param rate_limiter: Limits the rate of publish and unpublish requests
+            per client, requests over the limit are answered with 429 Too Many
+            Requests
+        :type rate_limiter: soa.directory.ratelimit.RateLimiter
         """
         super().__init__(*args, **kwargs)
-        self._directory = directory
+        self._directory = AsyncServiceDirectory.wrap(directory)
+        self.compression_threshold = compression_threshold
+        self.heartbeat_interval = heartbeat_interval
+        self.rate_limiter = rate_limiter
+        self._event_streams = set()
+        self._cache = RepresentationCache()
+        self._flights = SingleFlight(loop=self.loop)
+        self._negotiator = AcceptNegotiator()
 
         self._service_list_res = self.router.add_resource('/servicediscovery/service')
         self._service_list_res.add_route('GET', self.service_list_get)
@@ -28,43 +315,44 @@ class Server(LogMixin, web.Application):
         self._type_list_res.add_route('GET', self.type_list_get)
         self._type_res = self.router.add_resource('/servicediscovery/type/{name}')
         self._type_res.add_route('GET', self.type_get)
+        self._changes_res = self.router.add_resource('/servicediscovery/changes')
+        self._changes_res.add_route('GET', self.changes_get)
+        self._events_res = self.router.add_resource('/servicediscovery/events')
+        self._events_res.add_route('GET', self.events_get)
         self._publish_res = self.router.add_resource('/servicediscovery/publish')
         self._publish_res.add_route('POST', self.publish_post)
         self._unpublish_res = self.router.add_resource('/servicediscovery/unpublish')
         self._unpublish_res.add_route('POST', self.unpublish_post)
+        self._bulk_publish_res = self.router.add_resource('/servicediscovery/bulk/publish')
+        self._bulk_publish_res.add_route('POST', self.bulk_publish_post)
+        self._bulk_unpublish_res = self.router.add_resource('/servicediscovery/bulk/unpublish')
+        self._bulk_unpublish_res.add_route('POST', self.bulk_unpublish_post)
+        self.on_shutdown.append(self._close_event_streams)
         self.log.debug('HTTP directory starting')
 
     def parse_accept(self, request, content_types):
         """Parse the incoming Accept: headers for content types matching the
         available handlers
 
-        Currently this method does not care about the quality Accept parameter
-        (e.g. 'text/plain;q=0.5')
+        See :class:`AcceptNegotiator` for the negotiation rules.
 
         :param request: the incoming HTTP request
         :type request: aiohttp.Request
-        :param content_types: list of content types that can be produced
+        :param content_types: list of content types that can be produced, in
+            order of preference
         :type content_types: list(string)
-        :returns: The first matching item, or None if the incoming request has
+        :returns: The best matching item, or None if the incoming request has
             no Accept headers.
         :rtype: string
         :raises aiohttp.web.HTTPNotAcceptable: if incoming Accept headers can
             not be matched against any of the available produced types.
         """
-
-        client_acceptables = [
-            accept.split(';')[0] for accept in
-            ','.join(request.headers.getall('ACCEPT', [])).split(',')]
-
-        self.log.info('acceptables: %r', client_acceptables)
-        if len(client_acceptables) == 0 or (
-                len(client_acceptables) == 1 and len(client_acceptables[0]) == 0):
-            return None
-        for accept in client_acceptables:
-            for content_type in content_types:
-                if fnmatch.fnmatch(content_type, accept):
-                    return content_type
-        raise web.HTTPNotAcceptable()
+        header = ','.join(request.headers.getall('ACCEPT', []))
+        content_type = self._negotiator.negotiate(header, content_types)
+        if content_type is AcceptNegotiator.NOT_ACCEPTABLE:
+            self.log.debug('Not acceptable: %r', header)
+            raise web.HTTPNotAcceptable()
+        return content_type
 
     def dispatch_request(self, request, content_handlers, *args, **kwargs):
         """Handle request by dispatching to a suitable handler based on client
@@ -86,15 +374,100 @@ class Server(LogMixin, web.Application):
         content_type = self.parse_accept(request, content_handlers.keys())
         if content_type is None:
             # Missing Accept: header, pick arbitrary handler
-            self.log.info('Request is missing Accept headers')
+            self.log.debug('Request is missing Accept headers')
             content_type = list(content_handlers.keys())[0]
         self.log.debug('Content-type: %s', content_type)
         handler = content_handlers[content_type]
         payload = handler(*args, **kwargs)
-        charset = 'utf-8'
-        return web.Response(
-            body=payload.encode(charset), content_type=content_type,
-            charset=charset)
+        return self.conditional_response(
+            request, Representation(payload.encode('utf-8'), content_type))
+
+    @asyncio.coroutine
+    def dispatch_cached(self, request, key, content_handlers, fetch, last_modified=None):
+        """Handle a GET request for a representation of the registry contents
+
+        Works like :meth:`dispatch_request`, but the encoded body is cached
+        until the registry generation changes, and conditional requests with a
+        matching If-None-Match header are answered with 304 Not Modified.
+        Concurrent requests for a representation which is not cached yet wait
+        for a single rendering, see :class:`soa.directory.cache.SingleFlight`.
+
+        :param request: the request to handle
+        :type request: aiohttp.Request
+        :param key: Cache key identifying the resource
+        :type key: tuple
+        :param content_handlers: Content-type => handler mappings, each handler
+            is passed the return value of `fetch`
+        :type content_handlers: dict('content_type': callable)
+        :param fetch: Coroutine function returning the data to render
+        :type fetch: callable
+        :param last_modified: Coroutine function returning the Unix time of
+            the last modification of the resource, or None if unknown
+        :type last_modified: callable
+        :returns: A HTTP response
+        :rtype: aiohttp.web.Response
+        """
+        content_type = self.parse_accept(request, content_handlers.keys())
+        if content_type is None:
+            # Missing Accept: header, pick arbitrary handler
+            content_type = list(content_handlers.keys())[0]
+        key = key + (content_type, )
+        generation = yield from self._directory.generation()
+
+        @asyncio.coroutine
+        def render():
+            """Render and cache the representation"""
+            payload = content_handlers[content_type]((yield from fetch()))
+            modified = None
+            if last_modified is not None:
+                modified = yield from last_modified()
+            representation = Representation(
+                payload.encode('utf-8'), content_type, last_modified=modified)
+            self._cache.put(key, generation, representation)
+            return representation
+
+        representation = self._cache.get(key, generation)
+        if representation is None:
+            representation = yield from self._flights.run(key + (generation, ), render)
+        return self.conditional_response(request, representation)
+
+    def conditional_response(self, request, representation):
+        """Create a response for a representation, honouring any If-None-Match
+        and Accept-Encoding headers in the request
+
+        Bodies of at least :attr:`compression_threshold` bytes are sent with
+        the best content-coding accepted by the client.
+
+        :param request: the request to respond to
+        :type request: aiohttp.Request
+        :param representation: the representation to send
+        :type representation: soa.directory.cache.Representation
+        :returns: A HTTP response, 304 Not Modified if the client already has
+            this representation
+        :rtype: aiohttp.web.Response
+        """
+        body = representation.body
+        etag = representation.etag
+        headers = {
+            'Vary': 'Accept, Accept-Encoding',
+        }
+        if self.compression_threshold is not None and \
+                len(body) >= self.compression_threshold:
+            coding = choose_coding(request.headers.get('ACCEPT-ENCODING'))
+            if coding is not None:
+                body, etag = representation.coded(coding)
+                headers['Content-Encoding'] = coding
+        headers['ETag'] = etag
+        if etag_matches(request.headers.get('IF-NONE-MATCH'), etag):
+            headers.pop('Content-Encoding', None)
+            response = web.Response(status=web.HTTPNotModified.status_code, headers=headers)
+        else:
+            response = web.Response(
+                body=body, headers=headers,
+                content_type=representation.content_type, charset='utf-8')
+        if representation.last_modified is not None:
+            response.last_modified = representation.last_modified
+        return response
 
     @asyncio.coroutine
     def service_list_get(self, request):
@@ -109,8 +482,9 @@ class Server(LogMixin, web.Application):
             'application/json': services.servicelist_to_json,
             'application/xml': services.servicelist_to_xml,
         }
-        slist = self._directory.service_list()
-        return self.dispatch_request(request, content_handlers, slist)
+        return (yield from self.dispatch_cached(
+            request, ('service', ), content_handlers,
+            self._directory.service_list, self._directory.last_modified))
 
     @asyncio.coroutine
     def service_get(self, request):
@@ -122,12 +496,22 @@ class Server(LogMixin, web.Application):
         :rtype: aiohttp.web.Response
         """
         name = request.match_info.get('name', '(null)')
-        service = self._directory.service(name=name)
         content_handlers = {
-            'application/json': service.to_json,
-            'application/xml': service.to_xml,
+            'application/json': services.Service.to_json,
+            'application/xml': services.Service.to_xml,
         }
-        return self.dispatch_request(request, content_handlers)
+
+        @asyncio.coroutine
+        def fetch():
+            """Look up the requested service"""
+            try:
+                return (yield from self._directory.service(name=name))
+            except self._directory.DoesNotExist:
+                raise web.HTTPNotFound()
+
+        return (yield from self.dispatch_cached(
+            request, ('service', name), content_handlers, fetch,
+            lambda: self._directory.last_modified(name=name)))
 
     @asyncio.coroutine
     def type_list_get(self, request):
@@ -142,8 +526,9 @@ class Server(LogMixin, web.Application):
             'application/json': services.typelist_to_json,
             #'application/xml': services.service_to_xml,
         }
-        tlist = self._directory.types()
-        return self.dispatch_request(request, content_handlers, tlist)
+        return (yield from self.dispatch_cached(
+            request, ('type', ), content_handlers,
+            self._directory.types, self._directory.last_modified))
 
     @asyncio.coroutine
     def type_get(self, request):
@@ -159,15 +544,173 @@ class Server(LogMixin, web.Application):
             'application/xml': services.servicelist_to_xml,
         }
         name = request.match_info.get('name', '(null)')
-        slist = self._directory.service_list(type=name)
-        if not slist:
-            raise web.HTTPNotFound()
-        return self.dispatch_request(request, content_handlers, slist)
+
+        @asyncio.coroutine
+        def fetch():
+            """List the services of the requested type"""
+            slist = yield from self._directory.service_list(type=name)
+            if not slist:
+                raise web.HTTPNotFound()
+            return slist
+
+        return (yield from self.dispatch_cached(
+            request, ('type', name), content_handlers, fetch,
+            lambda: self._directory.last_modified(type=name)))
+
+    @asyncio.coroutine
+    def changes_get(self, request):
+        """Generate the list of changes since the generation given in the
+        ``since`` query parameter, see
+        :meth:`soa.directory.directory.ServiceDirectory.changes_since`
+
+        :param request: incoming HTTP request
+        :type request: aiohttp.Request
+        :returns: A HTTP response
+        :rtype: aiohttp.web.Response
+        """
+        try:
+            since = int(request.query['since']) if request.query.get('since') else None
+        except ValueError:
+            raise web.HTTPBadRequest(reason='Invalid since parameter')
+        epoch = request.query.get('epoch')
+        content_handlers = {
+            'application/json': lambda changes: json.dumps(changes.to_json_dict()),
+        }
+        return (yield from self.dispatch_cached(
+            request, ('changes', since, epoch), content_handlers,
+            lambda: self._directory.changes_since(since, epoch=epoch)))
+
+    @asyncio.coroutine
+    def events_get(self, request):
+        """Stream change events to the client as Server-Sent Events
+
+        The stream starts with a ``sync`` event carrying the epoch and
+        generation of the registry. Each change matching the ``type`` and
+        ``name`` query parameters, see :func:`event_filter`, is sent as a
+        ``change`` event in the format of the change feed, without the service
+        description. A client reconnecting with a Last-Event-ID header first
+        receives the changes it missed, or a ``resync`` event if they are not
+        known any more. Comments are sent as heartbeats when the registry is
+        idle.
+
+        Events are only taken from the buffer once the previous one has been
+        written out, pending events for the same service are merged meanwhile.
+
+        :param request: incoming HTTP request
+        :type request: aiohttp.Request
+        :returns: A HTTP response
+        :rtype: aiohttp.web.StreamResponse
+        """
+        matches = event_filter(request.query)
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        })
+        with self._directory.changes(loop=self.loop) as stream:
+            self._event_streams.add(stream)
+            try:
+                yield from response.prepare(request)
+                generation = yield from self._send_missed_events(
+                    request, response, matches)
+                while True:
+                    try:
+                        event = yield from asyncio.wait_for(
+                            stream.get(), self.heartbeat_interval, loop=self.loop)
+                    except asyncio.TimeoutError:
+                        response.write(format_sse(comment='heartbeat'))
+                    else:
+                        if event is None:
+                            break
+                        if event.generation <= generation or \
+                                not matches(event.name, event.types):
+                            continue
+                        entry = ChangeLogEntry.from_event(event)
+                        response.write(format_sse(
+                            json.dumps(entry.to_json_dict()), event='change',
+                            event_id='{}/{}'.format(self._directory.epoch(), entry.sequence)))
+                    yield from response.drain()
+            except ConnectionError:
+                self.log.debug('Event stream client disconnected')
+            finally:
+                self._event_streams.discard(stream)
+        return response
+
+    @asyncio.coroutine
+    def _send_missed_events(self, request, response, matches):
+        """Start an event stream, replaying the changes a reconnecting client
+        missed
+
+        :param request: incoming HTTP request
+        :type request: aiohttp.Request
+        :param response: The event stream
+        :type response: aiohttp.web.StreamResponse
+        :param matches: Event filter, see :func:`event_filter`
+        :type matches: callable
+        :returns: The generation the stream continues from
+        :rtype: int
+        """
+        epoch, _, since = request.headers.get('Last-Event-ID', '').partition('/')
+        try:
+            since = int(since)
+        except ValueError:
+            since = None
+        if since is None:
+            changes = None
+            generation = yield from self._directory.generation()
+        else:
+            changes = yield from self._directory.changes_since(since, epoch=epoch)
+            generation = changes.generation
+        epoch = self._directory.epoch()
+        event_id = '{}/{}'.format(epoch, generation)
+        if changes is not None and changes.resync:
+            response.write(format_sse(
+                json.dumps(changes.to_json_dict()), event='resync', event_id=event_id))
+        else:
+            for entry in changes.changes if changes is not None else ():
+                if matches(entry.name, {entry.type}):
+                    response.write(format_sse(
+                        json.dumps(entry.to_json_dict()), event='change',
+                        event_id='{}/{}'.format(epoch, entry.sequence)))
+            response.write(format_sse(
+                json.dumps({'epoch': epoch, 'generation': generation}), event='sync',
+                event_id=event_id))
+        yield from response.drain()
+        return generation
+
+    @asyncio.coroutine
+    def _close_event_streams(self, app): #pylint: disable=unused-argument
+        """End all event streams when the application shuts down"""
+        for stream in list(self._event_streams):
+            stream.close()
+
+    def check_rate(self, request, slist):
+        """Charge a modification request to the rate limiter
+
+        :param request: incoming HTTP request
+        :type request: aiohttp.Request
+        :param slist: Services to be modified
+        :type slist: list(soa.services.Service)
+        :raises aiohttp.web.HTTPTooManyRequests: if the client is over its
+            limit, with a Retry-After header
+        """
+        if self.rate_limiter is None:
+            return
+        peername = request.transport.get_extra_info('peername') if request.transport else None
+        address = peername[0] if peername else None
+        wait = self.rate_limiter.acquire(self.rate_limiter.keys(address, slist))
+        if wait:
+            self.log.info('Rate limit exceeded by %s', address)
+            raise web.HTTPTooManyRequests(
+                headers={'Retry-After': str(RateLimiter.retry_after(wait))})
 
     @asyncio.coroutine
     def publish_post(self, request):
         """Register a service in the service directory
 
+        A lease lifetime in seconds may be requested with the ``lifetime``
+        query parameter, the effective lifetime is returned in the
+        :data:`LIFETIME_HEADER` header.
+
         :param request: incoming HTTP request
         :type request: aiohttp.Request
         :returns: A HTTP response
@@ -195,17 +738,22 @@ class Server(LogMixin, web.Application):
         if not service.name:
             # bad input
             raise web.HTTPBadRequest(reason='Missing service name')
+        lifetime = parse_lifetime(request)
+        self.check_rate(request, [service])
         try:
-            self._directory.service(name=service.name)
+            yield from self._directory.service(name=service.name)
         except self._directory.DoesNotExist:
             code = web.HTTPCreated.status_code
         else:
             code = web.HTTPOk.status_code
 
-        self._directory.publish(service=service)
+        try:
+            lifetime = yield from self._directory.publish(service=service, lifetime=lifetime)
+        except self._directory.QuotaExceeded as exc:
+            raise web.HTTPForbidden(reason=str(exc))
         payload = 'Publish OK'
         return web.Response(
-            body=payload.encode('utf-8'), status=code,
+            body=payload.encode('utf-8'), status=code, headers={LIFETIME_HEADER: str(lifetime)},
             content_type='text/plain', charset='utf-8')
 
     @asyncio.coroutine
@@ -240,9 +788,10 @@ class Server(LogMixin, web.Application):
         if not name:
             # bad input
             raise web.HTTPBadRequest(reason='Missing service name')
+        self.check_rate(request, [service])
 
         try:
-            self._directory.unpublish(name=name)
+            yield from self._directory.unpublish(name=name)
         except self._directory.DoesNotExist:
             self.log.info('Service %s is not published', name)
             raise web.HTTPBadRequest(reason='Service %s is not published' % (name, ))
@@ -253,6 +802,81 @@ class Server(LogMixin, web.Application):
             body=payload.encode('utf-8'), status=code,
             content_type='text/plain', charset='utf-8')
 
+    @asyncio.coroutine
+    def _parse_servicelist(self, request):
+        """Parse the service list body of a bulk request
+
+        :param request: incoming HTTP request
+        :type request: aiohttp.Request
+        :returns: The services, and the encoder for the response
+        :rtype: tuple(list(soa.services.Service), callable)
+        """
+        content_handlers = {
+            'application/json': (services.servicelist_from_json, services.statuslist_to_json),
+            'application/xml': (services.servicelist_from_xml, services.statuslist_to_xml),
+        }
+        try:
+            handler, encoder = content_handlers[request.content_type]
+        except KeyError:
+            self.log.info('Unhandled Content-Type: %s', request.content_type)
+            raise web.HTTPUnsupportedMediaType(
+                reason='Unhandled Content-Type: %s' % request.content_type)
+
+        try:
+            text = yield from request.text()
+            slist = handler(text)
+        except (ValueError, services.ServiceError):
+            # bad input
+            raise web.HTTPBadRequest(reason='Invalid data, expected service list')
+        return slist, encoder
+
+    @asyncio.coroutine
+    def bulk_publish_post(self, request):
+        """Register a list of services in the service directory as one batch
+
+        The lease lifetime requested with the ``lifetime`` query parameter
+        applies to all services. The response lists the status and lifetime
+        of each service, see :func:`soa.directory.asyncdir.publish_batch`.
+
+        :param request: incoming HTTP request
+        :type request: aiohttp.Request
+        :returns: A HTTP response
+        :rtype: aiohttp.web.Response
+        """
+        lifetime = parse_lifetime(request)
+        slist, encoder = yield from self._parse_servicelist(request)
+        self.check_rate(request, slist)
+        try:
+            statuses = yield from publish_batch(self._directory, slist, lifetime)
+        except self._directory.QuotaExceeded as exc:
+            raise web.HTTPForbidden(reason=str(exc))
+        self.log.info('Bulk publish of %u services', len(slist))
+        return web.Response(
+            body=encoder(statuses).encode('utf-8'), content_type=request.content_type,
+            charset='utf-8')
+
+    @asyncio.coroutine
+    def bulk_unpublish_post(self, request):
+        """De-register a list of services in the service directory as one
+        batch
+
+        Only the names of the services are used. The response lists the
+        status of each service, see
+        :func:`soa.directory.asyncdir.unpublish_batch`.
+
+        :param request: incoming HTTP request
+        :type request: aiohttp.Request
+        :returns: A HTTP response
+        :rtype: aiohttp.web.Response
+        """
+        slist, encoder = yield from self._parse_servicelist(request)
+        self.check_rate(request, slist)
+        statuses = yield from unpublish_batch(self._directory, [srv.name for srv in slist])
+        self.log.info('Bulk unpublish of %u services', len(slist))
+        return web.Response(
+            body=encoder(statuses).encode('utf-8'), content_type=request.content_type,
+            charset='utf-8')
+
     def copy(self):
         """Disable copying"""
         raise NotImplementedError
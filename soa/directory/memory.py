@@ -0,0 +1,234 @@
+"""In-memory service directory backend
+
+:class:`MemoryServiceDirectory` keeps the registry in a dict and implements
+:class:`soa.directory.asyncdir.AsyncDirectory` natively, as none of its
+operations block. The registry is lost when the process exits, which suits
+test setups and deployments where publishers renew their services anyway.
+"""
+import re
+import asyncio
+import collections
+import copy
+
+from .. import LogMixin
+from ..services import Service as AHService
+from .asyncdir import AsyncDirectory
+from .directory import RECORD_METADATA, ChangeEvent, DirectoryException, RegistryMixin, \
+    effective_lifetime, unix_now
+
+__all__ = [
+    'MemoryServiceDirectory',
+    'record_matches',
+    ]
+
+def _regex(value, pattern):
+    """Match a string value against a regular expression"""
+    return isinstance(value, str) and re.match(pattern, value) is not None
+
+def _compare(compare):
+    """Make an operator which is false for missing values"""
+    return lambda value, operand: value is not None and compare(value, operand)
+
+OPERATORS = {
+    '$regex': _regex,
+    '$lt': _compare(lambda value, operand: value < operand),
+    '$lte': _compare(lambda value, operand: value <= operand),
+    '$gt': _compare(lambda value, operand: value > operand),
+    '$gte': _compare(lambda value, operand: value >= operand),
+    '$ne': lambda value, operand: value != operand,
+    '$in': lambda value, operand: value in operand,
+}
+"""Query operators supported by :func:`record_matches`, with the same meaning
+as in blitzdb"""
+
+def record_matches(record, criteria):
+    """Evaluate blitzdb style search criteria against a service record
+
+    Keys may name nested values with dots, e.g. ``properties.version``. Values
+    are compared for equality, or are dicts of :data:`OPERATORS` and operands.
+
+    :param record: Service record
+    :type record: dict
+    :param criteria: Search criteria
+    :type criteria: dict
+    :returns: True if the record matches all criteria
+    :rtype: bool
+    :raises soa.directory.directory.DirectoryException: for unsupported
+        operators
+    """
+    for key, condition in criteria.items():
+        value = record
+        for part in key.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for operator, operand in condition.items():
+            try:
+                matches = OPERATORS[operator]
+            except KeyError:
+                raise DirectoryException('Unsupported operator: {}'.format(operator))
+            if not matches(value, operand):
+                return False
+    return True
+
+class MemoryServiceDirectory(RegistryMixin, LogMixin, AsyncDirectory):
+    """Service directory keeping the registry in memory
+
+    The behaviour is the same as that of
+    :class:`soa.directory.directory.ServiceDirectory`, including lifetimes,
+    generations and change events, as both share the bookkeeping of
+    :class:`soa.directory.directory.RegistryMixin`.
+    """
+
+    def __init__(self, *args, config=None, **kwargs):
+        """Constructor
+
+        :param config: Configuration values overriding :attr:`config_defaults`
+        :type config: dict
+        """
+        super().__init__(*args, **kwargs)
+        self._records = collections.OrderedDict()
+        self._init_registry(config)
+
+    def _find_next_deadline(self):
+        """Find the deadline of the service which will time out first"""
+        return min((record['deadline'] for record in self._records.values()), default=None)
+
+    def _prune(self):
+        """Delete all service entries that have timed out"""
+        now = unix_now()
+        if not self._expiry_due(now):
+            return
+        expired = [record for record in self._records.values() if record['deadline'] < now]
+        for record in expired:
+            del self._records[record['name']]
+        self._next_deadline = self._find_next_deadline()
+        for record in expired:
+            self._changed(ChangeEvent(ChangeEvent.EXPIRE, record['name'], type=record['type']))
+
+    def _find_active(self, search):
+        """Find the records of all services matching the given criteria which
+        have not yet timed out"""
+        now = unix_now()
+        return [record for record in self._records.values()
+                if record['deadline'] >= now and record_matches(record, search)]
+
+    @staticmethod
+    def _to_service(record):
+        """Create a service from a record, without the metadata"""
+        srv = copy.deepcopy(record)
+        for key in RECORD_METADATA:
+            srv.pop(key, None)
+        return AHService(**srv)
+
+    @asyncio.coroutine
+    def generation(self):
+        self._prune()
+        return self._generation
+
+    @asyncio.coroutine
+    def changes_since(self, since, epoch=None):
+        return self._change_set(since, epoch, (yield from self.generation()))
+
+    @asyncio.coroutine
+    def prune_old_services(self):
+        self._prune()
+
+    @asyncio.coroutine
+    def publish(self, *, service, lifetime=None):
+        results = yield from self.publish_many(services=[service], lifetimes=[lifetime])
+        return results[0][1]
+
+    @asyncio.coroutine
+    def unpublish(self, *, name):
+        found = yield from self.unpublish_many(names=[name])
+        if not found[0]:
+            raise self.DoesNotExist('Not found: {}'.format(name))
+
+    @asyncio.coroutine
+    def publish_many(self, *, services, lifetimes=None):
+        """Publish several services in the registry as one batch, see
+        :meth:`soa.directory.directory.ServiceDirectory.publish_many`
+
+        The batch is admitted as a whole before the registry is modified, so
+        a rejected batch leaves the registry unchanged. Timed out services are
+        pruned once for the whole batch.
+        """
+        evicted = self._admit(
+            lambda: {record['name']: record for record in self._find_active({})}, services)
+        removed = []
+        for record in evicted:
+            del self._records[record['name']]
+            removed.append(record['deadline'])
+        now = unix_now()
+        results = []
+        events = []
+        for service, lifetime in zip(services, lifetimes or [None] * len(services)):
+            record = service.to_dict()
+            old_record = self._records.pop(service.name, None)
+            old_type = None
+            renewal = False
+            if old_record is not None:
+                removed.append(old_record['deadline'])
+                if old_record['type'] != service.type:
+                    old_type = old_record['type']
+                renewal = self._to_service(old_record) == self._to_service(record)
+                if lifetime is None:
+                    lifetime = old_record['lifetime']
+            lifetime = effective_lifetime(self._get_config_value, service.type, lifetime)
+            record['updated'] = now
+            record['deadline'] = now + lifetime
+            record['lifetime'] = lifetime
+            self.log.debug('publish: %r', record)
+            self._records[service.name] = record
+            results.append((old_record is not None, lifetime))
+            events.append((ChangeEvent(
+                ChangeEvent.PUBLISH, service.name, type=service.type, old_type=old_type,
+                renewal=renewal), self._to_service(record), lifetime))
+        self._track_deadlines(removed, [now + lifetime for _, lifetime in results])
+        self._prune()
+        for record in evicted:
+            self._changed(ChangeEvent(ChangeEvent.EVICT, record['name'], type=record['type']))
+        for event, service, lifetime in events:
+            self._changed(event, service, lifetime)
+        return results
+
+    @asyncio.coroutine
+    def unpublish_many(self, *, names):
+        """De-register several services in the registry as one batch, see
+        :meth:`soa.directory.directory.ServiceDirectory.unpublish_many`"""
+        found = []
+        removed = []
+        for name in names:
+            record = self._records.pop(name, None)
+            found.append(record is not None)
+            if record is not None:
+                self.log.debug('unpublish: %s', name)
+                removed.append(record)
+        self._track_deadlines([record['deadline'] for record in removed])
+        self._prune()
+        for record in removed:
+            self._changed(ChangeEvent(ChangeEvent.UNPUBLISH, record['name'], type=record['type']))
+        return found
+
+    @asyncio.coroutine
+    def service(self, *, name):
+        try:
+            record = self._records[name]
+        except KeyError:
+            raise self.DoesNotExist('Not found: {}'.format(name))
+        return self._to_service(record)
+
+    @asyncio.coroutine
+    def service_list(self, **search):
+        return [self._to_service(record) for record in self._find_active(search)]
+
+    @asyncio.coroutine
+    def last_modified(self, **search):
+        return max((record['updated'] for record in self._find_active(search)), default=None)
+
+    @asyncio.coroutine
+    def types(self):
+        return {record['type'] for record in self._find_active({})}
@@ -0,0 +1,217 @@
+"""CoAP multicast discovery responder
+
+Clients which do not know the address of the service directory can find it by
+sending a multicast GET for ``/.well-known/core``, or for the services of a
+type, to the All-CoAP-Nodes groups (:rfc:`7252#section-12.8`). The responder
+listens on the multicast groups with sockets of its own, separate from the
+unicast server context but bound to the same port, which the context of
+:func:`soa.directory.coap.create_server_context` shares. It answers as
+recommended by :rfc:`7252#section-8.2`: responses are delayed by a random
+time within the leisure period, and requests which would get an error or an
+empty answer are not answered at all.
+"""
+
+import json
+import logging
+import random
+import socket
+import struct
+import asyncio
+import xml.etree.ElementTree as ET
+
+import aiocoap
+from aiocoap.numbers import media_types_rev
+from aiocoap.numbers.codes import Code
+from aiocoap.numbers.constants import COAP_PORT
+from aiocoap.numbers.types import Type
+
+from .. import LogMixin
+from .coapsite import RouteNode
+
+__all__ = [
+    'ALL_COAP_NODES',
+    'MulticastResponder',
+    'create_multicast_responders',
+    'is_empty_response',
+    'multicast_socket',
+    ]
+
+ALL_COAP_NODES = ('ff02::fd', 'ff05::fd', '224.0.1.187')
+"""All-CoAP-Nodes multicast addresses: IPv6 link-local and site-local scope,
+and IPv4"""
+
+DEFAULT_LEISURE = 5.0
+"""Default leisure period in seconds, see :rfc:`7252#section-8.2`"""
+
+def is_empty_response(response):
+    """Check if a response has nothing to tell a multicast client
+
+    :param response: Response to check
+    :type response: aiocoap.Message
+    :returns: True if the payload is empty, or is an empty list in any of the
+        formats rendered by the directory
+    :rtype: bool
+    """
+    payload = response.payload.strip()
+    if not payload:
+        return True
+    try:
+        if response.opt.content_format == media_types_rev['application/json']:
+            document = json.loads(payload.decode('utf-8'))
+            return isinstance(document, dict) and \
+                not any(value for value in document.values())
+        if response.opt.content_format == media_types_rev['application/xml']:
+            return len(ET.fromstring(payload)) == 0
+    except (ValueError, ET.ParseError):
+        pass
+    return False
+
+def multicast_socket(group, port, interface=None):
+    """Create a UDP socket which has joined a multicast group
+
+    The socket is bound to the group address, so it receives only requests
+    sent to the group, while responses are sent from a unicast address chosen
+    by the kernel. It is bound with ``SO_REUSEADDR`` and ``SO_REUSEPORT``, to
+    share the port with a unicast server socket bound with either of them.
+
+    :param group: Multicast group address
+    :type group: string
+    :param port: UDP port to listen on
+    :type port: int
+    :param interface: Name of the network interface to join the group on,
+        default is to let the kernel choose
+    :type interface: string
+    :returns: A bound, non-blocking socket
+    :rtype: socket.socket
+    """
+    ifindex = socket.if_nametoindex(interface) if interface else 0
+    family = socket.AF_INET6 if ':' in group else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            sock.bind((group, port, 0, ifindex))
+            mreq = socket.inet_pton(family, group) + struct.pack('@I', ifindex)
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+        else:
+            sock.bind((group, port))
+            # struct ip_mreqn: group, local address, interface index
+            mreq = socket.inet_aton(group) + socket.inet_aton('0.0.0.0') + \
+                struct.pack('@i', ifindex)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+class MulticastResponder(LogMixin, asyncio.DatagramProtocol):
+    """Answer discovery requests received on a multicast socket
+
+    Requests are rendered by the same site as unicast requests, so the cached
+    representations and query filters of the site apply.
+    """
+
+    def __init__(self, site, paths, *args, leisure=DEFAULT_LEISURE, loop=None, **kwargs):
+        """Constructor
+
+        :param site: Site rendering the requests
+        :type site: soa.directory.coapsite.Site
+        :param paths: Resource paths which are answered, may contain
+            :class:`soa.directory.coapsite.PathRegex` components
+        :type paths: iterable(tuple)
+        :param leisure: Responses are delayed by a random time of up to this
+            many seconds, to avoid flooding the requester with responses from
+            every node at once
+        :type leisure: float
+        """
+        super().__init__(*args, **kwargs)
+        self.site = site
+        self.leisure = leisure
+        self.transport = None
+        self._loop = loop or asyncio.get_event_loop()
+        self._routes = RouteNode()
+        for path in paths:
+            self._routes.insert(tuple(path), True)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            request = aiocoap.Message.decode(data, addr)
+        except aiocoap.error.UnparsableMessage:
+            self.log.debug('Ignoring unparsable multicast message from %r', addr)
+            return
+        if request.code != Code.GET or not self._routes.lookup(tuple(request.opt.uri_path)):
+            self.log.debug('Ignoring multicast request %r from %r', request, addr)
+            return
+        self._loop.create_task(self.respond(request, addr))
+
+    def error_received(self, exc):
+        self.log.warning('Multicast socket error: %r', exc)
+
+    @asyncio.coroutine
+    def respond(self, request, addr):
+        """Render a multicast request and send the response after a random
+        delay, unless the response would be an error or empty
+
+        :param request: The inbound request
+        :type request: aiocoap.Message
+        :param addr: Address of the requester
+        :type addr: tuple
+        """
+        try:
+            response = yield from self.site.render(request)
+        except aiocoap.error.Error as exc:
+            self.log.debug('Suppressing error response to multicast request: %r', exc)
+            return
+        if response.code != Code.CONTENT or is_empty_response(response):
+            self.log.debug('Suppressing empty response to multicast request')
+            return
+        yield from asyncio.sleep(random.uniform(0, self.leisure), loop=self._loop)
+        response.mtype = Type.NON
+        response.mid = random.randint(0, 0xffff)
+        response.token = request.token
+        self.log.debug('Responding to multicast request from %r', addr)
+        self.transport.sendto(response.encode(), addr)
+
+@asyncio.coroutine
+def create_multicast_responders(site, paths, *, groups=ALL_COAP_NODES, port=COAP_PORT,
+                                interface=None, leisure=DEFAULT_LEISURE, loop=None):
+    """Join multicast groups and answer discovery requests sent to them
+
+    Groups which can not be joined, e.g. IPv6 groups on a host without IPv6
+    multicast routes, are skipped with a warning.
+
+    :param site: Site rendering the requests
+    :type site: soa.directory.coapsite.Site
+    :param paths: Resource paths which are answered, see
+        :class:`MulticastResponder`
+    :type paths: iterable(tuple)
+    :param groups: Multicast groups to join
+    :type groups: iterable(string)
+    :param port: UDP port to listen on
+    :type port: int
+    :param interface: Name of the network interface to join the groups on
+    :type interface: string
+    :param leisure: Leisure period in seconds
+    :type leisure: float
+    :returns: The datagram transports, one per joined group
+    :rtype: list(asyncio.DatagramTransport)
+    """
+    loop = loop or asyncio.get_event_loop()
+    paths = list(paths)
+    transports = []
+    for group in groups:
+        try:
+            sock = multicast_socket(group, port, interface)
+        except OSError as exc:
+            logging.getLogger(__name__).warning(
+                'Could not join multicast group %s: %r', group, exc)
+            continue
+        transport, _ = yield from loop.create_datagram_endpoint(
+            lambda: MulticastResponder(site, paths, leisure=leisure, loop=loop), sock=sock)
+        transports.append(transport)
+    return transports
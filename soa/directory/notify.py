@@ -0,0 +1,236 @@
+"""Asynchronous dispatch of change events to subscribers
+
+Notify callbacks registered with
+:meth:`soa.directory.directory.ServiceDirectory.add_notify_callback` run
+inside the modification which caused the change, so a slow subscriber delays
+every write, and is reported as such by
+:func:`soa.directory.directory.call_notify`. :class:`NotifyDispatcher` decouples a subscriber from the
+writes: events are put in a bounded :class:`EventBuffer`, and a task of its
+own passes them on to the subscriber. When a subscriber falls behind, the
+buffer merges or drops events according to its policy, instead of growing
+without bound.
+"""
+import asyncio
+import collections
+import itertools
+
+from .. import LogMixin
+from .directory import ChangeEvent
+
+__all__ = [
+    'DROP_NEWEST',
+    'DROP_OLDEST',
+    'EventBuffer',
+    'MERGE',
+    'NotifyDispatcher',
+    'merge_events',
+    ]
+
+MERGE = 'merge'
+"""Buffer policy: a pending event for the same service is replaced by the new
+one, the oldest event is dropped if the buffer is still full"""
+DROP_OLDEST = 'drop-oldest'
+"""Buffer policy: the oldest pending event is dropped when the buffer is full"""
+DROP_NEWEST = 'drop-newest'
+"""Buffer policy: new events are dropped when the buffer is full"""
+
+DEFAULT_MAXSIZE = 1024
+"""Default number of events buffered per subscriber"""
+
+def merge_events(earlier, later):
+    """Combine two change events of the same service into one
+
+    The result describes the final state of the service, and keeps the type
+    the service had before the earlier change, if it was different. It is a
+    renewal only if both changes were renewals.
+
+    :param earlier: The earlier event
+    :type earlier: soa.directory.directory.ChangeEvent
+    :param later: The later event
+    :type later: soa.directory.directory.ChangeEvent
+    :rtype: soa.directory.directory.ChangeEvent
+    """
+    old_type = later.old_type
+    if old_type is None:
+        for stype in (earlier.old_type, earlier.type):
+            if stype is not None and stype != later.type:
+                old_type = stype
+                break
+    return ChangeEvent(later.kind, later.name, type=later.type, old_type=old_type,
+                       generation=later.generation,
+                       renewal=earlier.renewal and later.renewal)
+
+class EventBuffer(object):
+    """Bounded queue of change events for a single consumer"""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, policy=MERGE, *, loop=None):
+        """Constructor
+
+        :param maxsize: Maximum number of pending events, None for no limit
+        :type maxsize: int
+        :param policy: What to do when events arrive faster than they are
+            consumed, one of :data:`MERGE`, :data:`DROP_OLDEST` and
+            :data:`DROP_NEWEST`
+        :type policy: string
+        :param loop: Event loop, default is the loop of the consumer
+        :type loop: asyncio.AbstractEventLoop
+        """
+        if policy not in (MERGE, DROP_OLDEST, DROP_NEWEST):
+            raise ValueError('Unknown buffer policy: {}'.format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.stats = collections.Counter()
+        self._loop = loop
+        self._events = collections.OrderedDict()
+        self._keys = itertools.count()
+        self._waiter = None
+        self._closed = False
+
+    def qsize(self):
+        """Get the number of pending events
+
+        :rtype: int
+        """
+        return len(self._events)
+
+    def put_nowait(self, event):
+        """Add an event, applying the buffer policy
+
+        :param event: The event to add
+        :type event: soa.directory.directory.ChangeEvent
+        :returns: False if the event was dropped
+        :rtype: bool
+        """
+        if self._closed:
+            return False
+        self.stats['events'] += 1
+        if self.policy == MERGE:
+            key = event.name
+            earlier = self._events.pop(key, None)
+            if earlier is not None:
+                event = merge_events(earlier, event)
+                self.stats['merged'] += 1
+        else:
+            key = next(self._keys)
+        if self.maxsize is not None and len(self._events) >= self.maxsize:
+            self.stats['dropped'] += 1
+            if self.policy == DROP_NEWEST:
+                return False
+            self._events.popitem(last=False)
+        self._events[key] = event
+        self._wake()
+        return True
+
+    def _wake(self):
+        """Wake up the waiting consumer"""
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    @asyncio.coroutine
+    def get(self):
+        """Wait for the next event
+
+        :returns: The oldest pending event, or None once the buffer is closed
+            and empty
+        :rtype: soa.directory.directory.ChangeEvent
+        """
+        while not self._events:
+            if self._closed:
+                return None
+            self._waiter = asyncio.Future(loop=self._loop or asyncio.get_event_loop())
+            try:
+                yield from self._waiter
+            finally:
+                self._waiter = None
+        return self._events.popitem(last=False)[1]
+
+    def close(self):
+        """Stop accepting events, :meth:`get` returns the pending events and
+        then None"""
+        self._closed = True
+        self._wake()
+
+class NotifyDispatcher(LogMixin, object):
+    """Notify callback wrapper passing events on from a task of its own
+
+    An instance is registered as a notify callback in place of the wrapped
+    callback, see :meth:`soa.directory.asyncdir.AsyncDirectory.subscribe`.
+    The wrapped callback may also be a coroutine function. Exceptions raised
+    by it are logged and counted, and do not affect the directory or other
+    subscribers. The time spent in the callback is measured.
+    """
+
+    def __init__(self, callback, *, maxsize=DEFAULT_MAXSIZE, policy=MERGE, loop=None):
+        """Constructor
+
+        :param callback: Callback to pass the events to
+        :type callback: callable(ChangeEvent)
+        :param maxsize: Maximum number of events waiting for the callback
+        :type maxsize: int
+        :param policy: Buffer policy, see :class:`EventBuffer`
+        :type policy: string
+        :param loop: Event loop to run the dispatch task on
+        :type loop: asyncio.AbstractEventLoop
+        """
+        super().__init__()
+        self.callback = callback
+        self.buffer = EventBuffer(maxsize, policy, loop=loop)
+        self.stats = self.buffer.stats
+        self.max_callback_time = 0.0
+        self._loop = loop or asyncio.get_event_loop()
+        self._task = asyncio.ensure_future(self._run(), loop=self._loop)
+
+    def __call__(self, event):
+        """Queue an event for the callback
+
+        :param event: Description of the change
+        :type event: soa.directory.directory.ChangeEvent
+        """
+        if not self.buffer.put_nowait(event):
+            self.log.debug('Dropped %r for %r', event, self.callback)
+
+    @asyncio.coroutine
+    def _run(self):
+        """Pass the buffered events on to the callback"""
+        while True:
+            event = yield from self.buffer.get()
+            if event is None:
+                return
+            start = self._loop.time()
+            try:
+                result = self.callback(event)
+                if asyncio.iscoroutine(result):
+                    yield from result
+            except asyncio.CancelledError:
+                raise
+            except Exception: #pylint: disable=broad-except
+                self.stats['errors'] += 1
+                self.log.exception('Notify callback %r failed', self.callback)
+            elapsed = self._loop.time() - start
+            self.stats['calls'] += 1
+            self.stats['callback_time'] += elapsed
+            self.max_callback_time = max(self.max_callback_time, elapsed)
+
+    @property
+    def pending(self):
+        """Number of events waiting for the callback"""
+        return self.buffer.qsize()
+
+    @property
+    def mean_callback_time(self):
+        """Average time spent in the callback per event in seconds, or None if
+        the callback has not been called yet"""
+        if not self.stats['calls']:
+            return None
+        return self.stats['callback_time'] / self.stats['calls']
+
+    @asyncio.coroutine
+    def close(self):
+        """Pass on the pending events, then stop the dispatch task"""
+        self.buffer.close()
+        yield from self._task
+
+    def cancel(self):
+        """Stop the dispatch task right away, dropping pending events"""
+        self.buffer.close()
+        self._task.cancel()
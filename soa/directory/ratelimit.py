@@ -0,0 +1,148 @@
+"""Rate limiting of modifications per client
+
+Every publish or unpublish request commits to the registry and notifies all
+subscribers, so a publisher stuck in a crash loop can keep the directory
+busy. :class:`RateLimiter` gives every client a token bucket: a request takes
+one token per service, and the tokens are refilled at a fixed rate up to the
+burst size. Requests arriving at an empty bucket are refused, and the client
+is told when to retry.
+"""
+import collections
+import math
+import time
+
+from .cache import LRUCache
+
+__all__ = [
+    'BY_ADDRESS',
+    'BY_HOST',
+    'RateLimiter',
+    'TokenBucket',
+    ]
+
+BY_ADDRESS = 'address'
+"""Key policy: requests are limited per client address"""
+BY_HOST = 'host'
+"""Key policy: requests are limited per service host, requests for services
+without a host are limited per client address"""
+
+class TokenBucket(object): # pylint: disable=too-few-public-methods
+    """Token bucket of a single client"""
+
+    def __init__(self, burst, now):
+        """Constructor
+
+        :param burst: Initial number of tokens
+        :type burst: float
+        :param now: Current time in seconds
+        :type now: float
+        """
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, rate, burst, now):
+        """Add the tokens accumulated since the last refill
+
+        :param rate: Tokens added per second
+        :type rate: float
+        :param burst: Maximum number of tokens
+        :type burst: float
+        :param now: Current time in seconds
+        :type now: float
+        """
+        self.tokens = min(burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+
+class RateLimiter(object):
+    """Token bucket rate limiter keyed by client
+
+    A request is admitted if the buckets of all its keys hold at least one
+    token, and then takes one token per service. A batch larger than the
+    bucket leaves it in debt, so the client has to wait correspondingly longer
+    before its next request.
+
+    The buckets are kept in a :class:`soa.directory.cache.LRUCache`, so the
+    state is bounded by `maxsize` clients. A client whose bucket was dropped
+    starts again with a full bucket.
+    """
+
+    def __init__(self, rate, burst=10, *, key=BY_ADDRESS, maxsize=4096, clock=time.monotonic):
+        """Constructor
+
+        :param rate: Sustained number of services per second and client
+        :type rate: float
+        :param burst: Number of services a client may send at once
+        :type burst: float
+        :param key: What to limit requests by, :data:`BY_ADDRESS` or
+            :data:`BY_HOST`
+        :type key: string
+        :param maxsize: Maximum number of clients to keep track of
+        :type maxsize: int
+        :param clock: Function returning the current time in seconds
+        :type clock: callable
+        """
+        if rate <= 0 or burst < 1:
+            raise ValueError('Rate must be positive and burst at least 1')
+        if key not in (BY_ADDRESS, BY_HOST):
+            raise ValueError('Unknown rate limit key: {}'.format(key))
+        self.rate = rate
+        self.burst = burst
+        self.key = key
+        self.stats = collections.Counter()
+        self._clock = clock
+        self._buckets = LRUCache(maxsize=maxsize)
+
+    def keys(self, address, slist):
+        """Get the keys to charge a request to, one per service
+
+        :param address: Address of the client
+        :type address: string
+        :param slist: Services of the request
+        :type slist: list(soa.services.Service)
+        :rtype: list
+        """
+        if self.key == BY_HOST:
+            return [srv.host or address for srv in slist]
+        return [address] * len(slist)
+
+    def acquire(self, keys):
+        """Take tokens for a request
+
+        Nothing is taken if the request is refused.
+
+        :param keys: Keys to charge the request to, one token is taken per
+            occurrence of a key
+        :type keys: list
+        :returns: 0 if the request is admitted, otherwise the number of
+            seconds until it would be admitted
+        :rtype: float
+        """
+        now = self._clock()
+        costs = collections.Counter(keys)
+        buckets = {}
+        wait = 0.0
+        for key in costs:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.burst, now)
+                self._buckets.put(key, bucket)
+            bucket.refill(self.rate, self.burst, now)
+            buckets[key] = bucket
+            wait = max(wait, (1 - bucket.tokens) / self.rate)
+        if wait > 0:
+            self.stats['limited'] += 1
+            return wait
+        for key, cost in costs.items():
+            buckets[key].tokens -= cost
+        self.stats['admitted'] += 1
+        return 0.0
+
+    @staticmethod
+    def retry_after(wait):
+        """Round a waiting time up to whole seconds, as sent to clients
+
+        :param wait: Waiting time in seconds, see :meth:`acquire`
+        :type wait: float
+        :rtype: int
+        """
+        return max(1, math.ceil(wait))
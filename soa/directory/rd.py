@@ -0,0 +1,409 @@
+"""CoRE Resource Directory (:rfc:`9176`) interface to the service directory
+
+The resource directory lets off-the-shelf CoAP clients register and look up
+services using CoRE Link-format (:rfc:`6690`) instead of the Arrowhead JSON
+and XML representations. It is backed by the same
+:class:`soa.directory.directory.ServiceDirectory` as the other front ends:
+
+- A registered endpoint is stored as a service named after the endpoint
+  (``ep``), with the sector (``d``) as domain, the endpoint type (``et``) as
+  service type and the host and port taken from the ``base`` URI. The
+  registered links are kept in the ``rd-links`` service property.
+- Services published through the Arrowhead interfaces are looked up as
+  endpoints with a single resource, the link given by
+  :meth:`soa.services.Service.to_corelf`. They can not be replaced, updated
+  or removed through the registration interface.
+"""
+
+import asyncio
+from urllib.parse import urlsplit
+
+import link_header
+
+import aiocoap
+from aiocoap.numbers import media_types_rev
+from aiocoap.numbers.codes import Code
+
+from .. import LogMixin
+from .. import services
+from .cache import Representation, RepresentationCache
+from .coapsite import (
+    BadRequestError, ForbiddenError, NotAcceptableError, NotFoundError,
+    UnsupportedMediaTypeError, PathRegex, Resource, attributes_match, parse_lifetime,
+    parse_query, query_to_search)
+
+__all__ = [
+    'ResourceDirectory',
+    'endpoint_attributes',
+    'is_registration',
+    'service_base',
+    'service_links',
+    ]
+
+LINK_FORMAT = media_types_rev['application/link-format']
+
+RD_LINKS_PROPERTY = 'rd-links'
+"""Service property holding the links registered by an endpoint"""
+
+RD_BASE_PROPERTY = 'rd-base'
+"""Service property holding the base URI registered by an endpoint"""
+
+DEFAULT_ENDPOINT_TYPE = 'core.rd-ep'
+"""Service type of endpoints registering without an endpoint type"""
+
+ENDPOINT_ATTRIBUTES = {'ep': 'name', 'd': 'domain', 'et': 'type'}
+"""Endpoint attributes which are stored as service attributes, and which
+lookups therefore can evaluate against the directory indexes"""
+
+PAGING_PARAMETERS = ('page', 'count')
+
+DEFAULT_LIFETIME = 90000
+"""Lifetime of registrations without an ``lt`` parameter in seconds,
+:rfc:`9176#section-5.3`. Like requested lifetimes, it is bounded by the
+``max_lifetime`` of the directory."""
+
+def service_base(service):
+    """Get the base URI of the resources of a service
+
+    :param service: The service
+    :type service: soa.services.Service
+    :rtype: string
+    """
+    base = getattr(service.properties, RD_BASE_PROPERTY, None)
+    if base:
+        return base
+    host = str(service.host)
+    if ':' in host:
+        # assume IPv6 address, wrap in brackets for URL construction
+        host = '[{}]'.format(host)
+    if service.port:
+        return 'coap://{}:{}'.format(host, service.port)
+    return 'coap://{}'.format(host)
+
+def endpoint_attributes(service):
+    """Get the link attributes describing a service as an endpoint
+
+    :param service: The service
+    :type service: soa.services.Service
+    :returns: Attribute name, value pairs
+    :rtype: list(list(string, string))
+    """
+    attributes = [['ep', service.name]]
+    if service.domain:
+        attributes.append(['d', service.domain])
+    if service.type:
+        attributes.append(['et', service.type])
+    attributes.append(['base', service_base(service)])
+    return attributes
+
+def service_links(service):
+    """Get the links to the resources of a service
+
+    :param service: The service
+    :type service: soa.services.Service
+    :returns: The links, relative to :func:`service_base`
+    :rtype: list(link_header.Link)
+    """
+    registered = getattr(service.properties, RD_LINKS_PROPERTY, None)
+    if registered is not None:
+        return link_header.parse(registered).links
+    path = getattr(service.properties, 'path', '/')
+    if path and path[0] != '/':
+        path = '/' + path
+    return [link_header.Link(path, [list(pair) for pair in service.corelf_attributes()])]
+
+def is_registration(service):
+    """Check whether a service was registered through the resource directory
+
+    Only these services may be updated or removed through their registration
+    resources, services published through the Arrowhead interfaces are
+    read-only there.
+
+    :param service: The service
+    :type service: soa.services.Service
+    :rtype: bool
+    """
+    return getattr(service.properties, RD_LINKS_PROPERTY, None) is not None
+
+def resolve(base, href):
+    """Resolve a link target against the base URI of its endpoint
+
+    :param base: Base URI
+    :type base: string
+    :param href: Link target
+    :type href: string
+    :returns: Absolute URI
+    :rtype: string
+    """
+    if '://' in href:
+        return href
+    if href.startswith('/'):
+        return base.rstrip('/') + href
+    return base.rstrip('/') + '/' + href
+
+def parse_links(request):
+    """Parse the link-format payload of a registration
+
+    :param request: The inbound CoAP request
+    :type request: aiocoap.Message
+    :returns: The payload as a string, which is validated to be link-format
+    :rtype: string
+    """
+    if request.opt.content_format not in (None, LINK_FORMAT):
+        raise UnsupportedMediaTypeError()
+    try:
+        payload = request.payload.decode('utf-8')
+        link_header.parse(payload)
+    except (UnicodeDecodeError, link_header.ParseException):
+        raise BadRequestError()
+    return payload
+
+class ResourceDirectory(LogMixin, object):
+    """CoRE Resource Directory registration and lookup interfaces
+
+    The interfaces are added to a CoAP site with :meth:`add_resources`.
+    """
+
+    def __init__(self, directory, *args, rd_path=('rd', ), lookup_path=('rd-lookup', ),
+                 **kwargs):
+        """Constructor
+
+        :param directory: Service directory backend
+        :type directory: soa.directory.asyncdir.AsyncDirectory
+        :param rd_path: Path of the registration interface
+        :type rd_path: tuple(strings...)
+        :param lookup_path: Path prefix of the lookup interfaces
+        :type lookup_path: tuple(strings...)
+        """
+        super().__init__(*args, **kwargs)
+        self._directory = directory
+        self.rd_path = tuple(rd_path)
+        self.lookup_path = tuple(lookup_path)
+        self._cache = RepresentationCache()
+
+    def add_resources(self, site):
+        """Add the resource directory interfaces to a site
+
+        :param site: The site to extend
+        :type site: soa.directory.coapsite.Site
+        """
+        register = Resource(post=self._render_register)
+        register.rt = 'core.rd'
+        register.ct = LINK_FORMAT
+        site.add_resource(self.rd_path, register)
+        site.add_resource(self.rd_path + (PathRegex('.+'), ), Resource(
+            get=self._render_registration, post=self._render_update,
+            delete=self._render_remove))
+        lookup_ep = Resource(get=self._render_lookup_ep)
+        lookup_ep.rt = 'core.rd-lookup-ep'
+        lookup_ep.ct = LINK_FORMAT
+        site.add_resource(self.lookup_path + ('ep', ), lookup_ep)
+        lookup_res = Resource(get=self._render_lookup_res)
+        lookup_res.rt = 'core.rd-lookup-res'
+        lookup_res.ct = LINK_FORMAT
+        site.add_resource(self.lookup_path + ('res', ), lookup_res)
+
+    @staticmethod
+    def _apply_base(service, base, request):
+        """Set the host and port of a service from the registration base URI,
+        or from the source address of the registration request"""
+        if base is not None:
+            parts = urlsplit(base)
+            if not parts.scheme or not parts.hostname:
+                raise BadRequestError()
+            service.host = parts.hostname
+            service.port = parts.port
+            setattr(service.properties, RD_BASE_PROPERTY, base)
+        elif service.host is None:
+            remote = request.remote
+            if not isinstance(remote, tuple):
+                # The base URI can not be inferred from the request
+                raise BadRequestError()
+            service.host, service.port = remote[:2]
+
+    @asyncio.coroutine
+    def _render_register(self, request):
+        """POST handler for the registration interface
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        """
+        query = parse_query(request)
+        endpoint = query.get('ep')
+        if not endpoint:
+            raise BadRequestError()
+        lifetime = parse_lifetime(query)
+        if lifetime is None:
+            lifetime = DEFAULT_LIFETIME
+        service = services.Service(
+            name=endpoint, type=query.get('et') or DEFAULT_ENDPOINT_TYPE, domain=query.get('d'),
+            properties={RD_LINKS_PROPERTY: parse_links(request)})
+        self._apply_base(service, query.get('base'), request)
+        try:
+            existing = yield from self._directory.service(name=endpoint)
+        except self._directory.DoesNotExist:
+            existing = None
+        if existing is not None and not is_registration(existing):
+            # Endpoints must not take over services of Arrowhead publishers
+            raise ForbiddenError('Name taken by a service: {}'.format(endpoint))
+        self.log.debug('RD register %r', service)
+        try:
+            yield from self._directory.publish(service=service, lifetime=lifetime)
+        except self._directory.QuotaExceeded as exc:
+            raise ForbiddenError(str(exc))
+        msg = aiocoap.Message(code=Code.CREATED)
+        msg.opt.location_path = self.rd_path + (endpoint, )
+        return msg
+
+    @asyncio.coroutine
+    def _registered_service(self, request, modify=False):
+        """Look up the service behind a registration resource
+
+        :param modify: Whether the request modifies the registration, which
+            is only allowed for services registered as endpoints
+        :type modify: bool
+        """
+        try:
+            service = yield from self._directory.service(name=request.opt.uri_path[-1])
+        except self._directory.DoesNotExist:
+            raise NotFoundError()
+        if modify and not is_registration(service):
+            raise NotFoundError()
+        return service
+
+    @asyncio.coroutine
+    def _render_registration(self, request):
+        """GET handler for registration resources, respond with the
+        registered links
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        """
+        service = yield from self._registered_service(request)
+        msg = aiocoap.Message(code=Code.CONTENT, payload=link_header.format_links(
+            service_links(service)).encode('utf-8'))
+        msg.opt.content_format = LINK_FORMAT
+        return msg
+
+    @asyncio.coroutine
+    def _render_update(self, request):
+        """POST handler for registration resources, refresh a registration
+
+        The registration is published again, which restarts its lifetime.
+        Without an ``lt`` parameter, the previous lifetime is kept. A new base
+        URI may be given in the query, and a non-empty payload replaces the
+        registered links.
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        """
+        query = parse_query(request)
+        lifetime = parse_lifetime(query)
+        service = yield from self._registered_service(request, modify=True)
+        if request.payload:
+            setattr(service.properties, RD_LINKS_PROPERTY, parse_links(request))
+        self._apply_base(service, query.get('base'), request)
+        try:
+            yield from self._directory.publish(service=service, lifetime=lifetime)
+        except self._directory.QuotaExceeded as exc:
+            raise ForbiddenError(str(exc))
+        return aiocoap.Message(code=Code.CHANGED)
+
+    @asyncio.coroutine
+    def _render_remove(self, request):
+        """DELETE handler for registration resources
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        """
+        service = yield from self._registered_service(request, modify=True)
+        try:
+            yield from self._directory.unpublish(name=service.name)
+        except self._directory.DoesNotExist:
+            raise NotFoundError()
+        return aiocoap.Message(code=Code.DELETED)
+
+    @asyncio.coroutine
+    def _lookup(self, request, kind, links):
+        """Respond to a lookup request
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        :param kind: Name of the lookup interface, used as cache key
+        :type kind: string
+        :param links: Callable producing the matching links from the list of
+            candidate services and the filters
+        :type links: callable(list, dict)
+        """
+        if request.opt.accept not in (None, LINK_FORMAT):
+            raise NotAcceptableError()
+        query = parse_query(request)
+        filters = {name: value for name, value in query.items()
+                   if name not in PAGING_PARAMETERS}
+        if any(value is None for value in filters.values()):
+            raise BadRequestError()
+        try:
+            page = int(query.get('page') or 0)
+            count = int(query['count']) if query.get('count') else None
+        except ValueError:
+            raise BadRequestError()
+        if page < 0 or (count is not None and count < 0):
+            raise BadRequestError()
+        key = (kind, ) + tuple(sorted(query.items()))
+        generation = yield from self._directory.generation()
+        representation = self._cache.get(key, generation)
+        if representation is None:
+            search = query_to_search({ENDPOINT_ATTRIBUTES[name]: value
+                                      for name, value in filters.items()
+                                      if name in ENDPOINT_ATTRIBUTES})
+            slist = yield from self._directory.service_list(**search)
+            candidates = sorted(slist, key=lambda srv: srv.name)
+            result = links(candidates, filters)
+            if count is not None:
+                result = result[page * count:(page + 1) * count]
+            representation = Representation(
+                link_header.format_links(result).encode('utf-8'), LINK_FORMAT)
+            self._cache.put(key, generation, representation)
+        msg = aiocoap.Message(code=Code.CONTENT, payload=representation.body)
+        msg.opt.content_format = LINK_FORMAT
+        msg.opt.etag = representation.digest
+        return msg
+
+    @asyncio.coroutine
+    def _render_lookup_ep(self, request):
+        """GET handler for the endpoint lookup interface
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        """
+        def links(candidates, filters):
+            """Link to the registration resource of each matching endpoint"""
+            result = []
+            for service in candidates:
+                attributes = endpoint_attributes(service)
+                if attributes_match(attributes, filters):
+                    href = '/' + '/'.join(self.rd_path + (service.name, ))
+                    result.append(link_header.Link(href, attributes))
+            return result
+        return (yield from self._lookup(request, 'ep', links))
+
+    @asyncio.coroutine
+    def _render_lookup_res(self, request):
+        """GET handler for the resource lookup interface
+
+        :param request: The inbound CoAP request
+        :type request: aiocoap.Message
+        """
+        def links(candidates, filters):
+            """Link to each matching resource of the matching endpoints"""
+            result = []
+            for service in candidates:
+                base = service_base(service)
+                endpoint = endpoint_attributes(service)
+                for link in service_links(service):
+                    href = resolve(base, link.href)
+                    attributes = [pair for pair in link.attr_pairs if pair[0] != 'anchor']
+                    if attributes_match(attributes + endpoint + [['href', href]], filters):
+                        result.append(link_header.Link(href, attributes + [['anchor', base]]))
+            return result
+        return (yield from self._lookup(request, 'res', links))
@@ -0,0 +1,351 @@
+"""Read replicas of a directory served by another process
+
+Several server processes can share one registry: a single writer process owns
+the directory and serves the HTTP front end (see :mod:`soa.directory.http`),
+typically on a Unix socket, and every other process uses a
+:class:`ReplicaDirectory` as its backend. Lookups are answered from a copy of
+the registry kept in memory, which follows the change feed of the writer.
+Modifications are forwarded to the writer.
+
+The replica takes over the epoch and the generation numbers of the writer, so
+representations, entity tags and change feeds are the same whichever process
+a client talks to. A modification made through any process becomes visible in
+all replicas within the sync interval, and right away in the replica it was
+made through.
+"""
+import asyncio
+import collections
+import copy
+import json
+
+import aiohttp
+
+from .. import LogMixin
+from ..services import Service as AHService
+from ..services import servicelist_from_json, servicelist_to_json
+from .asyncdir import AsyncDirectory, DELETED, UPDATED
+from .directory import RECORD_METADATA, ChangeEvent, ChangeLog, ChangeLogEntry, ChangeSet, \
+    DirectoryException, call_notify, unix_now
+from .http import LIFETIME_HEADER
+from .memory import record_matches
+
+__all__ = [
+    'ReplicaDirectory',
+    ]
+
+class ReplicaDirectory(LogMixin, AsyncDirectory):
+    """Directory replicating the registry of a directory HTTP front end
+
+    Call :meth:`start` to load the registry and keep following it. Services
+    are only removed when the writer reports it, so a replica never drops a
+    service the writer still has. Replicas do not apply lifetimes or capacity
+    limits themselves, the writer does.
+    """
+
+    EVENT_KINDS = {operation: kind for kind, operation in ChangeLogEntry.OPERATIONS.items()}
+    """Change event kind of each removal operation of the change feed"""
+
+    def __init__(self, url, *, connector=None, sync_interval=1.0, changelog_size=1024,
+                 loop=None):
+        """Constructor
+
+        :param url: URL of the service directory resources of the writer,
+            e.g. ``http://localhost/servicediscovery``
+        :type url: string
+        :param connector: Connector to reach the writer with, e.g. an
+            :class:`aiohttp.UnixConnector`
+        :type connector: aiohttp.BaseConnector
+        :param sync_interval: Seconds between polls of the change feed of the
+            writer, which is the maximum delay until modifications made
+            through other processes are visible
+        :type sync_interval: float
+        :param changelog_size: Number of changes kept for the change feed of
+            the replica
+        :type changelog_size: int
+        :param loop: Event loop
+        :type loop: asyncio.AbstractEventLoop
+        """
+        super().__init__()
+        self.url = url.rstrip('/')
+        self.sync_interval = sync_interval
+        self._loop = loop or asyncio.get_event_loop()
+        self._session = aiohttp.ClientSession(connector=connector, loop=self._loop)
+        self._records = collections.OrderedDict()
+        self._notify_set = set()
+        self._epoch = None
+        self._generation = 0
+        self._changelog_size = changelog_size
+        self._changelog = ChangeLog(changelog_size)
+        self._sync_lock = asyncio.Lock(loop=self._loop)
+        self._task = None
+
+    @asyncio.coroutine
+    def start(self):
+        """Load the registry, retrying until the writer answers, then keep
+        following its changes"""
+        while True:
+            try:
+                yield from self.sync()
+                break
+            except (aiohttp.ClientError, OSError, ValueError) as exc:
+                self.log.info('Waiting for the writer: %s', exc)
+                yield from asyncio.sleep(self.sync_interval, loop=self._loop)
+        self._task = asyncio.ensure_future(self._follow(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _follow(self):
+        """Poll the change feed of the writer"""
+        while True:
+            yield from asyncio.sleep(self.sync_interval, loop=self._loop)
+            try:
+                yield from self.sync()
+            except (aiohttp.ClientError, OSError, ValueError) as exc:
+                self.log.warning('Sync failed: %s', exc)
+
+    def close(self):
+        """Stop following the writer and close the connections to it"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._session.close()
+
+    @asyncio.coroutine
+    def _request(self, method, path, **kwargs):
+        """Send a request to the writer
+
+        :returns: The status, reason, headers and text of the response
+        :rtype: tuple(int, string, dict, string)
+        """
+        response = yield from self._session.request(method, self.url + path, **kwargs)
+        try:
+            text = yield from response.text()
+        finally:
+            response.release()
+        return response.status, response.reason, response.headers, text
+
+    @asyncio.coroutine
+    def _get_json(self, path, **params):
+        """Get a JSON document from the writer"""
+        status, reason, _, text = yield from self._request(
+            'GET', path, params=params, headers={'Accept': 'application/json'})
+        if status != 200:
+            raise aiohttp.ClientResponseError('{} {}'.format(status, reason))
+        return json.loads(text)
+
+    @asyncio.coroutine
+    def sync(self):
+        """Bring the replica up to date with the writer"""
+        with (yield from self._sync_lock):
+            params = {'since': str(self._generation)}
+            if self._epoch is not None:
+                params['epoch'] = self._epoch
+            changes = yield from self._get_json('/changes', **params)
+            if changes['resync'] or self._epoch is None:
+                # The writer may hold services its change log does not know,
+                # e.g. those loaded from its database, so the first sync
+                # always loads the complete registry
+                yield from self._resync(changes['epoch'], changes['generation'])
+                return
+            now = unix_now()
+            for entry in changes['changes']:
+                self._apply(entry, now)
+            self._generation = changes['generation']
+
+    @asyncio.coroutine
+    def _resync(self, epoch, generation):
+        """Replace the registry with the service list of the writer
+
+        Lifetimes are not part of the service list, so the deadlines of the
+        services are only known again once they are renewed.
+
+        :param epoch: Epoch of the writer
+        :type epoch: string
+        :param generation: Generation of the writer before fetching the
+            services, changes after it are fetched with the next sync
+        :type generation: int
+        """
+        status, reason, _, text = yield from self._request(
+            'GET', '/service', headers={'Accept': 'application/json'})
+        if status != 200:
+            raise aiohttp.ClientResponseError('{} {}'.format(status, reason))
+        self.log.info('Resync with epoch %s generation %u', epoch, generation)
+        old_records = self._records
+        self._records = collections.OrderedDict()
+        self._epoch = epoch
+        self._generation = generation
+        self._changelog = ChangeLog(self._changelog_size)
+        now = unix_now()
+        for service in servicelist_from_json(text):
+            self._store(service, None, now)
+        events = []
+        for name, record in old_records.items():
+            if name not in self._records:
+                events.append(ChangeEvent(ChangeEvent.UNPUBLISH, name, type=record['type']))
+        for name, record in self._records.items():
+            old_record = old_records.get(name)
+            if old_record is None or self._to_service(old_record) != self._to_service(record):
+                old_type = old_record['type'] if old_record is not None else None
+                events.append(ChangeEvent(
+                    ChangeEvent.PUBLISH, name, type=record['type'],
+                    old_type=old_type if old_type != record['type'] else None))
+        for event in events:
+            event.generation = generation
+            self._notify(event)
+
+    def _store(self, service, lifetime, now):
+        """Store the record of a published service"""
+        record = service.to_dict()
+        record['updated'] = now
+        record['lifetime'] = lifetime
+        record['deadline'] = now + lifetime if lifetime is not None else None
+        self._records.pop(service.name, None)
+        self._records[service.name] = record
+        return record
+
+    def _apply(self, entry, now):
+        """Apply a change feed entry of the writer
+
+        :param entry: Change feed entry, see
+            :meth:`soa.directory.directory.ChangeLogEntry.to_json_dict`
+        :type entry: dict
+        :param now: Current time
+        :type now: int
+        """
+        name = entry['name']
+        old_record = self._records.get(name)
+        if entry['op'] in (ChangeLogEntry.UPSERT, ChangeLogEntry.RENEW):
+            service = AHService.from_json_dict(entry['service'])
+            lifetime = entry.get('lifetime')
+            record = self._store(service, lifetime, now)
+            old_type = None
+            renewal = False
+            if old_record is not None:
+                if old_record['type'] != service.type:
+                    old_type = old_record['type']
+                renewal = self._to_service(old_record) == self._to_service(record)
+            event = ChangeEvent(ChangeEvent.PUBLISH, name, type=service.type,
+                                old_type=old_type, renewal=renewal)
+        else:
+            if old_record is None:
+                return
+            del self._records[name]
+            service = lifetime = None
+            event = ChangeEvent(self.EVENT_KINDS[entry['op']], name, type=old_record['type'])
+        event.generation = entry['sequence']
+        self._changelog.record(event, service, lifetime)
+        self._notify(event)
+
+    def _notify(self, event):
+        """Pass a change event on to the notify callbacks"""
+        self.log.debug('generation %u: %r', event.generation, event)
+        call_notify(self._notify_set, event, self.log)
+
+    @staticmethod
+    def _to_service(record):
+        """Create a service from a record, without the metadata"""
+        srv = copy.deepcopy(record)
+        for key in RECORD_METADATA:
+            srv.pop(key, None)
+        return AHService(**srv)
+
+    def add_notify_callback(self, callback):
+        self._notify_set.add(callback)
+
+    def del_notify_callback(self, callback):
+        self._notify_set.discard(callback)
+
+    def epoch(self):
+        return self._epoch
+
+    def next_deadline(self):
+        return min((record['deadline'] for record in self._records.values()
+                    if record['deadline'] is not None), default=None)
+
+    @asyncio.coroutine
+    def generation(self):
+        return self._generation
+
+    @asyncio.coroutine
+    def changes_since(self, since, epoch=None):
+        if epoch is not None and epoch != self._epoch:
+            return ChangeSet(self._epoch, self._generation, resync=True)
+        return self._changelog.changes_since(since, self._epoch, self._generation)
+
+    @asyncio.coroutine
+    def prune_old_services(self):
+        yield from self.sync()
+
+    @asyncio.coroutine
+    def _post(self, path, slist, lifetime=None):
+        """Forward a modification to the writer and sync with it
+
+        :returns: The status, reason, headers and text of the response
+        :rtype: tuple(int, string, dict, string)
+        """
+        params = {'lifetime': str(lifetime)} if lifetime is not None else {}
+        body = slist[0].to_json() if path in ('/publish', '/unpublish') else \
+            servicelist_to_json(slist)
+        result = yield from self._request(
+            'POST', path, params=params, data=body.encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        status, reason = result[:2]
+        if status == 403:
+            raise self.QuotaExceeded(reason)
+        if status >= 300 and not (status == 400 and path == '/unpublish'):
+            raise DirectoryException('Writer failed: {} {}'.format(status, reason))
+        yield from self.sync()
+        return result
+
+    @asyncio.coroutine
+    def publish(self, *, service, lifetime=None):
+        _, _, headers, _ = yield from self._post('/publish', [service], lifetime)
+        return int(headers[LIFETIME_HEADER])
+
+    @asyncio.coroutine
+    def unpublish(self, *, name):
+        status, _, _, _ = yield from self._post('/unpublish', [AHService(name=name)])
+        if status == 400:
+            raise self.DoesNotExist('Not found: {}'.format(name))
+
+    @asyncio.coroutine
+    def publish_many(self, *, services, lifetimes=None):
+        """Publish several services in the registry as one batch, see
+        :meth:`soa.directory.directory.ServiceDirectory.publish_many`
+
+        :raises ValueError: if the lifetimes differ, as the writer only takes
+            one lifetime per batch
+        """
+        if len(set(lifetimes or [None])) > 1:
+            raise ValueError('All services of a batch must request the same lifetime')
+        lifetime = lifetimes[0] if lifetimes else None
+        _, _, _, text = yield from self._post('/bulk/publish', services, lifetime)
+        return [(entry['status'] == UPDATED, entry.get('lifetime'))
+                for entry in json.loads(text)['status']]
+
+    @asyncio.coroutine
+    def unpublish_many(self, *, names):
+        _, _, _, text = yield from self._post(
+            '/bulk/unpublish', [AHService(name=name) for name in names])
+        return [entry['status'] == DELETED for entry in json.loads(text)['status']]
+
+    @asyncio.coroutine
+    def service(self, *, name):
+        try:
+            record = self._records[name]
+        except KeyError:
+            raise self.DoesNotExist('Not found: {}'.format(name))
+        return self._to_service(record)
+
+    @asyncio.coroutine
+    def service_list(self, **search):
+        return [self._to_service(record) for record in self._records.values()
+                if record_matches(record, search)]
+
+    @asyncio.coroutine
+    def last_modified(self, **search):
+        return max((record['updated'] for record in self._records.values()
+                    if record_matches(record, search)), default=None)
+
+    @asyncio.coroutine
+    def types(self):
+        return {record['type'] for record in self._records.values()}
@@ -0,0 +1,129 @@
+"""Publish the registry as a snapshot file for processes on the same host
+
+:class:`SnapshotPublisher` keeps a snapshot of a directory in a file, which
+local processes read with :class:`soa.snapshot.SnapshotReader` instead of
+querying the directory over the network. Put the file on a memory file
+system, such as ``/dev/shm`` on Linux, so neither side touches the disk.
+"""
+import asyncio
+
+from .. import LogMixin
+from ..snapshot import write_snapshot
+from .asyncdir import AsyncServiceDirectory
+from .directory import NotifyCoalescer, unix_now
+
+__all__ = [
+    'SnapshotPublisher',
+    ]
+
+class SnapshotPublisher(LogMixin, object):
+    """Rewrite a snapshot file after modifications of a directory
+
+    Bursts of modifications are merged with a
+    :class:`soa.directory.directory.NotifyCoalescer`, so the snapshot is
+    rewritten at most once per `interval`. The snapshot is also rewritten when
+    the first service in it times out, as readers can not tell expired
+    services apart, and `retry_interval` seconds after a failed write.
+    """
+
+    def __init__(self, directory, path, *, interval=0.5, retry_interval=5.0, loop=None):
+        """Constructor
+
+        :param directory: Directory to publish
+        :type directory: soa.directory.directory.ServiceDirectory or
+            soa.directory.asyncdir.AsyncDirectory
+        :param path: Path of the snapshot file
+        :type path: string
+        :param interval: Minimum time between two snapshots, in seconds
+        :type interval: float
+        :param retry_interval: Time until writing the snapshot is tried again
+            after a failure, in seconds
+        :type retry_interval: float
+        :param loop: Event loop
+        :type loop: asyncio.AbstractEventLoop
+        """
+        super().__init__()
+        self.path = path
+        self.retry_interval = retry_interval
+        self._loop = loop or asyncio.get_event_loop()
+        self._directory = AsyncServiceDirectory.wrap(directory, loop=self._loop)
+        self._coalescer = NotifyCoalescer(self._changed, min_interval=interval,
+                                          loop=self._loop)
+        self._task = None
+        self._timer = None
+        self._dirty = False
+        self.epoch = None
+        """Epoch of the last snapshot written"""
+        self.generation = None
+        """Generation of the last snapshot written"""
+
+    @asyncio.coroutine
+    def start(self):
+        """Write the first snapshot and follow the modifications"""
+        self._directory.add_notify_callback(self._coalescer)
+        yield from self.write()
+
+    def close(self):
+        """Stop following the modifications
+
+        The snapshot file is left in place with the last known state.
+        """
+        self._directory.del_notify_callback(self._coalescer)
+        self._coalescer.cancel()
+        self._schedule(None)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _schedule(self, delay):
+        """Schedule the next snapshot independent of modifications
+
+        :param delay: Seconds until the snapshot, None for no snapshot
+        :type delay: float
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if delay is not None:
+            self._timer = self._loop.call_later(delay, self._changed, [])
+
+    def _changed(self, events): #pylint: disable=unused-argument
+        """Schedule a new snapshot, or another one if one is being written"""
+        if self._task is not None and not self._task.done():
+            self._dirty = True
+            return
+        self._task = asyncio.ensure_future(self._update(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _update(self):
+        """Write a snapshot in the background, retrying on failure"""
+        try:
+            yield from self.write()
+        except Exception: #pylint: disable=broad-except
+            self.log.exception('Writing the snapshot to %s failed, retrying in %s s',
+                               self.path, self.retry_interval)
+            self._schedule(self.retry_interval)
+
+    @asyncio.coroutine
+    def write(self):
+        """Write a snapshot of the current registry, unless the last one is
+        up to date"""
+        while True:
+            self._dirty = False
+            # The generation is read first, so a snapshot never claims a
+            # newer generation than its services. Reading it also prunes
+            # the services which have timed out.
+            generation = yield from self._directory.generation()
+            epoch = self._directory.epoch()
+            if (epoch, generation) != (self.epoch, self.generation):
+                slist = yield from self._directory.service_list()
+                # Writing to a memory file system does not block for long
+                write_snapshot(self.path, epoch, generation, slist)
+                self.epoch, self.generation = epoch, generation
+                self.log.debug('Snapshot of generation %u with %u services',
+                               generation, len(slist))
+            deadline = self._directory.next_deadline()
+            # Services are pruned once their deadline has passed
+            self._schedule(max(deadline - unix_now() + 1, 0) if deadline is not None else None)
+            if not self._dirty:
+                return
@@ -13,6 +13,7 @@ else:
 
 try:
     import xml.etree.ElementTree as ET
+    from xml.sax.saxutils import escape
 except ImportError:
     HAVE_XML = False
 else:
@@ -33,8 +34,13 @@ SERVICE_ATTRIBUTES = ("name", "type", "host", "port", "domain")
 __all__ = [
     'Service',
     'ServiceError',
+    'servicelist_from_json',
+    'servicelist_from_message',
+    'servicelist_from_xml',
     'servicelist_to_xml',
     'servicelist_to_json',
+    'statuslist_to_json',
+    'statuslist_to_xml',
     'typelist_to_json',
     'servicelist_to_corelf',
     'typelist_to_corelf',
@@ -241,11 +247,21 @@ class Service(object):
     @classmethod
     def from_xml(cls, xmlstr):
         """Convert XML representation of service to service dict"""
-        res = cls()
         try:
             root = ET.fromstring(xmlstr)
         except ET.ParseError:
             raise ServiceError('Invalid XML service')
+        return cls.from_xml_element(root)
+
+    @classmethod
+    def from_xml_element(cls, root):
+        """Create a Service object from a parsed ``<service>`` element
+
+        :param root: The service element
+        :type root: xml.etree.ElementTree.Element
+        :returns: Service object
+        """
+        res = cls()
         if root.tag != 'service':
             raise ServiceError('Missing <service> tag')
         for node in root:
@@ -278,6 +294,24 @@ class Service(object):
         return res
 
 
+    def corelf_attributes(self):
+        """Get the CoRE Link-format target attributes describing the service
+
+        The service type is given as the resource type (``rt``), and the
+        ``interface`` property, if any, as the interface description
+        (``if``), see :rfc:`6690#section-3`.
+
+        :returns: Attribute name, value pairs
+        :rtype: list(tuple(string, string))
+        """
+        attributes = []
+        if self.type:
+            attributes.append(('rt', str(self.type)))
+        interface = getattr(self.properties, 'interface', None)
+        if interface:
+            attributes.append(('if', str(interface)))
+        return attributes
+
     def to_corelf(self):
         """Convert a service dict to CoRE Link-format (:rfc:`6690`)
 
@@ -295,6 +329,8 @@ class Service(object):
         if path and path[0] != '/':
             path = '/' + path
         link_str = '<coap://%s%s%s>' % (host, port, path)
+        for name, value in self.corelf_attributes():
+            link_str += ';%s="%s"' % (name, value.replace('"', '\\"'))
         return link_str
 
 
@@ -322,6 +358,105 @@ def servicelist_to_xml(slist):
         ''.join([srv.to_xml() for srv in slist]) + '</serviceList>'
 
 
+def servicelist_from_json(payload):
+    """Create a list of Service objects from the JSON representation produced
+    by :func:`servicelist_to_json`
+
+    :param payload: JSON string representation of a service list
+    :type payload: string or bytes
+    :returns: The services
+    :rtype: list(Service)
+    """
+    try:
+        try:
+            jsonstr = payload.decode('utf-8')
+        except AttributeError:
+            jsonstr = payload
+        entries = json.loads(jsonstr)['service']
+        if not isinstance(entries, list):
+            raise ServiceError('Expected a list of services')
+        return [Service.from_json_dict(entry) for entry in entries]
+    except ValueError as exc:
+        raise ServiceError(
+            'ValueError while parsing JSON service list: {}'.format(str(exc)))
+    except (LookupError, TypeError, AttributeError):
+        raise ServiceError('Invalid JSON service list')
+
+
+def servicelist_from_xml(xmlstr):
+    """Create a list of Service objects from the XML representation produced
+    by :func:`servicelist_to_xml`
+
+    :param xmlstr: XML string representation of a service list
+    :type xmlstr: string or bytes
+    :returns: The services
+    :rtype: list(Service)
+    """
+    try:
+        root = ET.fromstring(xmlstr)
+    except ET.ParseError:
+        raise ServiceError('Invalid XML service list')
+    if root.tag != 'serviceList':
+        raise ServiceError('Missing <serviceList> tag')
+    try:
+        return [Service.from_xml_element(node) for node in root]
+    except ValueError:
+        raise ServiceError('Invalid XML service list')
+
+
+def servicelist_from_message(message):
+    """Create a list of Service objects from a CoAP Message
+
+    :param message: Message with a JSON or XML service list payload
+    :type message: aiocoap.Message
+    :returns: The services
+    :rtype: list(Service)
+    """
+    try:
+        input_handler = {
+            'json': servicelist_from_json,
+            'xml': servicelist_from_xml,
+        }[Service.media_type_to_name[message.opt.content_format]]
+    except LookupError:
+        raise UnknownContentError(
+            "No translator for media type {}".format(message.opt.content_format))
+    return input_handler(message.payload)
+
+
+def statuslist_to_json(statuses):
+    """Convert the results of a batch operation to a JSON string
+
+    :param statuses: Name, status and lease lifetime of each service, the
+        lifetime is left out if None
+    :type statuses: list(tuple(string, string, int))
+    :returns: The results encoded as a JSON string
+    :rtype: string
+    """
+    entries = []
+    for name, status, lifetime in statuses:
+        entry = {'name': name, 'status': status}
+        if lifetime is not None:
+            entry['lifetime'] = lifetime
+        entries.append(entry)
+    return json.dumps({'status': entries})
+
+
+def statuslist_to_xml(statuses):
+    """Convert the results of a batch operation to an XML string
+
+    :param statuses: Name, status and lease lifetime of each service, the
+        lifetime is left out if None
+    :type statuses: list(tuple(string, string, int))
+    :returns: The results encoded as an XML string
+    :rtype: string
+    """
+    return '<statusList>' + ''.join(
+        '<status><name>%s</name><status>%s</status>%s</status>' % (
+            escape(str(name)), status,
+            '' if lifetime is None else '<lifetime>%u</lifetime>' % lifetime)
+        for name, status, lifetime in statuses) + '</statusList>'
+
+
 def servicelist_to_corelf(slist, uri_base):
     """Convert a list of services to a CoRE Link-format (:rfc:`6690`) string
 
@@ -333,7 +468,8 @@ def servicelist_to_corelf(slist, uri_base):
     :rtype: string
     """
     return link_header.format_links(
-        [link_header.Link('{0}/{1}'.format(uri_base, srv.name)) for srv in slist])
+        [link_header.Link('{0}/{1}'.format(uri_base, srv.name), srv.corelf_attributes())
+         for srv in slist])
 
 def typelist_to_json(tlist):
     """Convert a list of service dicts to a JSON string
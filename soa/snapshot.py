@@ -0,0 +1,255 @@
+"""Registry snapshots shared with processes on the same host
+
+A directory can publish its current service list into a file, preferably on
+a memory file system such as ``/dev/shm``, see
+:class:`soa.directory.snapshot.SnapshotPublisher`. Processes on the same host
+read it with :class:`SnapshotReader`, which maps the file into memory and
+resolves services without any network I/O.
+
+The file is never modified in place. Every update is written to a new file
+which replaces the old one, and then the old file is marked as superseded,
+so readers always see a complete snapshot and know when to map the new one.
+
+File format, all integers are little endian:
+
+* Header (:data:`HEADER`): magic, state (:data:`CURRENT` or
+  :data:`SUPERSEDED`), registry generation, Unix time of writing, registry
+  epoch and the number of services.
+* Index (:data:`ENTRY`), one entry per service sorted by name: offset and
+  length of the name, of the type and of the service encoded as JSON.
+* The UTF-8 encoded names, types and JSON services the index points to.
+"""
+import json
+import mmap
+import os
+import struct
+import time
+
+from .services import Service
+
+__all__ = [
+    'SnapshotError',
+    'SnapshotReader',
+    'encode_snapshot',
+    'write_snapshot',
+    ]
+
+MAGIC = b'SDSNAP\x00\x01'
+"""File signature and format version"""
+HEADER = struct.Struct('<8sIQQ16sI')
+"""Magic, state, generation, time of writing, epoch, number of services"""
+STATE = struct.Struct('<I')
+"""State field of the header"""
+STATE_OFFSET = 8
+"""Offset of the state field in the file"""
+ENTRY = struct.Struct('<IIIIII')
+"""Offset and length of name, type and JSON service of an index entry"""
+EPOCH_SIZE = 16
+"""Maximum length of the epoch"""
+
+CURRENT = 0
+"""State of the snapshot file in place"""
+SUPERSEDED = 1
+"""State of a snapshot file which has been replaced by a newer one"""
+
+class SnapshotError(Exception):
+    """The file is not a registry snapshot"""
+
+def encode_snapshot(epoch, generation, slist):
+    """Encode a service list as a snapshot
+
+    :param epoch: Epoch of the registry
+    :type epoch: string
+    :param generation: Generation of the registry
+    :type generation: int
+    :param slist: Services in the registry
+    :type slist: list(soa.services.Service)
+    :returns: Snapshot file contents
+    :rtype: bytes
+    """
+    epoch = (epoch or '').encode('ascii')
+    if len(epoch) > EPOCH_SIZE:
+        raise ValueError('Epoch longer than {} characters'.format(EPOCH_SIZE))
+    items = sorted(
+        (srv.name.encode('utf-8'), (srv.type or '').encode('utf-8'),
+         json.dumps(srv.to_json_dict(), separators=(',', ':')).encode('utf-8'))
+        for srv in slist)
+    header = HEADER.pack(MAGIC, CURRENT, generation, int(time.time()),
+                         epoch, len(items))
+    index = bytearray()
+    data = bytearray()
+    offset = HEADER.size + ENTRY.size * len(items)
+    for name, stype, record in items:
+        fields = []
+        for value in (name, stype, record):
+            fields.extend((offset + len(data), len(value)))
+            data += value
+        index += ENTRY.pack(*fields)
+    return header + bytes(index) + bytes(data)
+
+def write_snapshot(path, epoch, generation, slist):
+    """Replace the snapshot file, and tell readers of the previous one
+
+    :param path: Path of the snapshot file
+    :type path: string
+    :param epoch: Epoch of the registry
+    :type epoch: string
+    :param generation: Generation of the registry
+    :type generation: int
+    :param slist: Services in the registry
+    :type slist: list(soa.services.Service)
+    """
+    contents = encode_snapshot(epoch, generation, slist)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    previous = None
+    try:
+        with open(tmp_path, 'wb') as snapshot_file:
+            snapshot_file.write(contents)
+        try:
+            previous = open(path, 'r+b')
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        if previous is not None:
+            previous.seek(STATE_OFFSET)
+            previous.write(STATE.pack(SUPERSEDED))
+    finally:
+        if previous is not None:
+            previous.close()
+        # Only left over if writing the snapshot failed
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+class SnapshotReader(object):
+    """Read-only view of a registry snapshot file
+
+    Lookups check whether the snapshot has been superseded, and map the
+    current file if so, which costs no system call while the snapshot is
+    current. :meth:`record` returns the JSON encoded service without copying
+    it out of the mapping.
+    """
+
+    def __init__(self, path):
+        """Constructor
+
+        :param path: Path of the snapshot file
+        :type path: string
+        :raises SnapshotError: if the file is not a snapshot
+        """
+        self.path = path
+        self._view = None
+        self._header = None
+        self._map()
+
+    def _map(self):
+        """Map the current snapshot file"""
+        with open(self.path, 'rb') as snapshot_file:
+            mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        if len(view) < HEADER.size or HEADER.unpack_from(view)[0] != MAGIC:
+            raise SnapshotError('Not a registry snapshot: {}'.format(self.path))
+        # Mappings are closed once no returned records refer to them any more
+        self._view = view
+        self._header = HEADER.unpack_from(view)
+
+    def _current(self):
+        """Get the view of the current snapshot, mapping it if necessary"""
+        if STATE.unpack_from(self._view, STATE_OFFSET)[0] != CURRENT:
+            self._map()
+        return self._view
+
+    @property
+    def generation(self):
+        """Generation of the registry the snapshot was taken from"""
+        self._current()
+        return self._header[2]
+
+    @property
+    def written(self):
+        """Unix time when the snapshot was written"""
+        self._current()
+        return self._header[3]
+
+    @property
+    def epoch(self):
+        """Epoch of the registry the snapshot was taken from"""
+        self._current()
+        return self._header[4].rstrip(b'\x00').decode('ascii') or None
+
+    def __len__(self):
+        self._current()
+        return self._header[5]
+
+    def __contains__(self, name):
+        return self.record(name) is not None
+
+    def _entries(self):
+        """Iterate over the index entries of the current snapshot
+
+        :returns: The view and the index entries
+        :rtype: tuple(memoryview, iterator)
+        """
+        view = self._current()
+        return view, (ENTRY.unpack_from(view, HEADER.size + ENTRY.size * index)
+                      for index in range(self._header[5]))
+
+    def record(self, name):
+        """Look up the JSON encoding of a service
+
+        :param name: Name of the service
+        :type name: string
+        :returns: The UTF-8 encoded JSON service, or None if the service is
+            not in the snapshot
+        :rtype: memoryview
+        """
+        view = self._current()
+        key = name.encode('utf-8')
+        low, high = 0, self._header[5]
+        while low < high:
+            middle = (low + high) // 2
+            entry = ENTRY.unpack_from(view, HEADER.size + ENTRY.size * middle)
+            found = view[entry[0]:entry[0] + entry[1]].tobytes()
+            if found == key:
+                return view[entry[4]:entry[4] + entry[5]]
+            if found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def service(self, name):
+        """Look up a service
+
+        :param name: Name of the service
+        :type name: string
+        :rtype: soa.services.Service
+        :raises KeyError: if the service is not in the snapshot
+        """
+        record = self.record(name)
+        if record is None:
+            raise KeyError(name)
+        return Service.from_json_dict(json.loads(str(record, 'utf-8')))
+
+    def names(self):
+        """Get the names of all services, in sorted order
+
+        :rtype: list(string)
+        """
+        view, entries = self._entries()
+        return [str(view[entry[0]:entry[0] + entry[1]], 'utf-8') for entry in entries]
+
+    def service_list(self, type=None): #pylint: disable=redefined-builtin
+        """Get all services, or the services of a type
+
+        :param type: Only return services of this type
+        :type type: string
+        :rtype: list(soa.services.Service)
+        """
+        view, entries = self._entries()
+        stype = type.encode('utf-8') if type is not None else None
+        return [Service.from_json_dict(json.loads(str(view[entry[4]:entry[4] + entry[5]],
+                                                      'utf-8')))
+                for entry in entries
+                if stype is None or view[entry[2]:entry[2] + entry[3]] == stype]
@@ -0,0 +1,153 @@
+"""Test soa.directory.asyncdir"""
+
+import asyncio
+import tempfile
+import threading
+
+import pytest
+
+from soa import services
+from soa.directory import asyncdir
+from soa.directory import directory
+from soa.directory import notify
+
+from ..test_data import EXAMPLE_SERVICES
+
+@pytest.yield_fixture
+def async_directory(event_loop):
+    """Create a facade for an empty directory"""
+    with tempfile.TemporaryDirectory() as db_dir:
+        facade = asyncdir.AsyncServiceDirectory(
+            directory.ServiceDirectory(database=db_dir), loop=event_loop)
+        yield facade
+        facade.close()
+
+@pytest.mark.asyncio
+def test_rwlock_readers_share(event_loop):
+    """Test that readers hold the lock together, and writers exclusively"""
+    lock = asyncdir.ReadWriteLock(loop=event_loop)
+    yield from lock.acquire_read()
+    yield from lock.acquire_read()
+    assert lock.readers == 2
+    writer = event_loop.create_task(lock.acquire_write())
+    yield from asyncio.sleep(0, loop=event_loop)
+    assert not writer.done()
+    # Waiting writers take precedence over new readers
+    reader = event_loop.create_task(lock.acquire_read())
+    yield from asyncio.sleep(0, loop=event_loop)
+    assert not reader.done()
+    lock.release_read()
+    lock.release_read()
+    yield from writer
+    assert lock.locked()
+    assert not reader.done()
+    lock.release_write()
+    yield from reader
+    assert lock.readers == 1
+    lock.release_read()
+    with pytest.raises(RuntimeError):
+        lock.release_read()
+
+@pytest.mark.asyncio
+def test_rwlock_cancel(event_loop):
+    """Test that cancelled waiters do not keep the lock"""
+    lock = asyncdir.ReadWriteLock(loop=event_loop)
+    with (yield from lock.reader()):
+        writer = event_loop.create_task(lock.acquire_write())
+        yield from asyncio.sleep(0, loop=event_loop)
+        writer.cancel()
+        yield from asyncio.sleep(0, loop=event_loop)
+    assert not lock.locked()
+    with (yield from lock.writer()):
+        assert lock.locked()
+    assert not lock.locked()
+
+@pytest.mark.asyncio
+def test_async_directory(async_directory): #pylint: disable=redefined-outer-name
+    """Test the coroutine interface of the facade"""
+    events = []
+    threads = []
+
+    def callback(event):
+        """Record the event and the thread calling the callback"""
+        events.append(event)
+        threads.append(threading.current_thread())
+
+    async_directory.add_notify_callback(callback)
+    for testcase in EXAMPLE_SERVICES.values():
+        yield from async_directory.publish(service=services.Service(**testcase['service']))
+    assert len(events) == len(EXAMPLE_SERVICES)
+    assert set(threads) == {threading.current_thread()}
+    assert (yield from async_directory.generation()) == len(EXAMPLE_SERVICES)
+    slist = yield from async_directory.service_list()
+    assert len(slist) == len(EXAMPLE_SERVICES)
+    name = slist[0].name
+    assert (yield from async_directory.service(name=name)) == slist[0]
+    assert (yield from async_directory.types()) == {srv.type for srv in slist}
+    assert (yield from async_directory.last_modified(name=name)) is not None
+    yield from async_directory.unpublish(name=name)
+    with pytest.raises(async_directory.DoesNotExist):
+        yield from async_directory.service(name=name)
+    with pytest.raises(async_directory.DoesNotExist):
+        yield from async_directory.unpublish(name=name)
+    assert events[-1].kind == directory.ChangeEvent.UNPUBLISH
+    async_directory.del_notify_callback(callback)
+    yield from async_directory.publish(service=slist[0])
+    assert len(events) == len(EXAMPLE_SERVICES) + 1
+
+@pytest.mark.asyncio
+def test_async_directory_concurrency(async_directory, event_loop): #pylint: disable=redefined-outer-name
+    """Test that lookups run concurrently, and modifications exclusively"""
+    active = []
+    overlap = []
+    real = async_directory.directory
+    gate = threading.Event()
+
+    def tracked(func):
+        """Record which operations run at the same time"""
+        def wrapper(*args, **kwargs):
+            """Run the operation"""
+            active.append(func.__name__)
+            overlap.append(tuple(active))
+            gate.wait(1)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                active.remove(func.__name__)
+        return wrapper
+
+    async_directory.directory = type('Tracked', (object, ), {
+        'service_list': staticmethod(tracked(real.service_list)),
+        'publish': staticmethod(tracked(real.publish)),
+        })()
+    service = services.Service(**next(iter(EXAMPLE_SERVICES.values()))['service'])
+    tasks = [
+        event_loop.create_task(async_directory.service_list()),
+        event_loop.create_task(async_directory.service_list()),
+        event_loop.create_task(async_directory.publish(service=service)),
+        event_loop.create_task(async_directory.service_list()),
+    ]
+    yield from asyncio.sleep(0.1, loop=event_loop)
+    gate.set()
+    results = yield from asyncio.gather(*tasks, loop=event_loop)
+    assert results[0] == results[1] == []
+    assert results[3] == [service]
+    assert ('service_list', 'service_list') in overlap
+    assert all(len(ops) == 1 for ops in overlap if 'publish' in ops)
+
+def test_async_directory_wrap():
+    """Test that facades are not wrapped again"""
+    facade = asyncdir.AsyncServiceDirectory(directory.ServiceDirectory())
+    assert asyncdir.AsyncServiceDirectory.wrap(facade) is facade
+    facade.close()
+
+@pytest.mark.asyncio
+def test_async_directory_changes(async_directory): #pylint: disable=redefined-outer-name
+    """Test iterating over the change events of a wrapped directory"""
+    service = services.Service(**next(iter(EXAMPLE_SERVICES.values()))['service'])
+    with async_directory.changes(policy=notify.DROP_OLDEST) as stream:
+        yield from async_directory.publish(service=service)
+        yield from async_directory.unpublish(name=service.name)
+        kinds = [(yield from stream.get()).kind, (yield from stream.get()).kind]
+    assert kinds == [directory.ChangeEvent.PUBLISH, directory.ChangeEvent.UNPUBLISH]
+    assert (yield from stream.get()) is None
@@ -0,0 +1,93 @@
+"""Test soa.directory.cache"""
+
+import asyncio
+import gzip
+from unittest import mock
+
+import pytest
+
+from soa.directory import cache
+
+def test_lru_cache():
+    """Test that LRUCache evicts the least recently used item"""
+    lru = cache.LRUCache(maxsize=2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+    lru.put('c', 3)
+    assert 'b' not in lru
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+    assert len(lru) == 2
+    assert lru.pop('a') == 1
+    assert len(lru) == 1
+    lru.clear()
+    assert len(lru) == 0
+
+def test_representation():
+    """Test that the entity tag of a Representation only depends on the body"""
+    first = cache.Representation(b'{"service": []}', 'application/json')
+    second = cache.Representation(b'{"service": []}', 'application/json', last_modified=1)
+    other = cache.Representation(b'<serviceList></serviceList>', 'application/xml')
+    assert first.etag == second.etag
+    assert first.etag != other.etag
+    assert first.etag.startswith('"') and first.etag.endswith('"')
+    assert len(first.digest) == 8
+
+def test_representation_coded():
+    """Test that coded bodies are the same whenever they are compressed"""
+    body = b'{"service": []}' * 10
+    first = cache.Representation(body, 'application/json')
+    second = cache.Representation(body, 'application/json')
+    with mock.patch('time.time', return_value=1000):
+        coded, etag = first.coded('gzip')
+    with mock.patch('time.time', return_value=2000):
+        assert second.coded('gzip') == (coded, etag)
+    assert gzip.decompress(coded) == body
+    assert etag != first.etag
+
+def test_representation_cache():
+    """Test that RepresentationCache only returns entries of the requested generation"""
+    reps = cache.RepresentationCache()
+    rep = cache.Representation(b'payload', 'text/plain')
+    reps.put(('service', ), 1, rep)
+    assert reps.get(('service', ), 1) is rep
+    assert reps.get(('service', ), 2) is None
+    assert reps.get(('type', ), 1) is None
+
+@pytest.mark.asyncio
+def test_single_flight(event_loop):
+    """Test that concurrent computations of the same key run once"""
+    flights = cache.SingleFlight(loop=event_loop)
+    gate = asyncio.Future(loop=event_loop)
+    calls = []
+
+    @asyncio.coroutine
+    def compute():
+        """Wait for the gate and count the calls"""
+        calls.append(None)
+        return (yield from gate)
+
+    tasks = [event_loop.create_task(flights.run(key, compute)) for key in ('a', 'a', 'b')]
+    yield from asyncio.sleep(0, loop=event_loop)
+    assert len(flights) == 2
+    # Cancelling one caller does not affect the others
+    tasks[0].cancel()
+    gate.set_result(42)
+    results = yield from asyncio.gather(*tasks, loop=event_loop, return_exceptions=True)
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert results[1:] == [42, 42]
+    assert len(calls) == 2
+    assert flights.stats == {'runs': 2, 'shared': 1}
+    assert len(flights) == 0
+
+    @asyncio.coroutine
+    def fail():
+        """Raise an exception"""
+        raise KeyError('x')
+
+    tasks = [event_loop.create_task(flights.run('c', fail)) for _ in range(2)]
+    for task in tasks:
+        with pytest.raises(KeyError):
+            yield from task
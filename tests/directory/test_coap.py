@@ -2,6 +2,7 @@
 #pylint: disable=no-member
 # pylint doesn't understand mock objects
 
+import asyncio
 import random
 from unittest import mock
 import tempfile
@@ -18,6 +19,8 @@ import aiocoap
 from soa import services
 from soa.directory import directory
 from soa.directory import coap
+from soa.directory import memory
+from soa.directory import ratelimit
 import soa
 
 from ..test_data import EXAMPLE_SERVICES, BROKEN_SERVICES
@@ -68,6 +71,7 @@ def directory_spy():
         dir_spy.DoesNotExist = mydir.DoesNotExist
         # otherwise: TypeError: catching classes that do not inherit from
         #  BaseException is not allowed
+        dir_spy.stats = mydir.stats
         yield DirectorySpy(dir_spy, mydir)
 
 @pytest.yield_fixture
@@ -93,13 +97,12 @@ def test_coap_server(directory_spy): #pylint: disable=redefined-outer-name
     """Test initialization of the CoAP Server object"""
     coap_bind = '127.0.0.1'
     coap_port = random.randint(1024, 60000)
-    with mock.patch('soa.directory.coap.aiocoap.Context'):
+    with mock.patch('soa.directory.coap.create_server_context'):
         coap_server = coap.Server(directory=directory_spy.spy, bind=(coap_bind, coap_port))
         assert isinstance(coap_server, coap.Server)
-        assert soa.directory.coap.aiocoap.Context.create_server_context.call_count == 1
-        soa.directory.coap.\
-            aiocoap.Context.create_server_context.\
-            assert_called_once_with(mock.ANY, bind=(coap_bind, coap_port))
+        assert soa.directory.coap.create_server_context.call_count == 1
+        soa.directory.coap.create_server_context.assert_called_once_with(
+            mock.ANY, bind=(coap_bind, coap_port), reuse_port=False)
         for call in directory_spy.spy.method_calls:
             if call[0] not in (
                     'service',
@@ -353,3 +356,450 @@ def test_coap_service_default(coap_server_filled): #pylint: disable=redefined-ou
     for service in mydir.service_list():
         assert service.name in sdict
         assert sdict[service.name] == service
+
+@pytest.mark.asyncio
+def test_coap_service_list_etag(coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test ETag and Max-Age options and 2.03 Valid responses on /service"""
+    coap_server = coap_server_filled.coap_server
+    mydir = coap_server_filled.directory_spy.real
+    req = aiocoap.Message(code=Code.GET, payload=''.encode('utf-8'))
+    req.opt.uri_path = URI_PATH_SERVICE
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.CONTENT
+    etag = res.opt.etag
+    assert etag is not None
+    max_age = res.opt.get_option(aiocoap.numbers.optionnumbers.OptionNumber.MAX_AGE)
+    assert max_age
+    assert 0 < max_age[0].value <= mydir.config_defaults['lifetime']
+
+    req = aiocoap.Message(code=Code.GET, payload=''.encode('utf-8'))
+    req.opt.uri_path = URI_PATH_SERVICE
+    req.opt.etags = [b'12345678', etag]
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.VALID
+    assert res.opt.etag == etag
+    assert not res.payload
+
+    # The entity tag must change when the registry does
+    mydir.unpublish(name=next(iter(EXAMPLE_SERVICES.values()))['service']['name'])
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.CONTENT
+    assert res.opt.etag != etag
+
+@pytest.mark.asyncio
+def test_coap_changes(coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test the change feed resource"""
+    coap_server = coap_server_filled.coap_server
+    mydir = coap_server_filled.directory_spy.real
+    since = mydir.generation()
+    name = next(iter(EXAMPLE_SERVICES.values()))['service']['name']
+    mydir.unpublish(name=name)
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = ('servicediscovery', 'changes')
+    req.opt.uri_query = ('since={}'.format(since), 'epoch=' + mydir.epoch())
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.CONTENT
+    changes = json.loads(res.payload.decode('utf-8'))
+    assert [(entry['op'], entry['name']) for entry in changes['changes']] == \
+        [('delete', name)]
+
+    req.opt.uri_query = ('since=x', )
+    with pytest.raises(coap.BadRequestError):
+        yield from coap_server.site.render(req)
+
+    req.opt.uri_query = ()
+    res = yield from coap_server.site.render(req)
+    assert json.loads(res.payload.decode('utf-8'))['resync']
+
+@pytest.mark.asyncio
+def test_coap_publish_lifetime(coap_server_setup): #pylint: disable=redefined-outer-name
+    """Test requesting a lease lifetime, which is returned in Max-Age"""
+    coap_server = coap_server_setup.coap_server
+    service = services.Service(name='new', type='a', port=1)
+    req = aiocoap.Message(code=Code.POST, payload=service.to_json().encode('utf-8'))
+    req.opt.content_format = aiocoap.numbers.media_types_rev['application/json']
+    req.opt.uri_path = URI_PATH_PUBLISH
+    req.opt.uri_query = ('lt=120', )
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.CREATED
+    assert res.opt.get_option(
+        aiocoap.numbers.optionnumbers.OptionNumber.MAX_AGE)[0].value == 120
+    coap_server_setup.directory_spy.spy.publish.assert_called_with(service=service, lifetime=120)
+
+    req.opt.uri_query = ('lt=never', )
+    with pytest.raises(coap.BadRequestError):
+        yield from coap_server.site.render(req)
+
+@pytest.mark.asyncio
+def test_coap_publish_quota():
+    """Test that services exceeding a quota are rejected with 4.03 Forbidden"""
+    mydir = directory.ServiceDirectory(config={'max_services_per_host': 1})
+    mydir.publish(service=services.Service(name='first', host='h'))
+    with mock.patch('soa.directory.coap.aiocoap.Context'):
+        coap_server = coap.Server(directory=mydir)
+    service = services.Service(name='second', host='h', port=1)
+    req = aiocoap.Message(code=Code.POST, payload=service.to_json().encode('utf-8'))
+    req.opt.content_format = aiocoap.numbers.media_types_rev['application/json']
+    req.opt.uri_path = URI_PATH_PUBLISH
+    with pytest.raises(coap.ForbiddenError) as excinfo:
+        yield from coap_server.site.render(req)
+    assert excinfo.value.code == Code.FORBIDDEN
+    assert 'per host h' in excinfo.value.message
+
+@pytest.mark.asyncio
+def test_coap_bulk_publish_quota():
+    """Test that a rejected batch gets 4.03 Forbidden and is not applied"""
+    mydir = memory.MemoryServiceDirectory(config={'max_services': 3})
+    with mock.patch('soa.directory.coap.aiocoap.Context'):
+        coap_server = coap.Server(directory=mydir)
+    slist = [services.Service(name='s{}'.format(index), port=1) for index in range(4)]
+    req = aiocoap.Message(code=Code.POST, payload=services.servicelist_to_json(slist).encode())
+    req.opt.content_format = aiocoap.numbers.media_types_rev['application/json']
+    req.opt.uri_path = ('servicediscovery', 'bulk', 'publish')
+    with pytest.raises(coap.ForbiddenError):
+        yield from coap_server.site.render(req)
+    assert (yield from mydir.service_list()) == []
+    assert (yield from mydir.generation()) == 0
+
+@pytest.mark.asyncio
+def test_coap_rate_limit(coap_server_setup): #pylint: disable=redefined-outer-name
+    """Test that clients over their rate limit get 5.03 with Max-Age"""
+    coap_server = coap_server_setup.coap_server
+    coap_server.site.rate_limiter = ratelimit.RateLimiter(0.25, 2)
+    slist = [services.Service(name=name, port=1) for name in ('a', 'b', 'c')]
+    req = aiocoap.Message(code=Code.POST, payload=services.servicelist_to_json(slist).encode())
+    req.opt.content_format = aiocoap.numbers.media_types_rev['application/json']
+    req.opt.uri_path = ('servicediscovery', 'bulk', 'publish')
+    req.remote = ('::1', 5683, 0, 0)
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.CHANGED
+    req = aiocoap.Message(code=Code.POST, payload=slist[0].to_json().encode('utf-8'))
+    req.opt.content_format = aiocoap.numbers.media_types_rev['application/json']
+    req.opt.uri_path = ('servicediscovery', 'unpublish')
+    req.remote = ('::1', 5684, 0, 0)
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.SERVICE_UNAVAILABLE
+    assert res.opt.get_option(
+        aiocoap.numbers.optionnumbers.OptionNumber.MAX_AGE)[0].value == 8
+    assert not coap_server_setup.directory_spy.spy.unpublish.called
+
+@pytest.mark.asyncio
+def test_coap_single_flight(coap_server_filled, event_loop): #pylint: disable=redefined-outer-name
+    """Test that concurrent identical requests render the service list once"""
+    coap_server = coap_server_filled.coap_server
+    requests = []
+    for port in range(5):
+        req = aiocoap.Message(code=Code.GET)
+        req.opt.uri_path = ('servicediscovery', 'service')
+        req.remote = ('::1', 5683 + port, 0, 0)
+        requests.append(req)
+    responses = yield from asyncio.gather(
+        *[coap_server.site.render(req) for req in requests], loop=event_loop)
+    assert len({res.payload for res in responses}) == 1
+    assert coap_server_filled.directory_spy.spy.service_list.call_count == 1
+
+@pytest.mark.parametrize("test_format", TEST_FORMATS)
+@pytest.mark.asyncio
+def test_coap_bulk_publish(test_format, coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test publishing and removing services in batches"""
+    coap_server = coap_server_filled.coap_server
+    mydir = coap_server_filled.directory_spy.real
+    existing = next(iter(EXAMPLE_SERVICES.values()))['service']['name']
+    slist = [services.Service(name=existing, type='a', port=1),
+             services.Service(name='new', type='a', port=1)]
+    encode = getattr(services, 'servicelist_to_' + test_format)
+    req = aiocoap.Message(code=Code.POST, payload=encode(slist).encode('utf-8'))
+    req.opt.uri_path = ('servicediscovery', 'bulk', 'publish')
+    req.opt.content_format = aiocoap.numbers.media_types_rev['application/' + test_format]
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.CHANGED
+    assert res.opt.content_format == req.opt.content_format
+    assert existing in res.payload.decode('utf-8')
+    assert mydir.service(name='new').type == 'a'
+    assert coap_server_filled.directory_spy.spy.publish_many.call_count == 1
+
+    req.opt.uri_path = ('servicediscovery', 'bulk', 'unpublish')
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.CHANGED
+    assert mydir.service_list(name={'$in': [existing, 'new']}) == []
+
+    req.payload = b'<serviceList'
+    req.opt.content_format = aiocoap.numbers.media_types_rev['application/xml']
+    with pytest.raises(coap.BadRequestError):
+        yield from coap_server.site.render(req)
+
+@pytest.mark.asyncio
+def test_coap_service_etag(coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test ETag and 2.03 Valid responses on /service/{name}"""
+    coap_server = coap_server_filled.coap_server
+    name = next(iter(EXAMPLE_SERVICES.values()))['service']['name']
+    req = aiocoap.Message(code=Code.GET, payload=''.encode('utf-8'))
+    req.opt.uri_path = URI_PATH_SERVICE + (name, )
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.CONTENT
+    req.opt.etags = [res.opt.etag]
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.VALID
+
+@pytest.mark.asyncio
+def test_coap_observe_service(coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test that single services, matched by regex paths, can be observed"""
+    coap_server = coap_server_filled.coap_server
+    name = next(iter(EXAMPLE_SERVICES.values()))['service']['name']
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = URI_PATH_SERVICE + (name, )
+    req.opt.observe = 0
+    observation = mock.Mock(original_request=req)
+    yield from coap_server.site.add_observation(req, observation)
+    assert observation.accept.call_count == 1
+
+@pytest.mark.asyncio
+def test_coap_selective_notify(coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test that only the observers of changed services and types are notified"""
+    coap_server = coap_server_filled.coap_server
+    mydir = coap_server_filled.directory_spy.real
+    first, second = [testcase['service'] for testcase in EXAMPLE_SERVICES.values()][:2]
+    observations = {}
+    for path in (URI_PATH_SERVICE,
+                 URI_PATH_SERVICE + (first['name'], ),
+                 URI_PATH_SERVICE + (second['name'], ),
+                 URI_PATH_TYPE,
+                 URI_PATH_TYPE + (first['type'], ),
+                 URI_PATH_TYPE + ('unrelated', )):
+        req = aiocoap.Message(code=Code.GET)
+        req.opt.uri_path = path
+        req.opt.observe = 0
+        observations[path] = mock.Mock(original_request=req)
+        yield from coap_server.site.add_observation(req, observations[path])
+    mydir.publish(service=services.Service(**first))
+    for path, observation in observations.items():
+        triggered = path in (
+            URI_PATH_SERVICE,
+            URI_PATH_SERVICE + (first['name'], ),
+            URI_PATH_TYPE,
+            URI_PATH_TYPE + (first['type'], ))
+        assert observation.trigger.call_count == (1 if triggered else 0), path
+
+    # Cancelled observations are not notified
+    cancel = observations[URI_PATH_SERVICE].accept.call_args[0][0]
+    cancel()
+    mydir.unpublish(name=first['name'])
+    assert observations[URI_PATH_SERVICE].trigger.call_count == 1
+    assert observations[URI_PATH_SERVICE + (first['name'], )].trigger.call_count == 2
+    assert observations[URI_PATH_SERVICE + (second['name'], )].trigger.call_count == 0
+
+@pytest.mark.asyncio
+def test_coap_coalesced_notify(directory_spy, event_loop): #pylint: disable=redefined-outer-name
+    """Test that observe notifications are coalesced when configured"""
+    with mock.patch('soa.directory.coap.aiocoap.Context'):
+        coap_server = coap.Server(directory=directory_spy.spy, notify_interval=0.05)
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = URI_PATH_SERVICE
+    req.opt.observe = 0
+    observation = mock.Mock(original_request=req)
+    yield from coap_server.site.add_observation(req, observation)
+    for testcase in EXAMPLE_SERVICES.values():
+        directory_spy.real.publish(service=services.Service(**testcase['service']))
+    assert observation.trigger.call_count == 0
+    yield from asyncio.sleep(0.1, loop=event_loop)
+    assert observation.trigger.call_count == 1
+    assert coap_server.site.coalescer.coalescing_ratio == len(EXAMPLE_SERVICES)
+
+def delta_request(*query, observe=None):
+    """Create a GET request for the service list delta representation"""
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = URI_PATH_SERVICE
+    req.opt.uri_query = ('delta', ) + query
+    req.opt.observe = observe
+    return req
+
+@pytest.mark.asyncio
+def test_coap_service_list_delta(coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test the delta representation of the service list"""
+    coap_server = coap_server_filled.coap_server
+    mydir = coap_server_filled.directory_spy.real
+    first, second = [testcase['service'] for testcase in EXAMPLE_SERVICES.values()][:2]
+    res = yield from coap_server.site.render(delta_request())
+    assert res.code == Code.CONTENT
+    full = json.loads(res.payload.decode('utf-8'))
+    assert full['full']
+    assert full['epoch'] == mydir.epoch()
+    assert full['generation'] == mydir.generation()
+    assert len(full['service']) == len(EXAMPLE_SERVICES)
+
+    changed = services.Service(**first)
+    changed.port = 1
+    mydir.publish(service=changed)
+    mydir.unpublish(name=second['name'])
+    since = ('since={}'.format(full['generation']), 'epoch={}'.format(full['epoch']))
+    res = yield from coap_server.site.render(delta_request(*since))
+    delta = json.loads(res.payload.decode('utf-8'))
+    assert 'full' not in delta
+    assert delta['since'] == full['generation']
+    assert delta['generation'] == mydir.generation()
+    assert [services.Service.from_json_dict(srv) for srv in delta['service']] == [changed]
+    assert delta['removed'] == [second['name']]
+
+    # Unknown epoch or generation gives a full list
+    for query in (('since={}'.format(full['generation']), 'epoch=other'),
+                  ('since=12345', 'epoch={}'.format(full['epoch']))):
+        res = yield from coap_server.site.render(delta_request(*query))
+        assert json.loads(res.payload.decode('utf-8'))['full']
+
+    with pytest.raises(coap.BadRequestError):
+        yield from coap_server.site.render(
+            delta_request('since=bogus', 'epoch={}'.format(full['epoch'])))
+
+    req = delta_request()
+    req.opt.accept = aiocoap.numbers.media_types_rev['application/xml']
+    with pytest.raises(coap.NotAcceptableError):
+        yield from coap_server.site.render(req)
+
+@pytest.mark.asyncio
+def test_coap_service_list_delta_observe(coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test that delta notifications are relative to the previous notification"""
+    coap_server = coap_server_filled.coap_server
+    mydir = coap_server_filled.directory_spy.real
+    first, second = [testcase['service'] for testcase in EXAMPLE_SERVICES.values()][:2]
+    req = delta_request(observe=0)
+    req.token = b'\x01\x02'
+    res = yield from coap_server.site.render(req)
+    assert json.loads(res.payload.decode('utf-8'))['full']
+    mydir.unpublish(name=first['name'])
+    res = yield from coap_server.site.render(req)
+    assert json.loads(res.payload.decode('utf-8'))['removed'] == [first['name']]
+    mydir.unpublish(name=second['name'])
+    res = yield from coap_server.site.render(req)
+    delta = json.loads(res.payload.decode('utf-8'))
+    assert delta['removed'] == [second['name']]
+    assert delta['service'] == []
+
+def block_request(number, size_exp=2):
+    """Create a GET request for a block of the service list"""
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = URI_PATH_SERVICE
+    req.opt.block2 = (number, False, size_exp)
+    return req
+
+@pytest.mark.asyncio
+def test_coap_service_list_block2(coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test that all blocks of a transfer are taken from the same cached body"""
+    coap_server = coap_server_filled.coap_server
+    dir_spy = coap_server_filled.directory_spy.spy
+    mydir = coap_server_filled.directory_spy.real
+    res = yield from coap_server.site.render(block_request(0, 6))
+    body = res.payload
+    assert len(body) > 64
+    assert res.opt.block2.block_number == 0
+    assert res.opt.block2.more == (len(body) > 1024)
+    dir_spy.reset_mock()
+    res = yield from coap_server.site.render(block_request(0))
+    assert res.payload == body[:64]
+    assert res.opt.block2.more
+    etag = res.opt.etag
+    # Modify the registry in the middle of the transfer
+    mydir.unpublish(name=next(iter(EXAMPLE_SERVICES.values()))['service']['name'])
+    payload = res.payload
+    number = 0
+    while res.opt.block2.more:
+        number += 1
+        res = yield from coap_server.site.render(block_request(number))
+        assert res.code == Code.CONTENT
+        assert res.opt.block2.block_number == number
+        assert res.opt.etag == etag
+        payload += res.payload
+    assert payload == body
+    assert not dir_spy.service_list.called
+    with pytest.raises(coap.BadOptionError):
+        yield from coap_server.site.render(block_request(number + 1))
+    # A new transfer gets the new body
+    res = yield from coap_server.site.render(block_request(0))
+    assert res.opt.etag != etag
+
+@pytest.mark.parametrize("query, expected", [
+    (('type=_printer-s-ws-https._tcp', ), ['SingleService2']),
+    (('host=bedework.arces.unibo.it.', ), ['SingleService1']),
+    (('domain=arces.unibo.it.', ), ['SingleService1']),
+    (('name=another*', ), ['SingleService2']),
+    (('port=8181', ), ['SingleService1']),
+    (('version=1.0', ), ['SingleService1', 'SingleService2']),
+    (('path=/printer*', ), ['SingleService2']),
+    (('version=1.0', 'name=orch*'), ['SingleService1']),
+    (('name=nomatch*', ), []),
+    ])
+@pytest.mark.asyncio
+def test_coap_service_list_filter(query, expected, coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test filtering the service list with Uri-Query options"""
+    coap_server = coap_server_filled.coap_server
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = URI_PATH_SERVICE
+    req.opt.uri_query = query
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.CONTENT
+    slist = service_list_from_payload(res.payload, 'json')
+    assert sorted(srv.name for srv in slist) == \
+        sorted(EXAMPLE_SERVICES[name]['service']['name'] for name in expected)
+
+@pytest.mark.parametrize("query", [('port=http', ), ('type', )])
+@pytest.mark.asyncio
+def test_coap_service_list_filter_bad(query, coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test that malformed filters are rejected"""
+    coap_server = coap_server_filled.coap_server
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = URI_PATH_SERVICE
+    req.opt.uri_query = query
+    with pytest.raises(coap.BadRequestError):
+        yield from coap_server.site.render(req)
+
+@asyncio.coroutine
+def notify_tasks_done(site):
+    """Wait for the pending filtered observe notifications of a site"""
+    tasks = list(site._notify_tasks) #pylint: disable=protected-access
+    if tasks:
+        yield from asyncio.wait(tasks)
+
+@pytest.mark.asyncio
+def test_coap_filtered_notify(coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test that filtered observations are only notified when the result changes"""
+    coap_server = coap_server_filled.coap_server
+    mydir = coap_server_filled.directory_spy.real
+    first = EXAMPLE_SERVICES['SingleService1']['service']
+    second = EXAMPLE_SERVICES['SingleService2']['service']
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = URI_PATH_SERVICE
+    req.opt.uri_query = ('name=orch*', )
+    req.opt.observe = 0
+    req.token = b'\x01'
+    observation = mock.Mock(original_request=req)
+    yield from coap_server.site.add_observation(req, observation)
+    res = yield from coap_server.site.render(req)
+    assert len(service_list_from_payload(res.payload, 'json')) == 1
+    # Unrelated change
+    mydir.unpublish(name=second['name'])
+    yield from notify_tasks_done(coap_server.site)
+    assert observation.trigger.call_count == 0
+    # Change to the observed service
+    changed = services.Service(**first)
+    changed.port = 1
+    mydir.publish(service=changed)
+    yield from notify_tasks_done(coap_server.site)
+    assert observation.trigger.call_count == 1
+    res = yield from coap_server.site.render(req)
+    assert service_list_from_payload(res.payload, 'json') == [changed]
+    mydir.publish(service=services.Service(**second))
+    yield from notify_tasks_done(coap_server.site)
+    assert observation.trigger.call_count == 1
+
+@pytest.mark.asyncio
+def test_coap_type_filter(coap_server_filled): #pylint: disable=redefined-outer-name
+    """Test filtering the services of a type with Uri-Query options"""
+    coap_server = coap_server_filled.coap_server
+    first = EXAMPLE_SERVICES['SingleService1']['service']
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = URI_PATH_TYPE + (first['type'], )
+    req.opt.uri_query = ('version=1.0', )
+    res = yield from coap_server.site.render(req)
+    assert [srv.name for srv in service_list_from_payload(res.payload, 'json')] == [first['name']]
+    req.opt.uri_query = ('version=2.0', )
+    res = yield from coap_server.site.render(req)
+    assert service_list_from_payload(res.payload, 'json') == []
@@ -0,0 +1,99 @@
+"""Test soa.directory.coapsite"""
+#pylint: disable=no-member
+# pylint doesn't understand mock objects
+
+from unittest import mock
+
+import pytest
+
+import link_header
+from aiocoap.numbers.codes import Code
+import aiocoap
+
+from soa.directory import coapsite
+
+def test_route_node():
+    """Test path lookups in the routing tree"""
+    routes = coapsite.RouteNode()
+    routes.insert(('a', 'b'), 'exact')
+    routes.insert(('a', coapsite.PathRegex('[0-9]+')), 'number')
+    routes.insert(('a', coapsite.PathRegex('[0-9a-f]+')), 'hex')
+    routes.insert(('a', coapsite.PathRegex('x.*'), 'c'), 'deep')
+    assert routes.lookup(('a', 'b')) == ['exact']
+    assert routes.lookup(('a', 'ff')) == ['hex']
+    assert sorted(routes.lookup(('a', '12'))) == ['hex', 'number']
+    assert routes.lookup(('a', 'xyz', 'c')) == ['deep']
+    assert routes.lookup(('a', 'xyz')) == []
+    assert routes.lookup(('a', )) == []
+    assert routes.lookup(('a', 'b', 'c')) == []
+    assert routes.lookup(('q', )) == []
+
+@pytest.mark.asyncio
+def test_coap_site_routing():
+    """Test Site request routing, including removal of resources"""
+    site = coapsite.Site()
+    first = mock.Mock()
+    second = mock.Mock()
+    site.add_resource(('x', coapsite.PathRegex('.*')), first)
+    site.add_resource(('x', coapsite.PathRegex('[a-z]+')), second)
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = ('x', '123')
+    yield from site.render(req)
+    assert first.render.call_count == 1
+    req.opt.uri_path = ('x', 'abc')
+    with pytest.raises(aiocoap.error.RenderableError):
+        yield from site.render(req)
+    site.remove_resource(('x', coapsite.PathRegex('.*')))
+    yield from site.render(req)
+    assert second.render.call_count == 1
+    req.opt.uri_path = ('x', '123')
+    with pytest.raises(aiocoap.error.NoResource):
+        yield from site.render(req)
+
+def test_attributes_match():
+    """Test link attribute filtering"""
+    attributes = [['rt', 'temperature-c core.s'], ['if', 'sensor'], ['ep', 'node1']]
+    assert coapsite.attributes_match(attributes, {})
+    assert coapsite.attributes_match(attributes, {'rt': 'core.s'})
+    assert coapsite.attributes_match(attributes, {'rt': 'temp*', 'ep': 'node1'})
+    assert not coapsite.attributes_match(attributes, {'rt': 'light'})
+    assert not coapsite.attributes_match(attributes, {'ct': '*'})
+
+@pytest.mark.asyncio
+def test_well_known_core():
+    """Test the cached /.well-known/core document and its query filters"""
+    site = coapsite.Site()
+    first = coapsite.Resource()
+    first.rt = 'core.rd'
+    site.add_resource(('rd', ), first)
+    site.add_resource(('rd-lookup', 'res'), coapsite.Resource())
+    wkc = coapsite.WellKnownCoreResource(site)
+    site.add_resource(('.well-known', 'core'), wkc)
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = ('.well-known', 'core')
+    res = yield from site.render(req)
+    assert res.opt.content_format == aiocoap.numbers.media_types_rev['application/link-format']
+    hrefs = sorted(link.href for link in link_header.parse(res.payload.decode('utf-8')).links)
+    assert hrefs == ['/.well-known/core', '/rd', '/rd-lookup/res']
+
+    with mock.patch.object(coapsite.resource.Site, 'get_resources_as_linkheader') as build:
+        for query in (('rt=core.rd', ), ('href=/rd*', ), ()):
+            req.opt.uri_query = query
+            yield from site.render(req)
+        assert not build.called
+    req.opt.uri_query = ('rt=core.rd', )
+    res = yield from site.render(req)
+    assert [link.href for link in link_header.parse(res.payload.decode('utf-8')).links] == ['/rd']
+    req.opt.uri_query = ('href=/rd*', )
+    res = yield from site.render(req)
+    assert len(link_header.parse(res.payload.decode('utf-8')).links) == 2
+
+    req.opt.etag = res.opt.etag
+    res = yield from site.render(req)
+    assert res.code == Code.VALID
+
+    # Adding a resource invalidates the cache
+    site.add_resource(('rd-lookup', 'ep'), coapsite.Resource())
+    req.opt.etag = None
+    res = yield from site.render(req)
+    assert len(link_header.parse(res.payload.decode('utf-8')).links) == 3
@@ -2,6 +2,7 @@
 #pylint: disable=no-member
 # pylint doesn't understand mock objects
 
+import asyncio
 from unittest import mock
 import tempfile
 
@@ -136,3 +137,287 @@ def test_servicedir_callbacks(temp_dir): #pylint: disable=redefined-outer-name
     temp_dir.del_notify_callback(callback)
     temp_dir.unpublish(name=service.name)
     assert callback.call_count == 2
+
+def test_servicedir_generation(temp_dir): #pylint: disable=redefined-outer-name
+    """Test that ServiceDirectory.generation changes whenever the registry is modified"""
+    generations = [temp_dir.generation()]
+    assert temp_dir.generation() == generations[-1]
+    for service_dict in EXAMPLE_SERVICES.values():
+        temp_dir.publish(service=services.Service(**service_dict['service']))
+        assert temp_dir.generation() not in generations
+        generations.append(temp_dir.generation())
+    for service_dict in EXAMPLE_SERVICES.values():
+        temp_dir.unpublish(name=service_dict['service']['name'])
+        assert temp_dir.generation() not in generations
+        generations.append(temp_dir.generation())
+    with pytest.raises(temp_dir.DoesNotExist):
+        temp_dir.unpublish(name='nonexistant')
+    assert temp_dir.generation() == generations[-1]
+
+def test_servicedir_generation_expiry(temp_dir): #pylint: disable=redefined-outer-name
+    """Test that timed out services advance the generation"""
+    service = services.Service(name='testservice', type='testtype')
+    with mock.patch('soa.directory.directory.unix_now', return_value=1000):
+        temp_dir.publish(service=service)
+        generation = temp_dir.generation()
+        assert temp_dir.next_deadline() == 1000 + temp_dir.config_defaults['lifetime']
+    deadline = temp_dir.next_deadline()
+    with mock.patch('soa.directory.directory.unix_now', return_value=deadline):
+        assert temp_dir.generation() == generation
+        assert len(temp_dir.service_list()) == 1
+    with mock.patch('soa.directory.directory.unix_now', return_value=deadline + 1):
+        assert temp_dir.generation() != generation
+        assert len(temp_dir.service_list()) == 0
+        assert temp_dir.next_deadline() is None
+
+def test_servicedir_last_modified(temp_dir): #pylint: disable=redefined-outer-name
+    """Test ServiceDirectory.last_modified"""
+    assert temp_dir.last_modified() is None
+    with mock.patch('soa.directory.directory.unix_now', return_value=1000):
+        temp_dir.publish(service=services.Service(name='first', type='a'))
+    with mock.patch('soa.directory.directory.unix_now', return_value=2000):
+        temp_dir.publish(service=services.Service(name='second', type='b'))
+        assert temp_dir.last_modified() == 2000
+        assert temp_dir.last_modified(type='a') == 1000
+        assert temp_dir.last_modified(name='second') == 2000
+        assert temp_dir.last_modified(type='c') is None
+
+def test_servicedir_change_events(temp_dir): #pylint: disable=redefined-outer-name
+    """Test that notify callbacks are passed a description of each change"""
+    callback = mock.MagicMock()
+    temp_dir.add_notify_callback(callback)
+    temp_dir.publish(service=services.Service(name='first', type='a'))
+    event = callback.call_args[0][0]
+    assert event.kind == directory.ChangeEvent.PUBLISH
+    assert (event.name, event.type, event.old_type) == ('first', 'a', None)
+    assert event.types == {'a'}
+    assert event.generation == temp_dir.generation()
+    temp_dir.publish(service=services.Service(name='first', type='b'))
+    event = callback.call_args[0][0]
+    assert event.types == {'a', 'b'}
+    temp_dir.unpublish(name='first')
+    event = callback.call_args[0][0]
+    assert event.kind == directory.ChangeEvent.UNPUBLISH
+    assert (event.name, event.type) == ('first', 'b')
+
+    with mock.patch('soa.directory.directory.unix_now', return_value=1000):
+        temp_dir.publish(service=services.Service(name='second', type='c'))
+    callback.reset_mock()
+    with mock.patch('soa.directory.directory.unix_now', return_value=1000000):
+        temp_dir.generation()
+    assert callback.call_count == 1
+    event = callback.call_args[0][0]
+    assert event.kind == directory.ChangeEvent.EXPIRE
+    assert (event.name, event.type) == ('second', 'c')
+
+def test_servicedir_publish_many(temp_dir): #pylint: disable=redefined-outer-name
+    """Test publishing and removing services in batches"""
+    callback = mock.MagicMock()
+    temp_dir.add_notify_callback(callback)
+    temp_dir.publish(service=services.Service(name='first', type='a'))
+    existed = temp_dir.publish_many(services=[
+        services.Service(name='first', type='b'),
+        services.Service(name='second', type='a'),
+        services.Service(name='second', type='c')])
+    assert existed == [(True, 1800), (False, 1800), (True, 1800)]
+    assert {(srv.name, srv.type) for srv in temp_dir.service_list()} == \
+        {('first', 'b'), ('second', 'c')}
+    # Every service still gets its own change event
+    events = [call[0][0] for call in callback.call_args_list]
+    assert [(event.name, event.type, event.old_type) for event in events[1:]] == [
+        ('first', 'b', 'a'), ('second', 'a', None), ('second', 'c', 'a')]
+    assert temp_dir.generation() == 4
+
+    assert temp_dir.unpublish_many(names=['first', 'missing', 'first']) == \
+        [True, False, False]
+    assert [srv.name for srv in temp_dir.service_list()] == ['second']
+    assert temp_dir.generation() == 5
+    assert temp_dir.publish_many(services=[]) == []
+
+def test_servicedir_lifetimes():
+    """Test requested and per-type lease lifetimes"""
+    mydir = directory.ServiceDirectory(config={
+        'min_lifetime': 10, 'max_lifetime': 1000, 'type_lifetimes': {'static': 900}})
+    with mock.patch('soa.directory.directory.unix_now', return_value=1000):
+        assert mydir.publish(service=services.Service(name='a', type='static')) == 900
+        assert mydir.publish(service=services.Service(name='b', type='x')) == 1000
+        assert mydir.next_deadline() == 1900
+        assert mydir.publish(service=services.Service(name='c', type='x'), lifetime=5) == 10
+        assert mydir.next_deadline() == 1010
+        assert mydir.publish(service=services.Service(name='c', type='x'), lifetime=20) == 20
+        # Updates without a requested lifetime keep the previous one
+        assert mydir.publish(service=services.Service(name='c', type='y')) == 20
+        assert mydir.publish_many(services=[services.Service(name='d')], lifetimes=[50]) == \
+            [(False, 50)]
+    assert 'lifetime' not in mydir.service(name='c').to_dict()
+    with pytest.raises(directory.DirectoryException):
+        directory.ServiceDirectory(config={'lifetme': 10})
+
+def test_capacity_policy():
+    """Test admission and eviction decisions"""
+    records = {
+        'a': {'name': 'a', 'host': 'h1', 'domain': 'd', 'deadline': 300, 'updated': 100},
+        'b': {'name': 'b', 'host': 'h1', 'domain': 'd', 'deadline': 200, 'updated': 200},
+        'c': {'name': 'c', 'host': 'h2', 'domain': 'd', 'deadline': 100, 'updated': 300},
+    }
+    new = services.Service(name='n', host='h1', domain='d')
+    assert directory.CapacityPolicy().admit(records, [new]) == []
+    policy = directory.CapacityPolicy(max_per_host=2, eviction='nearest-deadline')
+    assert [record['name'] for record in policy.admit(records, [new])] == ['b']
+    # Renewals do not take up more room
+    assert policy.admit(records, [services.Service(name='a', host='h1')]) == []
+    policy = directory.CapacityPolicy(max_services=3, eviction='least-recently-renewed')
+    assert [record['name'] for record in policy.admit(records, [new])] == ['a']
+    policy = directory.CapacityPolicy(max_per_domain=3)
+    with pytest.raises(directory.QuotaExceeded) as excinfo:
+        policy.admit(records, [new])
+    assert 'per domain d' in str(excinfo.value)
+    # Services of the same batch are not evicted for each other
+    policy = directory.CapacityPolicy(max_per_host=1, eviction='nearest-deadline')
+    with pytest.raises(directory.QuotaExceeded):
+        policy.admit({}, [new, services.Service(name='m', host='h1')])
+    with pytest.raises(directory.DirectoryException):
+        directory.CapacityPolicy(eviction='random')
+
+def test_servicedir_capacity():
+    """Test eviction and rejection of services"""
+    mydir = directory.ServiceDirectory(config={
+        'max_services': 2, 'eviction_policy': 'nearest-deadline'})
+    callback = mock.MagicMock()
+    mydir.add_notify_callback(callback)
+    since = mydir.generation()
+    mydir.publish(service=services.Service(name='a', type='t'), lifetime=100)
+    mydir.publish(service=services.Service(name='b', type='t'), lifetime=200)
+    mydir.publish(service=services.Service(name='c', type='t'), lifetime=300)
+    assert sorted(srv.name for srv in mydir.service_list()) == ['b', 'c']
+    event = callback.call_args_list[-2][0][0]
+    assert (event.kind, event.name, event.type) == (directory.ChangeEvent.EVICT, 'a', 't')
+    assert [(entry.name, entry.operation) for entry in mydir.changes_since(since).changes] == [
+        ('b', directory.ChangeLogEntry.UPSERT), ('a', directory.ChangeLogEntry.EVICT),
+        ('c', directory.ChangeLogEntry.UPSERT)]
+    assert mydir.stats['evicted'] == 1
+
+    mydir = directory.ServiceDirectory(config={'max_services_per_host': 1})
+    mydir.publish(service=services.Service(name='a', host='h'))
+    with pytest.raises(directory.QuotaExceeded):
+        mydir.publish_many(services=[services.Service(name='b', host='g'),
+                                     services.Service(name='c', host='h')])
+    # Rejected batches are not applied at all
+    assert [srv.name for srv in mydir.service_list()] == ['a']
+    assert mydir.stats['rejected'] == 1
+
+def test_servicedir_changes_since(temp_dir): #pylint: disable=redefined-outer-name
+    """Test the change feed of ServiceDirectory"""
+    start = temp_dir.generation()
+    epoch = temp_dir.epoch()
+    assert temp_dir.changes_since(None).resync
+    temp_dir.publish(service=services.Service(name='first', type='a'))
+    temp_dir.publish(service=services.Service(name='second', type='b'))
+    temp_dir.publish(service=services.Service(name='first', type='c'))
+    changes = temp_dir.changes_since(start, epoch=epoch)
+    assert not changes.resync
+    assert (changes.since, changes.generation) == (start, temp_dir.generation())
+    # Only the latest change of each service is reported
+    assert [(entry.name, entry.operation, entry.type) for entry in changes.changes] == [
+        ('second', directory.ChangeLogEntry.UPSERT, 'b'),
+        ('first', directory.ChangeLogEntry.UPSERT, 'c')]
+    assert changes.changes[-1].service == services.Service(name='first', type='c')
+    assert temp_dir.changes_since(temp_dir.generation()).changes == []
+
+    since = temp_dir.generation()
+    temp_dir.publish(service=services.Service(name='first', type='c'))
+    temp_dir.unpublish(name='second')
+    changes = temp_dir.changes_since(since)
+    assert [(entry.name, entry.operation) for entry in changes.changes] == [
+        ('first', directory.ChangeLogEntry.RENEW),
+        ('second', directory.ChangeLogEntry.DELETE)]
+    # Removals are reported as tombstones
+    assert changes.changes[-1].service is None
+    assert changes.to_json_dict()['changes'][-1] == {
+        'sequence': temp_dir.generation(), 'op': 'delete', 'name': 'second', 'type': 'b'}
+
+    # Sequence numbers from the future or another epoch require a resync
+    assert temp_dir.changes_since(temp_dir.generation() + 1).resync
+    assert temp_dir.changes_since(since, epoch='other').resync
+    assert temp_dir.changes_since(since, epoch='other').to_json_dict() == {
+        'epoch': epoch, 'generation': temp_dir.generation(), 'resync': True}
+
+def test_servicedir_deadline_tracking(temp_dir): #pylint: disable=redefined-outer-name
+    """Test that the records are only scanned when the nearest deadline goes away"""
+    with mock.patch('soa.directory.directory.unix_now', return_value=1000):
+        temp_dir.publish(service=services.Service(name='a'), lifetime=100)
+        find = temp_dir._find_next_deadline #pylint: disable=protected-access
+        with mock.patch.object(temp_dir, '_find_next_deadline', wraps=find) as scan:
+            temp_dir.publish(service=services.Service(name='b'), lifetime=200)
+            temp_dir.unpublish(name='b')
+            assert (scan.call_count, temp_dir.next_deadline()) == (0, 1100)
+            temp_dir.publish(service=services.Service(name='a'), lifetime=300)
+            assert (scan.call_count, temp_dir.next_deadline()) == (1, 1300)
+
+def test_servicedir_changes_since_reopened():
+    """Test that a registry loaded from its database requires a resync"""
+    with tempfile.TemporaryDirectory() as db_dir:
+        mydir = directory.ServiceDirectory(database=db_dir)
+        assert not mydir.changes_since(0).resync
+        mydir.publish(service=services.Service(name='first'))
+        reopened = directory.ServiceDirectory(database=db_dir)
+        assert reopened.generation() == 1
+        assert reopened.changes_since(0).resync
+        assert reopened.changes_since(0).to_json_dict()['resync']
+        reopened.publish(service=services.Service(name='second'))
+        assert reopened.changes_since(0).resync
+        assert [entry.name for entry in reopened.changes_since(1).changes] == ['second']
+
+def test_servicedir_changes_since_trimmed(temp_dir): #pylint: disable=redefined-outer-name
+    """Test that a resync is required when the change log has been trimmed"""
+    mydir = temp_dir
+    mydir._changelog = directory.ChangeLog(2) #pylint: disable=protected-access
+    start = mydir.generation()
+    for name in ('first', 'second', 'third'):
+        mydir.publish(service=services.Service(name=name, type='a'))
+    assert mydir.changes_since(start).resync
+    changes = mydir.changes_since(start + 1)
+    assert [entry.name for entry in changes.changes] == ['second', 'third']
+
+    since = mydir.generation()
+    now = mydir.next_deadline() + 1
+    with mock.patch('soa.directory.directory.unix_now', return_value=now):
+        assert mydir.changes_since(since).resync
+        changes = mydir.changes_since(since + 1)
+    assert [entry.operation for entry in changes.changes] == \
+        [directory.ChangeLogEntry.EXPIRE] * 2
+
+@pytest.mark.asyncio
+def test_notify_coalescer(event_loop):
+    """Test that NotifyCoalescer merges bursts of events into one callback"""
+    callback = mock.MagicMock()
+    coalescer = directory.NotifyCoalescer(callback, min_interval=0.05, loop=event_loop)
+    assert coalescer.coalescing_ratio is None
+    events = [directory.ChangeEvent(directory.ChangeEvent.PUBLISH, str(i)) for i in range(10)]
+    for event in events:
+        coalescer(event)
+    assert callback.call_count == 0
+    yield from asyncio.sleep(0.1, loop=event_loop)
+    callback.assert_called_once_with(events)
+    assert coalescer.coalescing_ratio == 10
+    coalescer(events[0])
+    coalescer.flush()
+    assert callback.call_count == 2
+    assert coalescer.coalescing_ratio == 5.5
+    coalescer(events[0])
+    coalescer.cancel()
+    yield from asyncio.sleep(0.1, loop=event_loop)
+    assert callback.call_count == 2
+
+@pytest.mark.asyncio
+def test_notify_coalescer_max_delay(event_loop):
+    """Test that a steady stream of events does not hold back notifications forever"""
+    callback = mock.MagicMock()
+    coalescer = directory.NotifyCoalescer(
+        callback, min_interval=0.05, max_delay=0.1, loop=event_loop)
+    for i in range(20):
+        coalescer(directory.ChangeEvent(directory.ChangeEvent.PUBLISH, str(i)))
+        yield from asyncio.sleep(0.01, loop=event_loop)
+    assert callback.call_count >= 1
+    coalescer.flush()
+    assert sum(len(call[0][0]) for call in callback.call_args_list) == 20
@@ -0,0 +1,388 @@
+"""Test soa.directory.http"""
+#pylint: disable=no-member
+# pylint doesn't understand mock objects
+
+import asyncio
+import gzip
+from unittest import mock
+import tempfile
+import json
+import xml.etree.ElementTree as ET
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient as HTTPClient, make_mocked_request
+
+from soa import services
+from soa.directory import directory
+from soa.directory import http
+from soa.directory import ratelimit
+
+from ..test_data import EXAMPLE_SERVICES
+
+@pytest.yield_fixture
+def http_server(event_loop):
+    """Create a HTTP server with a pre-populated directory"""
+    with tempfile.TemporaryDirectory() as db_dir:
+        mydir = directory.ServiceDirectory(database=db_dir)
+        for testcase in EXAMPLE_SERVICES.values():
+            mydir.publish(service=services.Service(**testcase['service']))
+        yield http.Server(directory=mydir, loop=event_loop)
+
+def test_etag_matches():
+    """Test If-None-Match parsing"""
+    assert http.etag_matches('"abc"', '"abc"')
+    assert http.etag_matches('W/"abc"', '"abc"')
+    assert http.etag_matches('"xyz", "abc"', '"abc"')
+    assert http.etag_matches('*', '"abc"')
+    assert not http.etag_matches('"xyz"', '"abc"')
+    assert not http.etag_matches(None, '"abc"')
+    assert not http.etag_matches('', '"abc"')
+
+@pytest.mark.asyncio
+def test_http_service_list_conditional(http_server): #pylint: disable=redefined-outer-name
+    """Test ETag and If-None-Match handling on the service list"""
+    req = make_mocked_request(
+        'GET', '/servicediscovery/service', headers={'Accept': 'application/json'})
+    res = yield from http_server.service_list_get(req)
+    assert res.status == 200
+    etag = res.headers['ETag']
+    assert res.last_modified is not None
+    slist = json.loads(res.body.decode('utf-8'))
+    assert len(slist['service']) == len(EXAMPLE_SERVICES)
+
+    req = make_mocked_request(
+        'GET', '/servicediscovery/service',
+        headers={'Accept': 'application/json', 'If-None-Match': etag})
+    res = yield from http_server.service_list_get(req)
+    assert res.status == 304
+    assert res.headers['ETag'] == etag
+    assert not res.body
+
+    req = make_mocked_request(
+        'GET', '/servicediscovery/service',
+        headers={'Accept': 'application/xml', 'If-None-Match': etag})
+    res = yield from http_server.service_list_get(req)
+    assert res.status == 200
+    assert res.headers['ETag'] != etag
+
+    # Changing the registry must invalidate the entity tag
+    http_server._directory.directory.unpublish( #pylint: disable=protected-access
+        name=next(iter(EXAMPLE_SERVICES.values()))['service']['name'])
+    req = make_mocked_request(
+        'GET', '/servicediscovery/service',
+        headers={'Accept': 'application/json', 'If-None-Match': etag})
+    res = yield from http_server.service_list_get(req)
+    assert res.status == 200
+    assert res.headers['ETag'] != etag
+
+@pytest.mark.asyncio
+def test_http_type_list_conditional(http_server): #pylint: disable=redefined-outer-name
+    """Test ETag and If-None-Match handling on the type list"""
+    req = make_mocked_request(
+        'GET', '/servicediscovery/type', headers={'Accept': 'application/json'})
+    res = yield from http_server.type_list_get(req)
+    assert res.status == 200
+    req = make_mocked_request(
+        'GET', '/servicediscovery/type',
+        headers={'Accept': 'application/json', 'If-None-Match': res.headers['ETag']})
+    res = yield from http_server.type_list_get(req)
+    assert res.status == 304
+
+def test_choose_coding():
+    """Test Accept-Encoding negotiation"""
+    assert http.choose_coding(None) is None
+    assert http.choose_coding('') is None
+    assert http.choose_coding('gzip') == 'gzip'
+    assert http.choose_coding('deflate, gzip') == 'gzip'
+    assert http.choose_coding('gzip;q=0.5, deflate') == 'deflate'
+    assert http.choose_coding('gzip;q=0, deflate;q=0') is None
+    assert http.choose_coding('*') == 'gzip'
+    assert http.choose_coding('br') is None
+    assert http.choose_coding('gzip;q=0.5, identity') is None
+
+@pytest.mark.asyncio
+def test_http_service_list_compression(http_server): #pylint: disable=redefined-outer-name
+    """Test that large bodies are compressed, and that the compressed body is cached"""
+    http_server.compression_threshold = 1
+    headers = {'Accept': 'application/xml', 'Accept-Encoding': 'gzip, deflate'}
+    req = make_mocked_request('GET', '/servicediscovery/service', headers=headers)
+    res = yield from http_server.service_list_get(req)
+    assert res.status == 200
+    assert res.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in res.headers['Vary']
+    plain = gzip.decompress(res.body)
+    assert plain.startswith(b'<serviceList>')
+    etag = res.headers['ETag']
+
+    req = make_mocked_request('GET', '/servicediscovery/service', headers=headers)
+    res2 = yield from http_server.service_list_get(req)
+    assert res2.body is res.body
+
+    req = make_mocked_request(
+        'GET', '/servicediscovery/service', headers={'Accept': 'application/xml'})
+    res = yield from http_server.service_list_get(req)
+    assert 'Content-Encoding' not in res.headers
+    assert res.body == plain
+    assert res.headers['ETag'] != etag
+
+    headers['If-None-Match'] = etag
+    req = make_mocked_request('GET', '/servicediscovery/service', headers=headers)
+    res = yield from http_server.service_list_get(req)
+    assert res.status == 304
+
+    http_server.compression_threshold = len(plain) + 1
+    req = make_mocked_request(
+        'GET', '/servicediscovery/service',
+        headers={'Accept': 'application/xml', 'Accept-Encoding': 'deflate'})
+    res = yield from http_server.service_list_get(req)
+    assert 'Content-Encoding' not in res.headers
+
+JSON_XML = ('application/json', 'application/xml')
+
+@pytest.mark.parametrize('header,expected', [
+    ('', None),
+    ('application/json', 'application/json'),
+    ('application/xml', 'application/xml'),
+    ('application/xml, application/json', 'application/xml'),
+    ('application/json;q=0.5, application/xml', 'application/xml'),
+    ('application/*', 'application/json'),
+    ('*/*', 'application/json'),
+    ('*', 'application/json'),
+    ('text/html, */*;q=0.1', 'application/json'),
+    ('application/*, application/json;q=0', 'application/xml'),
+    ('APPLICATION/XML; charset=utf-8', 'application/xml'),
+    ('application/xml;q=0.8, application/json;q=0.9', 'application/json'),
+    ('application/json;q=bogus, application/xml', 'application/xml'),
+])
+def test_accept_negotiator(header, expected):
+    """Test Accept header negotiation"""
+    negotiator = http.AcceptNegotiator()
+    assert negotiator.negotiate(header, JSON_XML) == expected
+
+@pytest.mark.parametrize('header', [
+    'text/html',
+    'application/json;q=0, application/xml;q=0',
+    '*/*;q=0',
+    'text/*',
+])
+def test_accept_negotiator_not_acceptable(header):
+    """Test Accept headers which do not match any available type"""
+    negotiator = http.AcceptNegotiator()
+    assert negotiator.negotiate(header, JSON_XML) is http.AcceptNegotiator.NOT_ACCEPTABLE
+
+def test_accept_negotiator_memo():
+    """Test that negotiation results are memoised in a bounded cache"""
+    negotiator = http.AcceptNegotiator(maxsize=2)
+    with mock.patch.object(negotiator, 'compile', wraps=negotiator.compile) as compile_spy:
+        for _ in range(3):
+            assert negotiator.negotiate('application/xml', JSON_XML) == 'application/xml'
+        assert compile_spy.call_count == 1
+        assert negotiator.negotiate('application/xml', JSON_XML[:1]) is \
+            http.AcceptNegotiator.NOT_ACCEPTABLE
+        negotiator.negotiate('application/json', JSON_XML)
+        negotiator.negotiate('application/xml', JSON_XML)
+        assert compile_spy.call_count == 4
+    negotiator = http.AcceptNegotiator()
+    with mock.patch.object(negotiator, 'compile', wraps=negotiator.compile) as compile_spy:
+        for header in ('', '', None, 'garbage', 'garbage'):
+            negotiator.negotiate(header, JSON_XML)
+        assert negotiator.negotiate('', JSON_XML) is None
+        assert negotiator.negotiate('garbage', JSON_XML) is None
+        assert compile_spy.call_count == 2
+
+@pytest.mark.asyncio
+def test_http_not_acceptable(http_server): #pylint: disable=redefined-outer-name
+    """Test that unsupported Accept headers give 406 Not Acceptable"""
+    req = make_mocked_request(
+        'GET', '/servicediscovery/service', headers={'Accept': 'text/html'})
+    with pytest.raises(web.HTTPNotAcceptable):
+        yield from http_server.service_list_get(req)
+
+@pytest.mark.asyncio
+def test_http_changes(http_server): #pylint: disable=redefined-outer-name
+    """Test the change feed resource"""
+    mydir = http_server._directory.directory #pylint: disable=protected-access
+    since = mydir.generation()
+    name = next(iter(EXAMPLE_SERVICES.values()))['service']['name']
+    mydir.unpublish(name=name)
+    req = make_mocked_request(
+        'GET', '/servicediscovery/changes?since={}&epoch={}'.format(since, mydir.epoch()),
+        headers={'Accept': 'application/json'})
+    res = yield from http_server.changes_get(req)
+    assert res.status == 200
+    changes = json.loads(res.body.decode('utf-8'))
+    assert (changes['since'], changes['generation']) == (since, since + 1)
+    assert [(entry['op'], entry['name']) for entry in changes['changes']] == \
+        [('delete', name)]
+
+    req = make_mocked_request('GET', '/servicediscovery/changes?since=0&epoch=other')
+    res = yield from http_server.changes_get(req)
+    assert json.loads(res.body.decode('utf-8'))['resync']
+
+    req = make_mocked_request('GET', '/servicediscovery/changes?since=x')
+    with pytest.raises(web.HTTPBadRequest):
+        yield from http_server.changes_get(req)
+
+def test_format_sse():
+    """Test encoding Server-Sent Events messages"""
+    assert http.format_sse('a\nb', event='change', event_id='e/1') == \
+        b'event: change\nid: e/1\ndata: a\ndata: b\n\n'
+    assert http.format_sse(comment='heartbeat') == b': heartbeat\n\n'
+
+def test_event_filter():
+    """Test matching changes against type and name query parameters"""
+    req = make_mocked_request('GET', '/servicediscovery/events?type=a&name=x*&name=y')
+    matches = http.event_filter(req.query)
+    assert matches('x1', {'a'})
+    assert matches('y', {'a', 'b'})
+    assert not matches('y1', {'a'})
+    assert not matches('x1', {'b'})
+    assert http.event_filter(make_mocked_request('GET', '/').query)('z', {'b'})
+
+@asyncio.coroutine
+def read_sse(response):
+    """Read the next message of an event stream, skipping heartbeats"""
+    fields = {}
+    while True:
+        line = (yield from response.content.readline()).decode('utf-8').rstrip('\n')
+        if not line:
+            if fields:
+                return fields
+            continue
+        key, _, value = line.partition(': ')
+        if key:
+            fields[key] = value
+
+@pytest.mark.asyncio
+def test_http_events(http_server): #pylint: disable=redefined-outer-name
+    """Test streaming change events"""
+    http_server.heartbeat_interval = 0.01
+    mydir = http_server._directory.directory #pylint: disable=protected-access
+    client = HTTPClient(http_server)
+    yield from client.start_server()
+    try:
+        response = yield from client.get('/servicediscovery/events?type=b')
+        assert response.headers['Content-Type'] == 'text/event-stream'
+        sync = yield from read_sse(response)
+        assert sync['event'] == 'sync'
+        assert json.loads(sync['data'])['generation'] == mydir.generation()
+        mydir.publish(service=services.Service(name='first', type='a'))
+        mydir.publish(service=services.Service(name='second', type='b'))
+        change = yield from read_sse(response)
+        assert change['event'] == 'change'
+        assert change['id'] == '{}/{}'.format(mydir.epoch(), mydir.generation())
+        assert json.loads(change['data']) == {
+            'sequence': mydir.generation(), 'op': 'upsert', 'name': 'second', 'type': 'b'}
+        response.close()
+
+        # Reconnecting clients receive the changes they missed
+        mydir.unpublish(name='second')
+        response = yield from client.get(
+            '/servicediscovery/events?type=b', headers={'Last-Event-ID': change['id']})
+        change = yield from read_sse(response)
+        assert json.loads(change['data'])['op'] == 'delete'
+        assert (yield from read_sse(response))['event'] == 'sync'
+        response.close()
+
+        response = yield from client.get(
+            '/servicediscovery/events', headers={'Last-Event-ID': 'other/1'})
+        assert (yield from read_sse(response))['event'] == 'resync'
+        yield from http_server.shutdown()
+        assert (yield from response.content.read()) == b''
+    finally:
+        yield from client.close()
+
+@pytest.mark.asyncio
+def test_http_bulk_publish(http_server): #pylint: disable=redefined-outer-name
+    """Test publishing and removing services in batches"""
+    mydir = http_server._directory.directory #pylint: disable=protected-access
+    existing = next(iter(EXAMPLE_SERVICES.values()))['service']['name']
+    slist = [services.Service(name=existing, type='a'), services.Service(name='new', type='a'),
+             services.Service(type='a')]
+    req = make_mocked_request(
+        'POST', '/servicediscovery/bulk/publish', headers={'Content-Type': 'application/json'})
+    req.text = asyncio.coroutine(lambda: services.servicelist_to_json(slist))
+    res = yield from http_server.bulk_publish_post(req)
+    assert res.status == 200
+    assert json.loads(res.body.decode('utf-8'))['status'] == [
+        {'name': existing, 'status': 'updated', 'lifetime': 1800},
+        {'name': 'new', 'status': 'created', 'lifetime': 1800},
+        {'name': None, 'status': 'invalid'}]
+    assert mydir.service(name='new').type == 'a'
+
+    req = make_mocked_request(
+        'POST', '/servicediscovery/bulk/unpublish', headers={'Content-Type': 'application/xml'})
+    req.text = asyncio.coroutine(lambda: services.servicelist_to_xml(
+        [services.Service(name='new', port=1), services.Service(name='missing', port=1)]))
+    res = yield from http_server.bulk_unpublish_post(req)
+    assert res.content_type == 'application/xml'
+    root = ET.fromstring(res.body.decode('utf-8'))
+    assert [node.find('status').text for node in root] == ['deleted', 'not-found']
+
+    req = make_mocked_request(
+        'POST', '/servicediscovery/bulk/publish', headers={'Content-Type': 'application/json'})
+    req.text = asyncio.coroutine(lambda: '{"service": 1}')
+    with pytest.raises(web.HTTPBadRequest):
+        yield from http_server.bulk_publish_post(req)
+
+@pytest.mark.asyncio
+def test_http_publish_lifetime(http_server): #pylint: disable=redefined-outer-name
+    """Test requesting a lease lifetime"""
+    service = services.Service(name='new', type='a')
+    req = make_mocked_request(
+        'POST', '/servicediscovery/publish?lifetime=120',
+        headers={'Content-Type': 'application/json'})
+    req.text = asyncio.coroutine(service.to_json)
+    res = yield from http_server.publish_post(req)
+    assert res.status == 201
+    assert res.headers[http.LIFETIME_HEADER] == '120'
+
+    req = make_mocked_request(
+        'POST', '/servicediscovery/publish?lifetime=0',
+        headers={'Content-Type': 'application/json'})
+    req.text = asyncio.coroutine(service.to_json)
+    with pytest.raises(web.HTTPBadRequest):
+        yield from http_server.publish_post(req)
+
+@pytest.mark.asyncio
+def test_http_publish_quota(event_loop):
+    """Test that services exceeding a quota are rejected"""
+    mydir = directory.ServiceDirectory(config={'max_services': 1})
+    mydir.publish(service=services.Service(name='first'))
+    http_server = http.Server(directory=mydir, loop=event_loop)
+    req = make_mocked_request(
+        'POST', '/servicediscovery/publish', headers={'Content-Type': 'application/json'})
+    req.text = asyncio.coroutine(services.Service(name='second').to_json)
+    with pytest.raises(web.HTTPForbidden) as excinfo:
+        yield from http_server.publish_post(req)
+    assert 'at most 1 services' in excinfo.value.reason
+    assert http_server._directory.stats['rejected'] == 1 #pylint: disable=protected-access
+
+@pytest.mark.asyncio
+def test_http_rate_limit(http_server): #pylint: disable=redefined-outer-name
+    """Test that clients over their rate limit get 429 Too Many Requests"""
+    http_server.rate_limiter = ratelimit.RateLimiter(0.5, 1)
+    for expected in (None, web.HTTPTooManyRequests):
+        req = make_mocked_request(
+            'POST', '/servicediscovery/publish', headers={'Content-Type': 'application/json'})
+        req.text = asyncio.coroutine(services.Service(name='new').to_json)
+        if expected is None:
+            yield from http_server.publish_post(req)
+            continue
+        with pytest.raises(expected) as excinfo:
+            yield from http_server.publish_post(req)
+        assert excinfo.value.headers['Retry-After'] == '2'
+
+@pytest.mark.asyncio
+def test_http_single_flight(http_server, event_loop): #pylint: disable=redefined-outer-name
+    """Test that concurrent identical requests render the service list once"""
+    facade = http_server._directory #pylint: disable=protected-access
+    facade.directory = mock.Mock(wraps=facade.directory)
+    requests = [make_mocked_request('GET', '/servicediscovery/service',
+                                    headers={'Accept': 'application/json'})
+                for _ in range(5)]
+    responses = yield from asyncio.gather(
+        *[http_server.service_list_get(req) for req in requests], loop=event_loop)
+    assert len({res.body for res in responses}) == 1
+    assert facade.directory.service_list.call_count == 1
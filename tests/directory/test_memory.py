@@ -0,0 +1,260 @@
+"""Test soa.directory.memory"""
+
+import asyncio
+import json
+from unittest import mock
+
+import pytest
+
+import aiocoap
+from aiocoap.numbers.codes import Code
+
+from soa import services
+from soa.directory import asyncdir
+from soa.directory import coap
+from soa.directory import directory
+from soa.directory import memory
+from soa.directory import notify
+from soa.directory.coapsite import query_to_search
+
+from ..test_data import EXAMPLE_SERVICES
+
+@pytest.yield_fixture
+def filled_directory(event_loop):
+    """Create an in-memory directory with some services"""
+    mydir = memory.MemoryServiceDirectory()
+    for testcase in EXAMPLE_SERVICES.values():
+        event_loop.run_until_complete(
+            mydir.publish(service=services.Service(**testcase['service'])))
+    yield mydir
+
+@pytest.mark.parametrize('criteria, expected', [
+    ({'name': 'a'}, True),
+    ({'name': 'b'}, False),
+    ({'port': {'$gte': 10}}, True),
+    ({'port': {'$lt': 10}}, False),
+    ({'host': {'$gte': 10}}, False),
+    ({'name': {'$regex': '^a'}}, True),
+    ({'port': {'$regex': '^1'}}, False),
+    ({'properties.version': '1.0'}, True),
+    ({'properties.missing': '1.0'}, False),
+    ({'name': {'$in': ['a', 'b']}, 'type': {'$ne': 't'}}, True),
+    ({}, True),
+])
+def test_record_matches(criteria, expected):
+    """Test evaluating search criteria"""
+    record = {'name': 'a', 'type': 'x', 'host': None, 'port': 12,
+              'properties': {'version': '1.0'}}
+    assert memory.record_matches(record, criteria) == expected
+
+def test_record_matches_unsupported():
+    """Test that unsupported operators are reported"""
+    with pytest.raises(directory.DirectoryException):
+        memory.record_matches({'name': 'a'}, {'name': {'$where': 'true'}})
+
+@pytest.mark.asyncio
+def test_memory_directory(filled_directory): #pylint: disable=redefined-outer-name
+    """Test lookups and modifications"""
+    mydir = filled_directory
+    generation = yield from mydir.generation()
+    assert generation == len(EXAMPLE_SERVICES)
+    slist = yield from mydir.service_list()
+    assert sorted(srv.name for srv in slist) == \
+        sorted(tc['service']['name'] for tc in EXAMPLE_SERVICES.values())
+    first = slist[0]
+    assert (yield from mydir.service(name=first.name)) == first
+    assert (yield from mydir.types()) == {srv.type for srv in slist}
+    assert (yield from mydir.service_list(type=first.type)) == \
+        [srv for srv in slist if srv.type == first.type]
+    assert (yield from mydir.last_modified(name=first.name)) is not None
+    assert (yield from mydir.last_modified(name='missing')) is None
+    # Returned services are copies
+    first.properties.changed = 'yes'
+    assert (yield from mydir.service(name=first.name)) != first
+    yield from mydir.unpublish(name=first.name)
+    with pytest.raises(mydir.DoesNotExist):
+        yield from mydir.service(name=first.name)
+    with pytest.raises(mydir.DoesNotExist):
+        yield from mydir.unpublish(name=first.name)
+    assert (yield from mydir.generation()) == generation + 1
+
+@pytest.mark.asyncio
+def test_memory_directory_search(filled_directory): #pylint: disable=redefined-outer-name
+    """Test that the criteria built from CoAP queries work like with blitzdb"""
+    first = EXAMPLE_SERVICES['SingleService1']['service']
+    for query in (
+            {'name': first['name'][:4] + '*'},
+            {'port': str(first['port'])},
+            {'version': first['properties']['version']}):
+        slist = yield from filled_directory.service_list(**query_to_search(query))
+        assert first['name'] in [srv.name for srv in slist], query
+
+@pytest.mark.asyncio
+def test_memory_directory_expire(event_loop):
+    """Test that services time out"""
+    mydir = memory.MemoryServiceDirectory()
+    service = services.Service(**next(iter(EXAMPLE_SERVICES.values()))['service'])
+    with mydir.changes(policy=notify.DROP_OLDEST) as stream:
+        with mock.patch('soa.directory.memory.unix_now', return_value=1000):
+            yield from mydir.publish(service=service)
+        assert mydir.next_deadline() == 1000 + mydir.config_defaults['lifetime']
+        assert (yield from mydir.service_list()) == []
+        assert (yield from mydir.generation()) == 2
+        assert mydir.next_deadline() is None
+        events = [(yield from stream.get()), (yield from stream.get())]
+    assert [event.kind for event in events] == \
+        [directory.ChangeEvent.PUBLISH, directory.ChangeEvent.EXPIRE]
+    assert (yield from asyncio.wait_for(stream.get(), 1, loop=event_loop)) is None
+
+@pytest.mark.asyncio
+def test_memory_directory_changes_since(filled_directory): #pylint: disable=redefined-outer-name
+    """Test the change feed of the in-memory directory"""
+    mydir = filled_directory
+    since = yield from mydir.generation()
+    service = services.Service(**EXAMPLE_SERVICES['SingleService1']['service'])
+    yield from mydir.publish(service=service)
+    yield from mydir.unpublish(name=service.name)
+    changes = yield from mydir.changes_since(since - 1, epoch=mydir.epoch())
+    assert [entry.operation for entry in changes.changes] == [
+        directory.ChangeLogEntry.UPSERT, directory.ChangeLogEntry.DELETE]
+    assert changes.changes[0].to_json_dict()['lifetime'] == mydir.config_defaults['lifetime']
+    assert 'lifetime' not in changes.changes[1].to_json_dict()
+    changes = yield from mydir.changes_since(since, epoch=mydir.epoch())
+    assert [entry.name for entry in changes.changes] == [service.name]
+    assert (yield from mydir.changes_since(since, epoch='other')).resync
+
+@pytest.mark.asyncio
+def test_memory_directory_lifetimes():
+    """Test requested and per-type lease lifetimes"""
+    mydir = memory.MemoryServiceDirectory(config={'max_lifetime': 100,
+                                                  'type_lifetimes': {'static': 90}})
+    with mock.patch('soa.directory.memory.unix_now', return_value=1000):
+        assert (yield from mydir.publish(service=services.Service(name='a', type='static'))) == 90
+        assert (yield from mydir.publish(service=services.Service(name='b'), lifetime=1)) == 60
+        assert mydir.next_deadline() == 1060
+        assert (yield from mydir.publish(service=services.Service(name='b', type='x'))) == 60
+    assert 'lifetime' not in (yield from mydir.service(name='b')).to_dict()
+
+@pytest.mark.asyncio
+def test_memory_directory_deadline_tracking():
+    """Test that the records are only scanned when the nearest deadline goes away"""
+    mydir = memory.MemoryServiceDirectory()
+    with mock.patch('soa.directory.memory.unix_now', return_value=1000):
+        yield from mydir.publish(service=services.Service(name='a'), lifetime=100)
+        yield from mydir.publish(service=services.Service(name='b'), lifetime=200)
+        find = mydir._find_next_deadline #pylint: disable=protected-access
+        with mock.patch.object(mydir, '_find_next_deadline', wraps=find) as scan:
+            yield from mydir.publish(service=services.Service(name='c'), lifetime=300)
+            yield from mydir.publish(service=services.Service(name='b'), lifetime=150)
+            yield from mydir.unpublish(name='c')
+            assert (scan.call_count, mydir.next_deadline()) == (0, 1100)
+            yield from mydir.publish(service=services.Service(name='a'), lifetime=400)
+            assert (scan.call_count, mydir.next_deadline()) == (1, 1150)
+            yield from mydir.unpublish(name='b')
+            assert (scan.call_count, mydir.next_deadline()) == (2, 1400)
+
+@pytest.mark.asyncio
+def test_memory_directory_capacity():
+    """Test evicting the least recently renewed service"""
+    mydir = memory.MemoryServiceDirectory(config={
+        'max_services': 2, 'eviction_policy': 'least-recently-renewed'})
+    with mock.patch('soa.directory.memory.unix_now') as now:
+        for stamp, name in enumerate(('a', 'b', 'a', 'c')):
+            now.return_value = 1000 + stamp
+            yield from mydir.publish(service=services.Service(name=name))
+        assert sorted(srv.name for srv in (yield from mydir.service_list())) == ['a', 'c']
+    assert mydir.stats['evicted'] == 1
+    mydir = memory.MemoryServiceDirectory(config={'max_services': 1})
+    yield from mydir.publish(service=services.Service(name='a'))
+    with pytest.raises(mydir.QuotaExceeded):
+        yield from mydir.publish(service=services.Service(name='b'))
+
+    mydir = memory.MemoryServiceDirectory(config={'max_services_per_host': 1})
+    yield from mydir.publish(service=services.Service(name='a', host='h'))
+    callback = mock.Mock()
+    mydir.add_notify_callback(callback)
+    generation = yield from mydir.generation()
+    with pytest.raises(mydir.QuotaExceeded):
+        yield from mydir.publish_many(services=[
+            services.Service(name='b', host='g'), services.Service(name='a', host='g'),
+            services.Service(name='c', host='h')])
+    # Rejected batches are not applied at all
+    assert [srv.name for srv in (yield from mydir.service_list())] == ['a']
+    assert (yield from mydir.service(name='a')).host == 'h'
+    assert (yield from mydir.generation()) == generation
+    assert not callback.called
+    assert mydir.stats['rejected'] == 1
+
+@pytest.mark.asyncio
+def test_memory_directory_batch(filled_directory): #pylint: disable=redefined-outer-name
+    """Test the batch helpers with the default batch implementation"""
+    name = EXAMPLE_SERVICES['SingleService1']['service']['name']
+    statuses = yield from asyncdir.publish_batch(filled_directory, [
+        services.Service(name=name), services.Service(name='new'), services.Service()])
+    assert statuses == [(name, asyncdir.UPDATED, 1800), ('new', asyncdir.CREATED, 1800),
+                        (None, asyncdir.INVALID, None)]
+    statuses = yield from asyncdir.unpublish_batch(filled_directory, ['new', 'new', ''])
+    assert statuses == [('new', asyncdir.DELETED, None), ('new', asyncdir.NOT_FOUND, None),
+                        ('', asyncdir.INVALID, None)]
+
+@pytest.mark.asyncio
+def test_memory_directory_publish_many(): #pylint: disable=protected-access
+    """Test that a batch is applied as a whole before its events are passed on"""
+    mydir = memory.MemoryServiceDirectory()
+    prune = mydir._prune
+    yield from mydir.publish(service=services.Service(name='a', type='t'))
+    seen = []
+    mydir.add_notify_callback(lambda event: seen.append(
+        (event.kind, event.name, event.generation, sorted(mydir._records))))
+    with mock.patch.object(mydir, '_prune', wraps=prune) as prune_spy:
+        results = yield from mydir.publish_many(
+            services=[services.Service(name=name, type='t') for name in 'abc'],
+            lifetimes=[None, 100, None])
+        assert prune_spy.call_count == 1
+    assert results == [(True, 1800), (False, 100), (False, 1800)]
+    assert seen == [(directory.ChangeEvent.PUBLISH, name, generation, ['a', 'b', 'c'])
+                    for generation, name in enumerate('abc', 2)]
+
+    del seen[:]
+    with mock.patch.object(mydir, '_prune', wraps=prune) as prune_spy:
+        assert (yield from mydir.unpublish_many(names=['a', 'x', 'c'])) == [True, False, True]
+        assert prune_spy.call_count == 1
+    assert seen == [(directory.ChangeEvent.UNPUBLISH, name, generation, ['b'])
+                    for generation, name in ((5, 'a'), (6, 'c'))]
+
+@pytest.mark.asyncio
+def test_change_stream(filled_directory, event_loop): #pylint: disable=redefined-outer-name
+    """Test iterating over change events"""
+    mydir = filled_directory
+    stream = mydir.changes()
+    name = next(iter(EXAMPLE_SERVICES.values()))['service']['name']
+    getter = event_loop.create_task(stream.get())
+    yield from asyncio.sleep(0, loop=event_loop)
+    assert not getter.done()
+    yield from mydir.unpublish(name=name)
+    event = yield from getter
+    assert (event.kind, event.name) == (directory.ChangeEvent.UNPUBLISH, name)
+    # Pending events are merged per service
+    other = services.Service(**EXAMPLE_SERVICES['SingleService1']['service'])
+    yield from mydir.publish(service=other)
+    yield from mydir.unpublish(name=other.name)
+    assert stream.pending() == 1
+    stream.close()
+    yield from mydir.publish(service=services.Service(name=name))
+    assert (yield from stream.get()).kind == directory.ChangeEvent.UNPUBLISH
+    assert (yield from stream.get()) is None
+
+@pytest.mark.asyncio
+def test_coap_memory_backend(filled_directory): #pylint: disable=redefined-outer-name
+    """Test that the CoAP front end uses the in-memory backend as-is"""
+    with mock.patch('soa.directory.coap.aiocoap.Context'):
+        coap_server = coap.Server(directory=filled_directory)
+    assert coap_server.site._directory is filled_directory #pylint: disable=protected-access
+    first = EXAMPLE_SERVICES['SingleService1']['service']
+    req = aiocoap.Message(code=Code.GET)
+    req.opt.uri_path = ('servicediscovery', 'service')
+    req.opt.uri_query = ('name=' + first['name'], )
+    res = yield from coap_server.site.render(req)
+    assert res.code == Code.CONTENT
+    slist = json.loads(res.payload.decode('utf-8'))['service']
+    assert [srv['name'] for srv in slist] == [first['name']]
@@ -0,0 +1,123 @@
+"""Test soa.directory.multicast"""
+
+import asyncio
+import socket
+import tempfile
+from unittest import mock
+
+import pytest
+
+from aiocoap.numbers.codes import Code
+from aiocoap.numbers.types import Type
+import aiocoap
+
+from soa import services
+from soa.directory import directory
+from soa.directory import coap
+from soa.directory import multicast
+
+from ..test_data import EXAMPLE_SERVICES
+
+@pytest.yield_fixture
+def coap_server():
+    """Create a CoAP server with a stubbed server context and a filled directory"""
+    with tempfile.TemporaryDirectory() as db_dir:
+        mydir = directory.ServiceDirectory(database=db_dir)
+        with mock.patch('soa.directory.coap.aiocoap.Context'):
+            server = coap.Server(directory=mydir)
+        for testcase in EXAMPLE_SERVICES.values():
+            mydir.publish(service=services.Service(**testcase['service']))
+        yield server
+
+def make_request(path, *query, token=b'\x42'):
+    """Create an encoded multicast GET request"""
+    req = aiocoap.Message(code=Code.GET, mtype=Type.NON, mid=1, token=token)
+    req.opt.uri_path = path
+    req.opt.uri_query = query
+    return req.encode()
+
+def make_responder(server, event_loop):
+    """Create a responder with a mocked transport"""
+    responder = multicast.MulticastResponder(
+        server.site, [('.well-known', 'core'), ('servicediscovery', 'type', coap.PathRegex('.*'))],
+        leisure=0, loop=event_loop)
+    responder.connection_made(mock.Mock())
+    return responder
+
+@pytest.mark.asyncio
+def test_multicast_responder(coap_server, event_loop): #pylint: disable=redefined-outer-name
+    """Test that matching multicast requests are answered"""
+    responder = make_responder(coap_server, event_loop)
+    stype = EXAMPLE_SERVICES['SingleService1']['service']['type']
+    for request in (make_request(('.well-known', 'core'), 'rt=core.rd'),
+                    make_request(('servicediscovery', 'type', stype), 'version=1.0')):
+        responder.transport.reset_mock()
+        yield from responder.respond(aiocoap.Message.decode(request), ('127.0.0.1', 1234))
+        assert responder.transport.sendto.call_count == 1
+        data, addr = responder.transport.sendto.call_args[0]
+        assert addr == ('127.0.0.1', 1234)
+        response = aiocoap.Message.decode(data)
+        assert response.code == Code.CONTENT
+        assert response.mtype == Type.NON
+        assert response.token == b'\x42'
+        assert response.payload
+
+@pytest.mark.parametrize("request_data", [
+    make_request(('.well-known', 'core'), 'rt=nothing'),
+    make_request(('servicediscovery', 'type', 'unknown')),
+    make_request(('servicediscovery', 'type', 'x'), 'port=http'),
+    ])
+@pytest.mark.asyncio
+def test_multicast_responder_suppress(request_data, coap_server, event_loop): #pylint: disable=redefined-outer-name
+    """Test that empty and error responses are not sent"""
+    responder = make_responder(coap_server, event_loop)
+    yield from responder.respond(aiocoap.Message.decode(request_data), ('127.0.0.1', 1234))
+    assert not responder.transport.sendto.called
+
+def test_multicast_responder_ignore(coap_server, event_loop): #pylint: disable=redefined-outer-name
+    """Test that requests for other resources are ignored"""
+    responder = make_responder(coap_server, event_loop)
+    with mock.patch.object(event_loop, 'create_task') as create_task:
+        responder.datagram_received(make_request(('servicediscovery', 'service')), ('::1', 1))
+        responder.datagram_received(b'\xff', ('::1', 1))
+        assert not create_task.called
+        responder.datagram_received(make_request(('.well-known', 'core')), ('::1', 1))
+        assert create_task.call_count == 1
+
+@pytest.mark.parametrize('reuse_port', [False, True])
+@pytest.mark.asyncio
+def test_multicast_loopback(reuse_port, event_loop):
+    """Test discovery over IPv4 multicast on the loopback interface, on the
+    port of the unicast server"""
+    port = 25683
+    with tempfile.TemporaryDirectory() as db_dir:
+        mydir = directory.ServiceDirectory(database=db_dir)
+        server = coap.Server(directory=mydir, bind=('::', port), reuse_port=reuse_port)
+        context = yield from server.context
+        transports = []
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            transports = yield from server.join_multicast(
+                groups=('224.0.1.187', ), port=port, interface='lo', leisure=0.1)
+            assert len(transports) == 1
+            client.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                              socket.inet_aton('127.0.0.1'))
+            client.setblocking(False)
+            client.sendto(make_request(('.well-known', 'core')), ('224.0.1.187', port))
+            data = yield from asyncio.wait_for(event_loop.sock_recv(client, 4096), 5,
+                                               loop=event_loop)
+            response = aiocoap.Message.decode(data)
+            assert response.code == Code.CONTENT
+            assert response.mtype == Type.NON
+            assert b'</rd>' in response.payload
+
+            # Unicast requests still reach the server context
+            client.sendto(make_request(('.well-known', 'core')), ('127.0.0.1', port))
+            data = yield from asyncio.wait_for(event_loop.sock_recv(client, 4096), 5,
+                                               loop=event_loop)
+            assert aiocoap.Message.decode(data).code == Code.CONTENT
+        finally:
+            client.close()
+            for transport in transports:
+                transport.close()
+            yield from context.shutdown()
@@ -0,0 +1,139 @@
+"""Test soa.directory.notify"""
+
+import asyncio
+import tempfile
+from unittest import mock
+
+import pytest
+
+from soa import services
+from soa.directory import directory
+from soa.directory import memory
+from soa.directory import notify
+from soa.directory.directory import ChangeEvent
+
+from ..test_data import EXAMPLE_SERVICES
+
+def event(name, kind=ChangeEvent.PUBLISH, stype='t', old_type=None):
+    """Create a change event"""
+    return ChangeEvent(kind, name, type=stype, old_type=old_type)
+
+def test_merge_events():
+    """Test that merged events keep the final state and the previous type"""
+    merged = notify.merge_events(event('a', stype='x'), event('a', stype='y', old_type='x'))
+    assert (merged.kind, merged.type, merged.old_type) == (ChangeEvent.PUBLISH, 'y', 'x')
+    merged = notify.merge_events(
+        event('a', stype='x'), event('a', ChangeEvent.UNPUBLISH, stype='x'))
+    assert (merged.kind, merged.types) == (ChangeEvent.UNPUBLISH, {'x'})
+    merged = notify.merge_events(
+        event('a', stype='y', old_type='x'), event('a', stype='y'))
+    assert merged.types == {'x', 'y'}
+
+    renewal = ChangeEvent(ChangeEvent.PUBLISH, 'a', type='t', renewal=True)
+    assert notify.merge_events(renewal, renewal).renewal
+    assert not notify.merge_events(event('a'), renewal).renewal
+    assert not notify.merge_events(renewal, event('a')).renewal
+
+@pytest.mark.parametrize('policy, expected, dropped, merged', [
+    (notify.MERGE, [('a', 'u'), ('c', 't'), ('d', 't')], 1, 1),
+    (notify.DROP_OLDEST, [('a', 'u'), ('c', 't'), ('d', 't')], 2, 0),
+    (notify.DROP_NEWEST, [('a', 't'), ('b', 't'), ('a', 'u')], 2, 0),
+])
+@pytest.mark.asyncio
+def test_event_buffer_policy(policy, expected, dropped, merged):
+    """Test the overflow policies of the event buffer"""
+    buf = notify.EventBuffer(3, policy)
+    for name, stype in (('a', 't'), ('b', 't'), ('a', 'u'), ('c', 't'), ('d', 't')):
+        buf.put_nowait(event(name, stype=stype))
+    assert buf.qsize() == 3
+    buf.close()
+    assert not buf.put_nowait(event('e'))
+    result = []
+    while True:
+        item = yield from buf.get()
+        if item is None:
+            break
+        result.append((item.name, item.type))
+    assert result == expected
+    assert (buf.stats['dropped'], buf.stats['merged']) == (dropped, merged)
+
+def test_event_buffer_bad_policy():
+    """Test that unknown policies are rejected"""
+    with pytest.raises(ValueError):
+        notify.EventBuffer(policy='ignore')
+
+@pytest.mark.asyncio
+def test_notify_dispatcher(event_loop):
+    """Test that subscribers are called from their own tasks, isolated from
+    the writer and from each other"""
+    mydir = memory.MemoryServiceDirectory()
+    received = []
+    gate = asyncio.Event(loop=event_loop)
+
+    @asyncio.coroutine
+    def slow(evt):
+        """A subscriber which is blocked until the gate opens"""
+        yield from gate.wait()
+        received.append(evt.name)
+
+    def failing(evt):
+        """A subscriber which always fails"""
+        raise RuntimeError(evt.name)
+
+    slow_dispatcher = mydir.subscribe(slow, loop=event_loop)
+    failing_dispatcher = mydir.subscribe(failing, loop=event_loop)
+    for testcase in EXAMPLE_SERVICES.values():
+        yield from mydir.publish(service=services.Service(**testcase['service']))
+    # The writer was not held up by the blocked subscriber
+    assert received == []
+    yield from asyncio.sleep(0.01, loop=event_loop)
+    assert failing_dispatcher.stats['errors'] == len(EXAMPLE_SERVICES)
+    assert failing_dispatcher.mean_callback_time is not None
+    assert slow_dispatcher.pending == len(EXAMPLE_SERVICES) - 1
+    gate.set()
+    mydir.del_notify_callback(slow_dispatcher)
+    yield from slow_dispatcher.close()
+    assert sorted(received) == sorted(tc['service']['name'] for tc in EXAMPLE_SERVICES.values())
+    assert slow_dispatcher.stats['calls'] == len(EXAMPLE_SERVICES)
+    assert slow_dispatcher.max_callback_time > 0
+    mydir.unsubscribe(failing_dispatcher)
+    yield from asyncio.sleep(0, loop=event_loop)
+    assert failing_dispatcher._task.cancelled() #pylint: disable=protected-access
+
+def test_notify_callback_isolation():
+    """Test that a failing notify callback does not abort a modification"""
+    calls = []
+
+    def failing(evt):
+        """A callback which always fails"""
+        calls.append(evt)
+        raise RuntimeError()
+
+    def record(evt):
+        """A working callback"""
+        calls.append(evt)
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        mydir = directory.ServiceDirectory(database=db_dir)
+        mydir.add_notify_callback(failing)
+        mydir.add_notify_callback(record)
+        service = services.Service(**next(iter(EXAMPLE_SERVICES.values()))['service'])
+        mydir.publish(service=service)
+        assert mydir.service(name=service.name) == service
+        assert len(calls) == 2
+        assert mydir.stats['notify_errors'] == 1
+
+def test_notify_callback_timing():
+    """Test that slow notify callbacks are reported"""
+    with tempfile.TemporaryDirectory() as db_dir:
+        mydir = directory.ServiceDirectory(database=db_dir)
+        mydir.add_notify_callback(lambda evt: None)
+        service = services.Service(**next(iter(EXAMPLE_SERVICES.values()))['service'])
+        mydir.publish(service=service)
+        assert mydir.stats['notify_slow'] == 0
+        with mock.patch('soa.directory.directory.SLOW_NOTIFY_CALLBACK', -1):
+            with mock.patch.object(mydir.log, 'warning') as warning:
+                mydir.unpublish(name=service.name)
+        assert mydir.stats['notify_slow'] == 1
+        assert mydir.stats['notify_time'] > 0
+        assert warning.call_count == 1
@@ -0,0 +1,52 @@
+"""Test soa.directory.ratelimit"""
+
+import pytest
+
+from soa import services
+from soa.directory import ratelimit
+
+def test_rate_limiter():
+    """Test admitting and refusing requests"""
+    now = [100.0]
+    limiter = ratelimit.RateLimiter(2, 3, clock=lambda: now[0])
+    assert all(limiter.acquire(['a']) == 0 for _ in range(3))
+    assert limiter.acquire(['a']) == pytest.approx(0.5)
+    # Other clients have buckets of their own
+    assert limiter.acquire(['b']) == 0
+    now[0] += 0.5
+    assert limiter.acquire(['a']) == 0
+    assert limiter.acquire(['a']) > 0
+    assert limiter.stats == {'admitted': 5, 'limited': 2}
+
+def test_rate_limiter_batch():
+    """Test that batches take one token per service, and may go into debt"""
+    now = [100.0]
+    limiter = ratelimit.RateLimiter(1, 2, clock=lambda: now[0])
+    assert limiter.acquire(['a'] * 5) == 0
+    assert limiter.acquire(['a']) == pytest.approx(4)
+    # Refused requests take nothing
+    assert limiter.acquire(['a', 'b']) == pytest.approx(4)
+    assert limiter.acquire(['b', 'b']) == 0
+    assert ratelimit.RateLimiter.retry_after(0.1) == 1
+    assert ratelimit.RateLimiter.retry_after(3.2) == 4
+
+def test_rate_limiter_keys():
+    """Test limiting by client address or service host"""
+    slist = [services.Service(name='a', host='h'), services.Service(name='b')]
+    assert ratelimit.RateLimiter(1).keys('addr', slist) == ['addr', 'addr']
+    limiter = ratelimit.RateLimiter(1, key=ratelimit.BY_HOST)
+    assert limiter.keys('addr', slist) == ['h', 'addr']
+    with pytest.raises(ValueError):
+        ratelimit.RateLimiter(1, key='port')
+    with pytest.raises(ValueError):
+        ratelimit.RateLimiter(0)
+
+def test_rate_limiter_bounded():
+    """Test that the limiter keeps track of a bounded number of clients"""
+    limiter = ratelimit.RateLimiter(1, 1, maxsize=2, clock=lambda: 100.0)
+    for key in ('a', 'b', 'c'):
+        assert limiter.acquire([key]) == 0
+    assert len(limiter._buckets) == 2 #pylint: disable=protected-access
+    assert limiter.acquire(['c']) > 0
+    # The bucket of the least recently seen client was dropped
+    assert limiter.acquire(['a']) == 0
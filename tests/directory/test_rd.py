@@ -0,0 +1,176 @@
+"""Test soa.directory.rd"""
+#pylint: disable=no-member
+# pylint doesn't understand mock objects
+
+from unittest import mock
+import tempfile
+
+import pytest
+
+import link_header
+from aiocoap.numbers.codes import Code
+import aiocoap
+
+from soa import services
+from soa.directory import directory
+from soa.directory import coap
+
+from ..test_data import EXAMPLE_SERVICES
+
+LINK_FORMAT = aiocoap.numbers.media_types_rev['application/link-format']
+
+@pytest.yield_fixture
+def rd_server():
+    """Create a CoAP server with a stubbed server context and a filled directory"""
+    with tempfile.TemporaryDirectory() as db_dir:
+        mydir = directory.ServiceDirectory(database=db_dir)
+        with mock.patch('soa.directory.coap.aiocoap.Context'):
+            coap_server = coap.Server(directory=mydir)
+        for testcase in EXAMPLE_SERVICES.values():
+            mydir.publish(service=services.Service(**testcase['service']))
+        yield coap_server
+
+def make_request(code, path, *query, payload=b''):
+    """Create a CoAP request"""
+    req = aiocoap.Message(code=code, payload=payload)
+    req.opt.uri_path = path
+    req.opt.uri_query = query
+    req.remote = ('2001:db8::1', 61616)
+    return req
+
+@pytest.mark.asyncio
+def test_rd_registration(rd_server): #pylint: disable=redefined-outer-name
+    """Test registration, update and removal of an endpoint"""
+    site = rd_server.site
+    payload = b'</sensors/temp>;rt="temperature-c";if="sensor",</sensors/light>;rt="light-lux"'
+    req = make_request(Code.POST, ('rd', ), 'ep=node1', 'd=home', payload=payload)
+    req.opt.content_format = LINK_FORMAT
+    res = yield from site.render(req)
+    assert res.code == Code.CREATED
+    assert res.opt.location_path == ('rd', 'node1')
+    service = rd_server.site._directory.directory.service(name='node1') #pylint: disable=protected-access
+    assert service.domain == 'home'
+    assert service.host == '2001:db8::1'
+    assert service.port == 61616
+
+    res = yield from site.render(make_request(Code.GET, ('rd', 'node1')))
+    hrefs = [link.href for link in link_header.parse(res.payload.decode('utf-8')).links]
+    assert hrefs == ['/sensors/temp', '/sensors/light']
+
+    res = yield from site.render(make_request(
+        Code.POST, ('rd', 'node1'), 'base=coap://[2001:db8::2]:5683'))
+    assert res.code == Code.CHANGED
+    res = yield from site.render(make_request(Code.GET, ('rd-lookup', 'res'), 'ep=node1'))
+    hrefs = [link.href for link in link_header.parse(res.payload.decode('utf-8')).links]
+    assert hrefs == ['coap://[2001:db8::2]:5683/sensors/temp',
+                     'coap://[2001:db8::2]:5683/sensors/light']
+
+    res = yield from site.render(make_request(Code.DELETE, ('rd', 'node1')))
+    assert res.code == Code.DELETED
+    with pytest.raises(coap.NotFoundError):
+        yield from site.render(make_request(Code.DELETE, ('rd', 'node1')))
+    with pytest.raises(coap.NotFoundError):
+        yield from site.render(make_request(Code.POST, ('rd', 'node1')))
+
+@pytest.mark.asyncio
+def test_rd_arrowhead_services(rd_server): #pylint: disable=redefined-outer-name
+    """Test that services published through Arrowhead are read-only for RD clients"""
+    site = rd_server.site
+    mydir = site._directory.directory #pylint: disable=protected-access
+    name = EXAMPLE_SERVICES['SingleService1']['service']['name']
+    original = mydir.service(name=name)
+    with pytest.raises(coap.ForbiddenError):
+        yield from site.render(make_request(Code.POST, ('rd', ), 'ep=' + name, payload=b'</a>'))
+    with pytest.raises(coap.NotFoundError):
+        yield from site.render(make_request(Code.POST, ('rd', name), payload=b'</a>'))
+    with pytest.raises(coap.NotFoundError):
+        yield from site.render(make_request(Code.DELETE, ('rd', name)))
+    assert mydir.service(name=name) == original
+    res = yield from site.render(make_request(Code.GET, ('rd', name)))
+    assert res.code == Code.CONTENT
+
+@pytest.mark.asyncio
+def test_rd_lifetime(rd_server): #pylint: disable=redefined-outer-name
+    """Test that the requested registration lifetime is applied and kept on updates"""
+    site = rd_server.site
+    mydir = site._directory.directory #pylint: disable=protected-access
+    with mock.patch('soa.directory.directory.unix_now', return_value=1000):
+        req = make_request(Code.POST, ('rd', ), 'ep=node1', 'lt=120', payload=b'</a>')
+        res = yield from site.render(req)
+        assert res.code == Code.CREATED
+        assert mydir.next_deadline() == 1120
+    with mock.patch('soa.directory.directory.unix_now', return_value=1100):
+        res = yield from site.render(make_request(Code.POST, ('rd', 'node1')))
+        assert res.code == Code.CHANGED
+        assert mydir.next_deadline() == 1220
+
+@pytest.mark.parametrize("config, lifetime", [
+    ({}, 90000),
+    ({'lifetime': 60}, 90000),
+    ({'max_lifetime': 3600}, 3600),
+    ])
+@pytest.mark.asyncio
+def test_rd_default_lifetime(config, lifetime):
+    """Test that registrations without a lifetime get the RFC 9176 default"""
+    with tempfile.TemporaryDirectory() as db_dir:
+        mydir = directory.ServiceDirectory(database=db_dir, config=config)
+        with mock.patch('soa.directory.coap.aiocoap.Context'):
+            site = coap.Server(directory=mydir).site
+        with mock.patch('soa.directory.directory.unix_now', return_value=1000):
+            res = yield from site.render(
+                make_request(Code.POST, ('rd', ), 'ep=node1', payload=b'</a>'))
+            assert res.code == Code.CREATED
+            assert mydir.next_deadline() == 1000 + lifetime
+
+@pytest.mark.parametrize("query, payload", [
+    ((), b'</a>'),
+    (('ep=x', 'lt=forever'), b'</a>'),
+    (('ep=x', 'base=nowhere'), b'</a>'),
+    (('ep=x', ), b'<<garbage'),
+    ])
+@pytest.mark.asyncio
+def test_rd_registration_bad(query, payload, rd_server): #pylint: disable=redefined-outer-name
+    """Test that malformed registrations are rejected"""
+    with pytest.raises(coap.BadRequestError):
+        yield from rd_server.site.render(make_request(Code.POST, ('rd', ), *query, payload=payload))
+
+@pytest.mark.asyncio
+def test_rd_lookup(rd_server): #pylint: disable=redefined-outer-name
+    """Test endpoint and resource lookup of services published as Arrowhead services"""
+    site = rd_server.site
+    first = EXAMPLE_SERVICES['SingleService1']['service']
+    second = EXAMPLE_SERVICES['SingleService2']['service']
+    res = yield from site.render(make_request(Code.GET, ('rd-lookup', 'ep')))
+    assert res.opt.content_format == LINK_FORMAT
+    links = link_header.parse(res.payload.decode('utf-8')).links
+    assert sorted(dict(link.attr_pairs)['ep'] for link in links) == \
+        sorted([first['name'], second['name']])
+
+    res = yield from site.render(make_request(Code.GET, ('rd-lookup', 'ep'), 'd=arces*'))
+    links = link_header.parse(res.payload.decode('utf-8')).links
+    assert [link.href for link in links] == ['/rd/' + first['name']]
+    assert dict(links[0].attr_pairs)['base'] == 'coap://bedework.arces.unibo.it.:8181'
+
+    res = yield from site.render(make_request(
+        Code.GET, ('rd-lookup', 'res'), 'rt=' + second['type']))
+    links = link_header.parse(res.payload.decode('utf-8')).links
+    assert [link.href for link in links] == ['coap://192.168.56.101.:8055/printer/something']
+    assert dict(links[0].attr_pairs)['anchor'] == 'coap://192.168.56.101.:8055'
+
+    res = yield from site.render(make_request(Code.GET, ('rd-lookup', 'res'), 'href=*'))
+    assert len(link_header.parse(res.payload.decode('utf-8')).links) == 2
+
+@pytest.mark.asyncio
+def test_rd_lookup_paging(rd_server): #pylint: disable=redefined-outer-name
+    """Test paging of lookup results"""
+    site = rd_server.site
+    res = yield from site.render(make_request(Code.GET, ('rd-lookup', 'ep')))
+    everything = link_header.parse(res.payload.decode('utf-8')).links
+    pages = []
+    for page in range(len(everything) + 1):
+        res = yield from site.render(make_request(
+            Code.GET, ('rd-lookup', 'ep'), 'page={}'.format(page), 'count=1'))
+        pages.extend(link_header.parse(res.payload.decode('utf-8')).links)
+    assert [link.href for link in pages] == [link.href for link in everything]
+    with pytest.raises(coap.BadRequestError):
+        yield from site.render(make_request(Code.GET, ('rd-lookup', 'ep'), 'count=many'))
@@ -0,0 +1,117 @@
+"""Test soa.directory.replica"""
+
+import asyncio
+from unittest import mock
+
+import pytest
+from aiohttp.test_utils import TestClient as HTTPClient
+
+from soa import services
+from soa.directory import directory
+from soa.directory import http
+from soa.directory import memory
+from soa.directory import replica
+
+@pytest.yield_fixture
+def writer(event_loop):
+    """Serve an in-memory directory over HTTP"""
+    mydir = memory.MemoryServiceDirectory(config={'max_services': 3})
+    client = HTTPClient(http.Server(directory=mydir, loop=event_loop))
+    event_loop.run_until_complete(client.start_server())
+    yield mydir, client
+    event_loop.run_until_complete(client.close())
+
+@pytest.yield_fixture
+def replicas(writer, event_loop): #pylint: disable=redefined-outer-name
+    """Create two replicas of the writer"""
+    url = str(writer[1].make_url('/servicediscovery'))
+    reps = [replica.ReplicaDirectory(url, sync_interval=60, loop=event_loop) for _ in range(2)]
+    for rep in reps:
+        event_loop.run_until_complete(rep.start())
+    yield reps
+    for rep in reps:
+        rep.close()
+
+@pytest.mark.asyncio
+def test_replica_modifications(writer, replicas): #pylint: disable=redefined-outer-name
+    """Test that modifications are forwarded and seen by all replicas"""
+    mydir = writer[0]
+    first, second = replicas
+    callback = mock.Mock()
+    second.add_notify_callback(callback)
+    service = services.Service(name='a', type='t', host='h')
+    assert (yield from first.publish(service=service, lifetime=120)) == 120
+    # The replica a modification was made through is up to date right away
+    assert (yield from first.service(name='a')) == service
+    assert (yield from mydir.service(name='a')) == service
+    assert (yield from second.service_list()) == []
+    yield from second.sync()
+    assert (yield from second.service_list(type='t')) == [service]
+    assert second.epoch() == mydir.epoch()
+    assert (yield from second.generation()) == (yield from mydir.generation())
+    assert second.next_deadline() is not None
+    event = callback.call_args[0][0]
+    assert (event.kind, event.name, event.generation) == (directory.ChangeEvent.PUBLISH, 'a', 1)
+
+    assert (yield from second.publish_many(services=[
+        service, services.Service(name="b")])) == [(True, 120), (False, 1800)]
+    with pytest.raises(ValueError):
+        yield from second.publish_many(
+            services=[service, services.Service(name="c")], lifetimes=[60, 120])
+    assert (yield from mydir.service_list(name='c')) == []
+    yield from first.unpublish(name='a')
+    with pytest.raises(first.DoesNotExist):
+        yield from first.unpublish(name='a')
+    assert (yield from first.unpublish_many(names=['b', 'c'])) == [True, False]
+    yield from second.sync()
+    assert (yield from second.service_list()) == []
+    assert callback.call_args[0][0].kind == directory.ChangeEvent.UNPUBLISH
+    changes = yield from second.changes_since(1, epoch=mydir.epoch())
+    assert [(entry.name, entry.operation) for entry in changes.changes] == [
+        ('a', directory.ChangeLogEntry.DELETE), ('b', directory.ChangeLogEntry.DELETE)]
+    assert (yield from second.changes_since(1, epoch='other')).resync
+
+    yield from first.publish_many(services=[services.Service(name=name) for name in 'xyz'])
+    with pytest.raises(first.QuotaExceeded):
+        yield from first.publish(service=services.Service(name='w'))
+
+@pytest.mark.asyncio
+def test_replica_prepopulated(writer, event_loop): #pylint: disable=redefined-outer-name
+    """Test that a replica loads services the change log of the writer does not know"""
+    mydir, client = writer
+    yield from mydir.publish(service=services.Service(name='a'))
+    yield from mydir.publish(service=services.Service(name='b'))
+    # As if the services had been loaded from a database
+    changes = directory.ChangeSet(mydir.epoch(), (yield from mydir.generation()), since=0)
+    with mock.patch.object(mydir, 'changes_since', return_value=asyncio.Future()) as feed:
+        feed.return_value.set_result(changes)
+        rep = replica.ReplicaDirectory(str(client.make_url('/servicediscovery')),
+                                       sync_interval=60, loop=event_loop)
+        yield from rep.start()
+    try:
+        assert sorted(srv.name for srv in (yield from rep.service_list())) == ['a', 'b']
+        assert (rep.epoch(), (yield from rep.generation())) == (mydir.epoch(), 2)
+    finally:
+        rep.close()
+
+@pytest.mark.asyncio
+def test_replica_resync(writer, replicas): #pylint: disable=redefined-outer-name
+    """Test that a replica reloads the registry when it cannot follow"""
+    mydir = writer[0]
+    rep = replicas[0]
+    yield from mydir.publish(service=services.Service(name='a'))
+    yield from rep.sync()
+    callback = mock.Mock()
+    rep.add_notify_callback(callback)
+    # A writer restart starts a new epoch
+    mydir._epoch = 'restarted' #pylint: disable=protected-access
+    yield from mydir.unpublish(name='a')
+    yield from mydir.publish(service=services.Service(name='b', type='t'))
+    yield from rep.sync()
+    assert rep.epoch() == 'restarted'
+    assert [srv.name for srv in (yield from rep.service_list())] == ['b']
+    assert sorted((event.kind, event.name) for event in
+                  (call[0][0] for call in callback.call_args_list)) == [
+                      (directory.ChangeEvent.PUBLISH, 'b'), (directory.ChangeEvent.UNPUBLISH, 'a')]
+    # Lifetimes are only known again after renewals
+    assert rep.next_deadline() is None
@@ -0,0 +1,75 @@
+"""Test soa.directory.snapshot"""
+#pylint: disable=protected-access
+
+import asyncio
+from unittest import mock
+
+import pytest
+
+from soa import services
+from soa.snapshot import SnapshotReader
+from soa.directory import memory
+from soa.directory import snapshot
+
+@pytest.mark.asyncio
+def test_snapshot_publisher(tmpdir, event_loop):
+    """Test that the snapshot follows the modifications"""
+    mydir = memory.MemoryServiceDirectory()
+    yield from mydir.publish(service=services.Service(name='a'))
+    path = str(tmpdir.join('snapshot'))
+    publisher = snapshot.SnapshotPublisher(mydir, path, interval=0.01, loop=event_loop)
+    yield from publisher.start()
+    reader = SnapshotReader(path)
+    assert (reader.epoch, reader.generation, reader.names()) == (mydir.epoch(), 1, ['a'])
+    yield from mydir.publish(service=services.Service(name='b'))
+    yield from mydir.unpublish(name='a')
+    for _ in range(100):
+        if publisher.generation == 3:
+            break
+        yield from asyncio.sleep(0.01, loop=event_loop)
+    assert (reader.generation, reader.names()) == (3, ['b'])
+    publisher.close()
+    yield from mydir.publish(service=services.Service(name='c'))
+    yield from asyncio.sleep(0.05, loop=event_loop)
+    assert reader.names() == ['b']
+
+@pytest.mark.asyncio
+def test_snapshot_publisher_expiry(tmpdir, event_loop):
+    """Test that the snapshot is rewritten when services time out"""
+    mydir = memory.MemoryServiceDirectory()
+    path = str(tmpdir.join('snapshot'))
+    publisher = snapshot.SnapshotPublisher(mydir, path, interval=0.01, loop=event_loop)
+    with mock.patch('soa.directory.memory.unix_now', return_value=1000), \
+            mock.patch('soa.directory.snapshot.unix_now', return_value=1000):
+        yield from mydir.publish(service=services.Service(name='a'), lifetime=60)
+        yield from publisher.start()
+    reader = SnapshotReader(path)
+    assert reader.names() == ['a']
+    # Due one second after the deadline, when the service has been pruned
+    timer = publisher._timer
+    assert timer._when == pytest.approx(event_loop.time() + 61, abs=1)
+    with mock.patch('soa.directory.memory.unix_now', return_value=1061):
+        timer._run()
+        yield from publisher._task
+    assert reader.names() == []
+    assert publisher._timer is None
+    publisher.close()
+
+@pytest.mark.asyncio
+def test_snapshot_publisher_retry(tmpdir, event_loop):
+    """Test that failed snapshots are retried"""
+    mydir = memory.MemoryServiceDirectory()
+    path = str(tmpdir.join('snapshot'))
+    publisher = snapshot.SnapshotPublisher(mydir, path, interval=0.01, retry_interval=0.01,
+                                           loop=event_loop)
+    yield from publisher.start()
+    with mock.patch('soa.directory.snapshot.write_snapshot',
+                    side_effect=[OSError('No space left on device'), None]) as write:
+        yield from mydir.publish(service=services.Service(name='a'))
+        for _ in range(100):
+            if write.call_count == 2:
+                break
+            yield from asyncio.sleep(0.01, loop=event_loop)
+    assert write.call_count == 2
+    assert publisher.generation == 1
+    publisher.close()
@@ -0,0 +1,193 @@
+"""Unit tests for soa.coap"""
+import asyncio
+import json
+
+from unittest import mock
+
+import pytest
+
+import aiocoap
+from aiocoap.numbers.codes import Code
+
+from soa import coap
+from soa import services
+from soa.directory import coap as directory_coap
+from soa.directory import memory
+from .test_data import EXAMPLE_SERVICES
+
+def json_response(payload):
+    """Create a service list response message"""
+    response = aiocoap.Message(code=Code.CONTENT, payload=json.dumps(payload).encode('utf-8'))
+    response.opt.content_format = aiocoap.numbers.media_types_rev['application/json']
+    return response
+
+def test_browser_delta():
+    """Test that ServiceDirectoryBrowser applies full lists and deltas"""
+    notify = mock.MagicMock()
+    browser = coap.ServiceDirectoryBrowser(
+        uri='coap://[::1]/servicediscovery/service', notify=notify, delta=True)
+    assert browser.make_request().opt.uri_query == ('delta', )
+    slist = [services.Service(**testcase['service']) for testcase in EXAMPLE_SERVICES.values()]
+    browser.browse_handler(json_response({
+        'epoch': 'abcd', 'generation': 3, 'full': True,
+        'service': [srv.to_json_dict() for srv in slist]}))
+    assert notify.call_count == 1
+    assert set(browser.services) == {srv.name for srv in slist}
+    assert browser.make_request().opt.uri_query == ('delta', 'since=3', 'epoch=abcd')
+
+    changed = services.Service(**EXAMPLE_SERVICES['SingleService1']['service'])
+    changed.port = 1
+    browser.browse_handler(json_response({
+        'epoch': 'abcd', 'generation': 5, 'since': 3,
+        'service': [changed.to_json_dict()], 'removed': [slist[1].name]}))
+    assert notify.call_count == 2
+    assert browser.services[changed.name] == changed
+    assert slist[1].name not in browser.services
+    assert len(browser.services) == len(slist) - 1
+
+    # A delta which does not follow on the last seen generation is dropped
+    browser.browse_handler(json_response({
+        'epoch': 'abcd', 'generation': 9, 'since': 7, 'service': [], 'removed': [changed.name]}))
+    assert notify.call_count == 2
+    assert changed.name in browser.services
+    assert browser.make_request().opt.uri_query == ('delta', )
+
+def test_browser_full_list():
+    """Test that services missing from a full list are forgotten"""
+    browser = coap.ServiceDirectoryBrowser(uri='coap://[::1]/servicediscovery/service')
+    slist = [services.Service(**testcase['service']) for testcase in EXAMPLE_SERVICES.values()]
+    browser.browse_handler(json_response({'service': [srv.to_json_dict() for srv in slist]}))
+    assert len(browser.services) == len(slist)
+    browser.browse_handler(json_response({'service': [slist[0].to_json_dict()]}))
+    assert list(browser.services) == [slist[0].name]
+    assert browser.make_request().opt.uri_query == ()
+
+@pytest.mark.asyncio
+def test_browser_resync():
+    """Test that a delta which does not apply is followed by a full list right away"""
+    browser = coap.ServiceDirectoryBrowser(
+        uri='coap://[::1]/servicediscovery/service', delta=True)
+    browser.epoch, browser.generation = 'abcd', 3
+    requests = []
+
+    class Done(Exception):
+        """Ends the test"""
+
+    @asyncio.coroutine
+    def start_observe():
+        """Answer with a stale delta, then with the full list"""
+        requests.append(browser.make_request().opt.uri_query)
+        if len(requests) == 1:
+            browser.browse_handler(json_response({
+                'epoch': 'abcd', 'generation': 9, 'since': 7, 'service': [], 'removed': []}))
+        elif len(requests) == 2:
+            browser.browse_handler(json_response({
+                'epoch': 'abcd', 'generation': 9, 'full': True,
+                'service': [{'name': 'a'}]}))
+        else:
+            raise Done()
+    browser.observer = mock.Mock(start_observe=start_observe, lost=False)
+    with mock.patch('asyncio.sleep') as sleep:
+        with pytest.raises(Done):
+            yield from browser.start_observe()
+    assert requests[:2] == [('delta', 'since=3', 'epoch=abcd'), ('delta', )]
+    assert list(browser.services) == ['a']
+    # Only the end of the observation with the full list backs off
+    assert sleep.call_count == 1
+
+class FakeRequester(object): #pylint: disable=too-few-public-methods
+    """Requester answering with a given response"""
+    def __init__(self, response):
+        self.response = asyncio.Future()
+        self.response.set_result(response)
+
+def block_response(payload, number, more, etag=b'1234'):
+    """Create a response carrying one block"""
+    response = aiocoap.Message(code=Code.CONTENT, payload=payload)
+    response.opt.block2 = (number, more, 0)
+    response.opt.etag = etag
+    return response
+
+@pytest.mark.asyncio
+def test_observer_blockwise_notification():
+    """Test that the blocks of a notification are assembled"""
+    handler = mock.MagicMock()
+    observer = coap.CoAPObserver(uri='coap://[::1]/servicediscovery/service?delta',
+                                 observation_handler=handler)
+    observer._request = observer.make_request() #pylint: disable=protected-access
+    observer.context = mock.MagicMock()
+    observer.context.request.side_effect = [
+        FakeRequester(block_response(b'b' * 16, 1, True)),
+        FakeRequester(block_response(b'c', 2, False)),
+    ]
+    observer.notification_handler(block_response(b'a' * 16, 0, True))
+    yield from observer._transfer #pylint: disable=protected-access
+    assert handler.call_count == 1
+    assembled = handler.call_args[0][0]
+    assert assembled.payload == b'a' * 16 + b'b' * 16 + b'c'
+    assert assembled.opt.block2 is None
+    requests = [call[0][0] for call in observer.context.request.call_args_list]
+    assert [req.opt.block2.block_number for req in requests] == [1, 2]
+    assert all(req.opt.uri_query == ('delta', ) for req in requests)
+    assert all(req.opt.observe is None for req in requests)
+
+    # Changed resource, the notification is dropped
+    handler.reset_mock()
+    observer.context.request.side_effect = [
+        FakeRequester(block_response(b'b' * 16, 1, False, etag=b'5678')),
+    ]
+    observer.notification_handler(block_response(b'a' * 16, 0, True))
+    yield from observer._transfer #pylint: disable=protected-access
+    assert not handler.called
+
+    # Single message notifications are passed on directly
+    observer.notification_handler(json_response({}))
+    assert handler.call_count == 1
+
+@asyncio.coroutine
+def wait_for_services(browser, count, timeout=5.0):
+    """Wait until the browser knows a number of services"""
+    for _ in range(int(timeout / 0.05)):
+        if len(browser.services) == count:
+            return
+        yield from asyncio.sleep(0.05)
+    assert len(browser.services) == count
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('delta', [False, True])
+def test_browser_blockwise_loopback(delta):
+    """Test observing a service list too large for one message over loopback"""
+    mydir = memory.MemoryServiceDirectory()
+    for index in range(30):
+        yield from mydir.publish(service=services.Service(
+            name='service-{:02}'.format(index), type='_x._udp', host='host.example.com',
+            port=index + 1, properties={'path': '/' + 'x' * 40}))
+    server = directory_coap.Server(directory=mydir, bind=('::1', 25684))
+    context = yield from server.context
+    browser = coap.ServiceDirectoryBrowser(
+        uri='coap://[::1]:25684/servicediscovery/service', delta=delta)
+    browser.observer = coap.CoAPObserver(
+        uri=browser.uri, observation_handler=browser.browse_handler,
+        request_factory=browser.make_request, refresh_interval=0.5)
+    browser.observer.max_age_grace = 0.1
+    task = asyncio.ensure_future(browser.start_observe())
+    try:
+        yield from wait_for_services(browser, 30)
+        for index in range(30, 33):
+            yield from mydir.publish(service=services.Service(
+                name='service-{:02}'.format(index), port=index + 1))
+            yield from wait_for_services(browser, index + 1)
+        client_context = browser.observer.context
+
+        # The observation is registered again when the server drops it
+        for observation in list(context.incoming_observations.values()):
+            observation.deregister('Dropped by test')
+        yield from mydir.publish(service=services.Service(name='service-33', port=34))
+        yield from wait_for_services(browser, 34)
+        assert browser.observer.context is client_context
+        yield from mydir.publish(service=services.Service(name='service-34', port=35))
+        yield from wait_for_services(browser, 35)
+    finally:
+        task.cancel()
+        yield from browser.observer.context.shutdown()
+        yield from context.shutdown()
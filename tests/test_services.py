@@ -144,6 +144,35 @@ def test_service_from_xml_neg(testcase):
         service = services.Service.from_xml(xml_input)
         assert isinstance(service, services.Service)
 
+def test_servicelist_from_json():
+    '''servicelist_from_json should parse the output of servicelist_to_json'''
+    slist = [services.Service(**case['service']) for case in EXAMPLE_SERVICES.values()]
+    assert services.servicelist_from_json(services.servicelist_to_json(slist)) == slist
+    for payload in ('{', '{}', '{"service": {}}', '{"service": [1]}'):
+        with pytest.raises(services.ServiceError):
+            services.servicelist_from_json(payload)
+
+def test_servicelist_from_xml():
+    '''servicelist_from_xml should parse the output of servicelist_to_xml'''
+    slist = [services.Service(**case['service']) for case in EXAMPLE_SERVICES.values()
+             if case['service'].get('port') is not None]
+    assert services.servicelist_from_xml(services.servicelist_to_xml(slist)) == slist
+    for payload in ('<serviceList>', '<service></service>',
+                    '<serviceList><service><port>x</port></service></serviceList>'):
+        with pytest.raises(services.ServiceError):
+            services.servicelist_from_xml(payload)
+
+def test_statuslist():
+    '''Batch results should be encoded as JSON and XML'''
+    statuses = [('a&b', 'created', 60), (None, 'invalid', None)]
+    assert json.loads(services.statuslist_to_json(statuses)) == {'status': [
+        {'name': 'a&b', 'status': 'created', 'lifetime': 60},
+        {'name': None, 'status': 'invalid'}]}
+    root = ET.fromstring(services.statuslist_to_xml(statuses))
+    assert [node.find('name').text for node in root] == ['a&b', 'None']
+    assert root[0].find('lifetime').text == '60'
+    assert root[1].find('lifetime') is None
+
 def test_servicelist_to_corelf():
     '''Service.to_corelf should give a Link object'''
     slist = [services.Service(**case['service']) for case in EXAMPLE_SERVICES.values()]
@@ -153,3 +182,14 @@ def test_servicelist_to_corelf():
         assert tuple(link.href.strip('/').split('/')) in uris
         uris.remove(tuple(link.href.strip('/').split('/')))
     assert len(uris) == 0
+
+def test_service_corelf_attributes():
+    '''Links to services should carry the service type and interface'''
+    service = services.Service(
+        name='x', type='_t._udp', host='::1', port=5683,
+        properties={'path': '/a', 'interface': 'core.s'})
+    links = link_header.parse(service.to_corelf()).links
+    assert links[0].href == 'coap://[::1]:5683/a'
+    assert links[0].attr_pairs == [['rt', '_t._udp'], ['if', 'core.s']]
+    links = link_header.parse(str(services.servicelist_to_corelf([service], '/uri/base'))).links
+    assert links[0].attr_pairs == [['rt', '_t._udp'], ['if', 'core.s']]
@@ -0,0 +1,67 @@
+"""Unit tests for soa.snapshot"""
+import json
+import os
+from unittest import mock
+
+import pytest
+from soa import services
+from soa import snapshot
+from .test_data import EXAMPLE_SERVICES
+
+def example_services():
+    """Create the example services"""
+    return [services.Service(**testcase['service']) for testcase in EXAMPLE_SERVICES.values()]
+
+def test_snapshot_reader(tmpdir):
+    """Test looking up services in a snapshot"""
+    path = str(tmpdir.join('snapshot'))
+    slist = example_services()
+    snapshot.write_snapshot(path, 'abcd', 7, slist)
+    reader = snapshot.SnapshotReader(path)
+    assert (reader.epoch, reader.generation, len(reader)) == ('abcd', 7, len(slist))
+    assert reader.names() == sorted(srv.name for srv in slist)
+    first = slist[0]
+    record = reader.record(first.name)
+    assert isinstance(record, memoryview)
+    assert json.loads(str(record, 'utf-8')) == first.to_json_dict()
+    assert reader.service(first.name) == first
+    assert first.name in reader
+    assert reader.record('missing') is None
+    with pytest.raises(KeyError):
+        reader.service('missing')
+    assert reader.service_list(type=first.type) == \
+        sorted((srv for srv in slist if srv.type == first.type), key=lambda srv: srv.name)
+
+def test_snapshot_superseded(tmpdir):
+    """Test that readers follow a replaced snapshot"""
+    path = str(tmpdir.join('snapshot'))
+    snapshot.write_snapshot(path, 'abcd', 1, [services.Service(name='a')])
+    reader = snapshot.SnapshotReader(path)
+    record = reader.record('a')
+    snapshot.write_snapshot(path, 'abcd', 2, [services.Service(name='b', type='t')])
+    assert reader.generation == 2
+    assert reader.names() == ['b']
+    assert reader.service_list(type='t') == [services.Service(name='b', type='t')]
+    # Records of the previous snapshot stay valid
+    assert json.loads(str(record, 'utf-8'))['name'] == 'a'
+    snapshot.write_snapshot(path, None, 0, [])
+    assert (reader.epoch, len(reader), reader.names()) == (None, 0, [])
+
+def test_snapshot_invalid(tmpdir):
+    """Test reading files which are no snapshots"""
+    path = tmpdir.join('snapshot')
+    path.write('not a snapshot, but long enough for a header')
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.SnapshotReader(str(path))
+    with pytest.raises(ValueError):
+        snapshot.write_snapshot(str(path), 'x' * 17, 1, [])
+
+def test_snapshot_write_failure(tmpdir):
+    """Test that a failed write leaves the previous snapshot in place"""
+    path = str(tmpdir.join('snapshot'))
+    snapshot.write_snapshot(path, 'abcd', 1, [services.Service(name='a')])
+    with mock.patch('os.replace', side_effect=OSError('No space left on device')):
+        with pytest.raises(OSError):
+            snapshot.write_snapshot(path, 'abcd', 2, [])
+    assert os.listdir(str(tmpdir)) == ['snapshot']
+    assert snapshot.SnapshotReader(path).names() == ['a']